@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark on synthetic NatMEG projects.
+
+Generates project trees like the ones on sinuhe and kaptah, with small FIF
+files made with MNE, and times the bidsify and MaxFilter planning steps at
+several scales. Results are appended to a JSON lines file and compared with
+the previous result of the same scale.
+
+    python benchmark.py --scales 10 100 --root /tmp/natmeg_benchmark
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from glob import glob
+from shutil import copyfile, rmtree
+
+# Tasks of each synthetic TRIUX session, the value is the number of split
+# parts after the first file
+squid_tasks = {
+    'RSEO': 0,
+    'Phalanges': 1,
+    'AudOdd': 0,
+    'empty_room_before': 0
+}
+opm_tasks = ['RSEO', 'AudOdd']
+trans_conditions = ['RSEO', 'Phalanges']
+
+steps = ['generate_new_conversion_table',
+         'update_conversion_table',
+         'maxfilter_plan',
+         'bidsify',
+         'update_sidecars']
+
+
+def make_templates(path: str, sfreq: float=200., duration: float=5.):
+    """
+    Write one small FIF file per recording type, copied into the tree.
+
+    Returns:
+        dict: file name per type: 'squid', 'opm', 'pos', 'cal', 'ctc'.
+    """
+    import numpy as np
+    import mne
+
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    n_times = int(sfreq * duration)
+    templates = {}
+
+    for kind, ch_names in [('squid', [f'MEG{i:04d}' for i in range(111, 121)]),
+                           ('opm', [f'OPM{i:03d}' for i in range(1, 11)])]:
+        info = mne.create_info(ch_names, sfreq, 'mag')
+        info['line_freq'] = 50.
+        with info._unlock():
+            info['dev_head_t'] = mne.transforms.Transform('meg', 'head')
+            info['meas_date'] = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+            info['gantry_angle'] = 68 if kind == 'squid' else 0
+        raw = mne.io.RawArray(rng.normal(size=(len(ch_names), n_times)) * 1e-12,
+                              info, verbose='error')
+        templates[kind] = f'{path}/{kind}_raw.fif'
+        raw.save(templates[kind], overwrite=True, verbose='error')
+
+    head_pos = np.zeros((int(duration), 10))
+    head_pos[:, 0] = np.arange(int(duration))
+    head_pos[:, 6] = 0.04
+    templates['pos'] = f'{path}/headpos.pos'
+    mne.chpi.write_head_pos(templates['pos'], head_pos)
+
+    # Calibration and crosstalk files are only copied by bidsify
+    for kind in ['cal', 'ctc']:
+        templates[kind] = f'{path}/{kind}.dat'
+        with open(templates[kind], 'w') as f:
+            f.write('')
+    return templates
+
+
+def make_project(root: str, n_subjects: int, n_sessions: int=1, opm: bool=True):
+    """
+    Create a synthetic project with n_subjects participants.
+
+    TRIUX data: sinuhe/bench/NatMEG_XXXX/<date>/meg/<task>_raw.fif with
+    split parts (<task>_raw-1.fif), an empty room recording and head
+    position files of the trans conditions. OPM data:
+    kaptah/bench/sub-XXXX/<date>_<time>_sub-XXXX_file-<task>OPM_raw.fif
+    with a channels.tsv per recording.
+
+    Split parts are separate small files, they only need to exist for
+    the conversion table.
+
+    Returns:
+        dict: paths of the squid, opm, bids and template folders.
+    """
+    paths = {
+        'squid': f'{root}/sinuhe/bench',
+        'opm': f'{root}/kaptah/bench' if opm else '',
+        'bids': f'{root}/bids',
+        'templates': f'{root}/templates'
+    }
+    templates = make_templates(paths['templates'])
+
+    for i in range(1, n_subjects + 1):
+        for s in range(n_sessions):
+            date = f'2401{s + 1:02d}'
+            meg = f"{paths['squid']}/NatMEG_{i:04d}/{date}/meg"
+            os.makedirs(meg, exist_ok=True)
+            for task, n_splits in squid_tasks.items():
+                copyfile(templates['squid'], f'{meg}/{task}_raw.fif')
+                for split in range(1, n_splits + 1):
+                    copyfile(templates['squid'], f'{meg}/{task}_raw-{split}.fif')
+                if task in trans_conditions:
+                    copyfile(templates['pos'], f'{meg}/{task}_headpos.pos')
+
+            if opm:
+                subject = f"{paths['opm']}/sub-{i:04d}"
+                os.makedirs(subject, exist_ok=True)
+                for task in opm_tasks:
+                    name = f'20{date}_120000_sub-{i:04d}_file-{task}OPM_raw.fif'
+                    copyfile(templates['opm'], f'{subject}/{name}')
+                    with open(f"{subject}/{name.replace('raw.fif', 'channels.tsv')}", 'w') as f:
+                        f.write('name\tsensor_id\n')
+                        f.writelines(f'OPM{c:03d}\t{c}\n' for c in range(1, 11))
+    return paths
+
+
+def bids_config(paths: dict):
+    from bidsify import defaultBidsConfig
+
+    config = defaultBidsConfig()
+    config.update({
+        'squidMEG': paths['squid'],
+        'opmMEG': paths['opm'],
+        'BIDS': paths['bids'],
+        'Calibration': f"{paths['templates']}/cal.dat",
+        'Crosstalk': f"{paths['templates']}/ctc.dat"
+    })
+    return config
+
+
+def maxfilter_config(paths: dict):
+    from maxfilter import defaultMaxfilterConfig
+
+    config = defaultMaxfilterConfig()
+    config['standard_settings'].update({
+        'data_path': os.path.dirname(paths['squid']),
+        'project_name': os.path.basename(paths['squid']),
+        'trans_conditions': trans_conditions,
+        'empty_room_files': ['empty_room_before'],
+        'sss_files': ['AudOdd']
+    })
+    return config
+
+
+def run_steps(paths: dict, selected: list):
+    """
+    Time the selected steps on a project, in pipeline order.
+
+    Returns:
+        dict: seconds per step.
+    """
+    import bidsify
+    import maxfilter
+
+    config = bids_config(paths)
+    timings = {}
+
+    def timed(step, func, *args, **kwargs):
+        if step not in selected:
+            return None
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            result = func(*args, **kwargs)
+        timings[step] = round(time.perf_counter() - start, 3)
+        print(f'  {step}: {timings[step]:.2f} s')
+        return result
+
+    timed('generate_new_conversion_table', bidsify.generate_new_conversion_table, config)
+    conversion_file = (sorted(glob(f"{paths['bids']}/conversion_logs/*_bids_conversion.tsv")) or [None])[-1]
+    if conversion_file:
+        table = bidsify.load_conversion_table(config, conversion_file)
+        timed('update_conversion_table', bidsify.update_conversion_table, table, conversion_file)
+
+    timed('maxfilter_plan',
+          lambda: maxfilter.MaxFilter(maxfilter_config(paths)).build_graph())
+
+    if conversion_file:
+        timed('bidsify', bidsify.bidsify, config, conversion_file)
+        timed('update_sidecars', bidsify.update_sidecars, paths['bids'])
+    return timings
+
+
+def environment():
+    import mne
+    import mne_bids
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'mne': mne.__version__,
+        'mne_bids': mne_bids.__version__
+    }
+
+
+def read_results(results_file: str):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(result: dict, previous: list):
+    """Print the timings next to the last earlier result of the same scale."""
+    earlier = [r for r in previous
+               if r['n_subjects'] == result['n_subjects']
+               and r['n_sessions'] == result['n_sessions']]
+    if not earlier:
+        return
+    last = earlier[-1]
+    print(f"  compared with {last['environment'].get('commit')} ({last['time']}):")
+    for step, seconds in result['timings'].items():
+        before = last['timings'].get(step)
+        if before:
+            print(f'    {step}: {before:.2f} s -> {seconds:.2f} s ({seconds / before:.2f}x)')
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='''Benchmark
+
+                                     Times bidsify and MaxFilter planning on synthetic NatMEG projects.
+
+                                     ''',
+                                     add_help=True)
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100],
+                        help='Numbers of subjects, e.g. 10 100 1000')
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions per subject')
+    parser.add_argument('--steps', nargs='+', default=steps, choices=steps,
+                        help='Steps to time')
+    parser.add_argument('--root', type=str, default='natmeg_benchmark',
+                        help='Folder for the synthetic projects, removed before each scale')
+    parser.add_argument('--results', type=str, default='benchmark_results.jsonl',
+                        help='Results file, one JSON object per run and scale')
+    parser.add_argument('--no-opm', action='store_true', help='Only create TRIUX data')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic projects')
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    previous = read_results(args.results)
+    env = environment()
+
+    for n_subjects in args.scales:
+        root = os.path.abspath(f'{args.root}/{n_subjects}')
+        if os.path.exists(root):
+            rmtree(root)
+
+        print(f'{n_subjects} subjects:')
+        start = time.perf_counter()
+        paths = make_project(root, n_subjects, args.sessions, opm=not args.no_opm)
+        print(f'  created project in {time.perf_counter() - start:.2f} s')
+
+        result = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'n_subjects': n_subjects,
+            'n_sessions': args.sessions,
+            'n_files': sum(len(files) for _, _, files in os.walk(root)),
+            'environment': env,
+            'timings': run_steps(paths, args.steps)
+        }
+        compare(result, previous)
+
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+        if not args.keep:
+            rmtree(root)
+
+    print(f'Results appended to {args.results}')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
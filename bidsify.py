@@ -1,6 +1,7 @@
 # #!/opt/miniconda3/envs/mne/bin/python
 # #!/home/natmeg/miniforge3/envs/mne/bin/python
-import pandas as pd
+from __future__ import annotations
+
 import json
 import re
 import os
@@ -8,36 +9,34 @@ from shutil import copy2
 from os.path import exists, basename, dirname
 import sys
 from glob import glob
-import numpy as np
-import tkinter as tk
-from tkinter.filedialog import askopenfilename, asksaveasfile
 import argparse
 from datetime import datetime
+from typing import TYPE_CHECKING
 
-
-from mne_bids import (
-    BIDSPath,
-    write_raw_bids,
-    read_raw_bids,
-    update_sidecar_json,
-    make_dataset_description,
-    write_meg_calibration,
-    write_meg_crosstalk,
-    update_anat_landmarks,
-    print_dir_tree,
-    find_matching_paths
-    )
-from mne_bids.utils import _write_json
-import mne
+# mne, mne_bids, numpy, pandas and tkinter are imported where they are
+# used, so that the command line starts fast and works without Tk
+if TYPE_CHECKING:
+    import mne
+    import pandas as pd
+    from mne_bids import BIDSPath
 
 from utils import (
     log,
     noise_patterns,
     headpos_patterns,
     askForConfig,
-    extract_info_from_filename,
-    file_contains
+    file_contains,
+    max_movement,
+    HeadposCache
 )
+from resources import Usage, ResourceReport, measure
+from profiling import profiler, span
+from inventory import inventory
+from staging import staging
+from iolimits import limits
+from bidstree import BidsIndex
+from bidstables import tables
+import metrics
 ###############################################################################
 # Global variables
 ###############################################################################
@@ -47,6 +46,11 @@ InstitutionName = 'Karolinska Institutet'
 InstitutionAddress = 'Nobels vag 9, 171 77, Stockholm, Sweden'
 InstitutionDepartmentName = 'Department of Clinical Neuroscience (CNS)'
 global data
+
+
+class DeviantsError(ValueError):
+    """Rows of the conversion table with a task_flag to check."""
+
 ###############################################################################
 # Functions: Create or fill templates: dataset description, participants info
 ###############################################################################
@@ -62,6 +66,7 @@ def create_dataset_description(
     Returns:
         None
     """
+    from mne_bids import make_dataset_description
     
     # Make sure the BIDS directory exists and create it if it doesn't
     os.makedirs(path_BIDS, exist_ok=True)
@@ -90,6 +95,7 @@ def create_dataset_description(
 
     # Open UI to fill the dataset description if not exists or overwrite is True
     if edit:
+        import tkinter as tk
         
         # Create a new Tkinter window
         root = tk.Tk()
@@ -165,6 +171,7 @@ def create_participants_files(
     path_BIDS: str='.',
     overwrite=False):
     # check if participants.tsv and participants.json files is available or create a new one with default fields
+    import pandas as pd
     output_path = os.path.join(path_BIDS)
     os.makedirs(output_path, exist_ok=True)
     
@@ -241,6 +248,8 @@ def openBidsConfigUI(json_name: str = None):
     None
     
     """
+    import tkinter as tk
+    from tkinter.filedialog import asksaveasfile
 
     # Check if the configuration file exists and if so load
     if not(json_name):
@@ -329,23 +338,30 @@ def openBidsConfigUI(json_name: str = None):
     root.mainloop()
     return data
 
-def update_sidecars(bids_root):
+def update_sidecars(bids_root, tree: BidsIndex=None):
     
     """_summary_
 
     Args:
         bids_root (str): _description_
+        tree (BidsIndex): Index of the BIDS tree, rewritten sidecars are
+            recorded in it.
     Returns:
         None
     """
+    import mne
+    from mne_bids import find_matching_paths
     # bids_root = config_dict.get('BIDS')
     # Find all meg files in the BIDS folder, ignore EEG for now
-    bids_paths = find_matching_paths(bids_root,
-                                     suffixes='meg',
-                                    acquisitions=['triux', 'hedscan'],
-                                    splits=None,
-                                    descriptions=None,
-                                     extensions='.fif')
+    with span('scan', bids_root):
+        bids_paths = find_matching_paths(bids_root,
+                                         suffixes='meg',
+                                        acquisitions=['triux', 'hedscan'],
+                                        splits=None,
+                                        descriptions=None,
+                                         extensions='.fif')
+    headpos_cache = HeadposCache()
+
     # Add institution name, department and address
     institution = {
             'InstitutionName': InstitutionAddress,
@@ -354,97 +370,99 @@ def update_sidecars(bids_root):
             }
     
     for bp in bids_paths:
-        if not file_contains(bp.basename, headpos_patterns):
-            acq = bp.acquisition
-            proc = bp.processing
-            suffix = bp.suffix
-            info = mne.io.read_info(bp.fpath, verbose='error')
-            bp_json = bp.copy().update(extension='.json', split=None)
-            with open(str(bp_json.fpath), 'r') as f:
-                sidecar = json.load(f)
+        with span('sidecar', bp.basename), limits.access(bp.root):
+            if not file_contains(bp.basename, headpos_patterns):
+                acq = bp.acquisition
+                proc = bp.processing
+                suffix = bp.suffix
+                info = mne.io.read_info(bp.fpath, verbose='error')
+                bp_json = bp.copy().update(extension='.json', split=None)
+                with open(str(bp_json.fpath), 'r') as f:
+                    text = f.read()
+                sidecar = json.loads(text)
             
-            if not file_contains(bp.task.lower(), noise_patterns):
-                match_paths = find_matching_paths(
-                                bp.directory,
-                                acquisitions=acq,
-                                suffixes='meg',
-                                extensions='.fif')
-
-                noise_paths = [p for p in match_paths if 'noise' in p.task.lower()]
-                sidecar['AssociatedEmptyRoom'] = [basename(er) for er in noise_paths]
+                if not file_contains(bp.task.lower(), noise_patterns):
+                    match_paths = find_matching_paths(
+                                    bp.directory,
+                                    acquisitions=acq,
+                                    suffixes='meg',
+                                    extensions='.fif')
+
+                    noise_paths = [p for p in match_paths if 'noise' in p.task.lower()]
+                    sidecar['AssociatedEmptyRoom'] = [basename(er) for er in noise_paths]
                 
-                # Find associated headpos and trans files
-                headpos_file = find_matching_paths(
-                    bp.directory,
-                    bp.task,
-                    acquisitions=acq,
-                    descriptions='headpos',
-                    extensions='.pos',
-                )
-                trans_file = find_matching_paths(
-                    bp.directory,
-                    bp.task,
-                    acquisitions=acq,
-                    descriptions='trans',
-                    extensions='.fif',
-                )
-                if headpos_file:
-                    path = f"{headpos_file[0].root}/{headpos_file[0].basename}"
-                    headpos = mne.chpi.read_head_pos(path)
-                    trans_head, rot, t = mne.chpi.head_pos_to_trans_rot_t(headpos)
-                    sidecar['MaxMovement'] = round(float(trans_head.max()), 4)
-                    
-                if trans_file:
-                    path = f"{headpos_file[0].root}/{headpos_file[0].basename}"
-                    trans = mne.read_trans(path)
+                    # Find associated headpos file
+                    headpos_file = find_matching_paths(
+                        bp.directory,
+                        bp.task,
+                        acquisitions=acq,
+                        descriptions='headpos',
+                        extensions='.pos',
+                    )
+                    if headpos_file:
+                        path = str(headpos_file[0].fpath)
+                        cached = headpos_cache.lookup(path)
+                        if cached and 'MaxMovement' in cached['meta']:
+                            sidecar['MaxMovement'] = cached['meta']['MaxMovement']
+                        else:
+                            movement = max_movement(mne.chpi.read_head_pos(path), info['dev_head_t'])
+                            if movement is not None:
+                                sidecar['MaxMovement'] = movement
 
-            if acq == 'triux' and suffix == 'meg':
-                if info['gantry_angle'] > 0:
-                    dewar_pos = f'upright ({int(info["gantry_angle"])} degrees)'
-                else:
-                    dewar_pos = f'supine ({int(info["gantry_angle"])} degrees)'
-                sidecar['DewarPosition'] = dewar_pos
-                try:
-                    # mne.chpi.get_chpi_info(info)
-                    sidecar['HeadCoilFrequency'] = [f['coil_freq'] for f in info['hpi_meas'][0]['hpi_coils']]
-                except IndexError:
-                    'No head coil frequency found'
-
-                # sidecar['ContinuousHeadLocalization']
+                if acq == 'triux' and suffix == 'meg':
+                    if info['gantry_angle'] > 0:
+                        dewar_pos = f'upright ({int(info["gantry_angle"])} degrees)'
+                    else:
+                        dewar_pos = f'supine ({int(info["gantry_angle"])} degrees)'
+                    sidecar['DewarPosition'] = dewar_pos
+                    try:
+                        # mne.chpi.get_chpi_info(info)
+                        sidecar['HeadCoilFrequency'] = [f['coil_freq'] for f in info['hpi_meas'][0]['hpi_coils']]
+                    except IndexError:
+                        'No head coil frequency found'
+
+                    # sidecar['ContinuousHeadLocalization']
                 
-                # TODO: Add maxfilter and headposition parameters
-                if proc:
-                    print('Processing detected')
-                    proc_list = proc.split('+')
-                    max_info = info['proc_history'][0]['max_info']
+                    # TODO: Add maxfilter and headposition parameters
+                    if proc:
+                        print('Processing detected')
+                        proc_list = proc.split('+')
+                        max_info = info['proc_history'][0]['max_info']
                     
-                    if file_contains(proc, ['sss', 'tsss']):
-                        sss_info = max_info['sss_info']
-                        sidecar['SoftwareFilters']['MaxFilterVersion'] = info['proc_history'][0]['creator']
-                        sidecar['SoftwareFilters']['SignalSpaceSeparation'] = {
-                            'Origin': sss_info['origin'].tolist(),
-                            'NComponents': sss_info['nfree'],
-                            'HPIGLimit': sss_info['hpi_g_limit'],
-                            'HPIDistanceLimit': sss_info['hpi_dist_limit']
+                        if file_contains(proc, ['sss', 'tsss']):
+                            sss_info = max_info['sss_info']
+                            sidecar['SoftwareFilters']['MaxFilterVersion'] = info['proc_history'][0]['creator']
+                            sidecar['SoftwareFilters']['SignalSpaceSeparation'] = {
+                                'Origin': sss_info['origin'].tolist(),
+                                'NComponents': sss_info['nfree'],
+                                'HPIGLimit': sss_info['hpi_g_limit'],
+                                'HPIDistanceLimit': sss_info['hpi_dist_limit']
                             
-                        }
-                        if ['tsss'] in proc_list:
-                            max_st = max_info['max_st']
-                            sidecar['SoftwareFilters']['TemporalSignalSpaceSeparation'] = {
-                                'SubSpaceCorrelationLimit': max_st['subspcorr'],
-                                'LengtOfDataBuffert': max_st['buflen']
                             }
+                            if ['tsss'] in proc_list:
+                                max_st = max_info['max_st']
+                                sidecar['SoftwareFilters']['TemporalSignalSpaceSeparation'] = {
+                                    'SubSpaceCorrelationLimit': max_st['subspcorr'],
+                                    'LengtOfDataBuffert': max_st['buflen']
+                                }
                     
-                    # sidecar['MaxMovement'] 
-                    # Add average head position file
+                        # sidecar['MaxMovement'] 
+                        # Add average head position file
 
-            if acq == 'hedscan':
-                sidecar['Manufacturer'] = 'FieldLine'
+                if acq == 'hedscan':
+                    sidecar['Manufacturer'] = 'FieldLine'
             
-            new_sidecar = institution | sidecar
+                new_sidecar = institution | sidecar
             
-            with open(str(bp_json.fpath), 'w') as f:
-                json.dump(new_sidecar, f, indent=4)
+                # Unchanged sidecars are not written again
+                new_text = json.dumps(new_sidecar, indent=4)
+                if new_text != text:
+                    with open(str(bp_json.fpath), 'w') as f:
+                        f.write(new_text)
+                    if tree:
+                        tree.record(bp_json.fpath)
+    if tree:
+        tree.save()
 
 
 def update_sidecar(bids_path: BIDSPath):
@@ -455,6 +473,8 @@ def update_sidecar(bids_path: BIDSPath):
     Returns:
         None
     """
+    import mne
+    from mne_bids import update_sidecar_json, find_matching_paths
     # Find associated sidecar file
     sidecar_path = bids_path.copy().update(
         check=True,
@@ -472,7 +492,11 @@ def update_sidecar(bids_path: BIDSPath):
     # Add Dewar position and associated empty room
     if bids_path.datatype == 'meg' and bids_path.acquisition == 'triux':
         
-        info = mne.io.read_info(bids_path.fpath, verbose='error')
+        fif_path = bids_path.fpath
+        if not fif_path.exists():
+            # Split recording
+            fif_path = bids_path.copy().update(split='01').fpath
+        info = mne.io.read_info(fif_path, verbose='error')
         if info['gantry_angle'] > 0:
             dewar_pos = f'upright ({int(info["gantry_angle"])} degrees)'
         else:
@@ -504,6 +528,8 @@ def add_channel_parameters(
     bids_tsv: str,
     opm_tsv: str):
 
+    import numpy as np
+    import pandas as pd
     if exists(opm_tsv):
         orig_df = pd.read_csv(opm_tsv, sep='\t')
         bids_df = pd.read_csv(bids_tsv, sep='\t')
@@ -523,6 +549,8 @@ def add_channel_parameters(
 
 def copy_eeg_to_meg(file_name: str, bids_path: BIDSPath):
     
+    import mne
+    from mne_bids import find_matching_paths
     if not file_contains(file_name, headpos_patterns):
         raw = mne.io.read_raw_fif(file_name, allow_maxshield=True, verbose='error')
         ch_types = set(raw.info.get_channel_types())
@@ -549,14 +577,111 @@ def copy_eeg_to_meg(file_name: str, bids_path: BIDSPath):
                 if not exists(new_cap):
                     copy2(old_cap, new_cap)
 
+def write_fif_copy(raw: mne.io.Raw, bids_path: BIDSPath):
+    """
+    Write a MEG recording to BIDS by copying the FIF files block by block
+    (see fifcopy.py) instead of decoding and saving the data with MNE.
+
+    write_raw_bids writes the sidecars and scans.tsv with a symlink to the
+    raw file, which is then replaced by the copy. Split recordings keep
+    their split boundaries and are named split-01, split-02, ... as when
+    written by MNE-BIDS.
+
+    Args:
+        raw (mne.io.Raw, required): Recording read from its raw file.
+        bids_path (BIDSPath, required): Destination of the recording.
+
+    Returns:
+        int: number of bytes written.
+
+    Raises:
+        ValueError: If the files cannot be copied, e.g. they are not
+            written sequentially.
+    """
+    from mne_bids import BIDSPath, write_raw_bids
+    from fifcopy import read_tags, copy_split_fif
+
+    src_files = [str(f) for f in raw.filenames]
+    for src in src_files:
+        read_tags(src)
+
+    if len(src_files) == 1:
+        dst_files = [bids_path.fpath]
+    else:
+        dst_files = [bids_path.copy().update(split=f'{i + 1:02d}').fpath
+                     for i in range(len(src_files))]
+
+    # Remove earlier outputs, write_raw_bids would load the data to overwrite
+    split_pattern = str(bids_path.copy().update(split='01').fpath).replace('split-01', 'split-*')
+    for dst in [bids_path.fpath] + glob(split_pattern):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    write_raw_bids(
+        raw=raw,
+        bids_path=bids_path,
+        empty_room=None,
+        events=None,
+        overwrite=True,
+        symlink=True,
+        verbose='error'
+    )
+    os.remove(bids_path.fpath)
+    written = copy_split_fif(src_files, dst_files)
+
+    if len(dst_files) > 1:
+        # List the split files in scans.tsv instead of the symlink
+        from collections import OrderedDict
+        scans_tsv = BIDSPath(subject=bids_path.subject, session=bids_path.session,
+                             suffix='scans', extension='.tsv', root=bids_path.root).fpath
+        scans = tables.read(scans_tsv)
+        link_name = f'{bids_path.datatype}/{bids_path.fpath.name}'
+        split_names = [f'{bids_path.datatype}/{dst.name}' for dst in dst_files]
+        rows = []
+        for row in [dict(zip(scans, values)) for values in zip(*scans.values())]:
+            if row['filename'] == link_name:
+                rows += [row | {'filename': name} for name in split_names]
+            elif row['filename'] not in split_names:
+                rows.append(row)
+        tables.write(scans_tsv, OrderedDict((column, [row[column] for row in rows]) for column in scans))
+    return written
+
+def count_tasks(df: pd.DataFrame):
+    """
+    Number of files of each task per participant, and a flag for the tasks
+    with another count than the largest one in the table.
+
+    Returns:
+        tuple: task_count and task_flag ('check' or 'ok') of each row.
+    """
+    columns = ['participant_to', 'acquisition', 'datatype', 'split', 'task', 'processing', 'description']
+    # Missing values as '', as in a new table, a loaded table reads them as NaN
+    keys = df[columns].astype(object).where(df[columns].notnull(), '')
+    task_count = df['task'].groupby([keys[c] for c in columns]).transform('count')
+    task_flag = ['check' if count != task_count.max() else 'ok' for count in task_count]
+    return task_count, task_flag
+
 def generate_new_conversion_table(
     config_dict: dict,
-    overwrite=False):
+    overwrite=False,
+    participants: list=None,
+    sessions: list=None,
+    save=True):
     
     """
     For each participant and session within MEG folder, move the files to BIDS correspondent folder
     or create a new one if the session does not match. Change the name of the files into BIDS format.
+
+    Args:
+        participants (list): Only scan these raw participant folders.
+        sessions (list): Only scan these raw session folders.
+        save (bool): Write the table to the conversion_logs folder.
+
+    Returns:
+        pd.DataFrame: the conversion table
     """
+    import pandas as pd
+    from mne_bids import BIDSPath, find_matching_paths
     ts = datetime.now().strftime('%Y%m%d')
     path_triux = config_dict['squidMEG']
     path_opm = config_dict['opmMEG']
@@ -567,6 +692,9 @@ def generate_new_conversion_table(
     old_session = config_dict['Original session name']
     new_session = config_dict['New session name']
     
+    participant_filter = participants
+    session_filter = sessions
+
     processing_modalities = []
     if path_triux != '' and str(path_triux) != '()':
         processing_modalities.append('triux')
@@ -603,31 +731,40 @@ def generate_new_conversion_table(
     
     
     for mod in processing_modalities:
-        if mod == 'triux':
-            path = path_triux
-            participants = [p for p in glob('NatMEG*', root_dir=path) if os.path.isdir(os.path.join(path, p))]
-        elif mod == 'hedscan':
-            path = path_opm
-            participants = [p for p in glob('sub*', root_dir=path) if os.path.isdir(os.path.join(path, p))]
+        with span('scan', mod):
+            if mod == 'triux':
+                path = path_triux
+                participants = [p for p in inventory.glob('NatMEG*', root_dir=path) if os.path.isdir(os.path.join(path, p))]
+            elif mod == 'hedscan':
+                path = path_opm
+                participants = [p for p in inventory.glob('sub*', root_dir=path) if os.path.isdir(os.path.join(path, p))]
+
+        if participant_filter:
+            participants = [p for p in participants if p in participant_filter]
 
         for participant in participants:
             
-            if mod == 'triux':
-                sessions = [session for session in glob('*', root_dir=os.path.join(path, participant)) if os.path.isdir(os.path.join(path, participant, session))]
-                
-            elif mod == 'hedscan':
-                sessions = list(set([f.split('_')[0][2:] for f in glob('*.fif', root_dir=os.path.join(path, participant))]))
+            with span('scan', participant):
+                if mod == 'triux':
+                    sessions = [session for session in inventory.glob('*', root_dir=os.path.join(path, participant)) if os.path.isdir(os.path.join(path, participant, session))]
+                    
+                elif mod == 'hedscan':
+                    sessions = list(set([f.split('_')[0][2:] for f in inventory.glob('*.fif', root_dir=os.path.join(path, participant))]))
+
+            if session_filter:
+                sessions = [s for s in sessions if s in session_filter]
 
             for date_session in sessions:
                 
                 session = date_session
                 
-                if mod == 'triux':
-                    all_files = sorted(glob('*.fif', root_dir=os.path.join(path, participant, date_session, 'meg')) + 
-                                      glob('*.pos', root_dir=os.path.join(path, participant, date_session, 'meg')))
-                    
-                elif mod == 'hedscan':
-                    all_files = sorted(glob('*.fif', root_dir=os.path.join(path, participant)))
+                with span('scan', f'{participant}/{date_session}'):
+                    if mod == 'triux':
+                        all_files = sorted(inventory.glob('*.fif', root_dir=os.path.join(path, participant, date_session, 'meg')) + 
+                                          inventory.glob('*.pos', root_dir=os.path.join(path, participant, date_session, 'meg')))
+                        
+                    elif mod == 'hedscan':
+                        all_files = sorted(inventory.glob('*.fif', root_dir=os.path.join(path, participant)))
 
                 for file in all_files:
                     
@@ -637,7 +774,7 @@ def generate_new_conversion_table(
                         full_file_name = os.path.join(path, participant, file)
                     
                     if exists(full_file_name):
-                        info_dict = extract_info_from_filename(full_file_name)
+                        info_dict = inventory.file_info(full_file_name)
                     
                     task = info_dict.get('task')
                     proc = '+'.join(info_dict.get('processing'))
@@ -659,10 +796,7 @@ def generate_new_conversion_table(
                         # TODO: Test bypass if file broken
                         print(full_file_name)
                         try:
-                            info = mne.io.read_raw_fif(full_file_name,
-                                            allow_maxshield=True,
-                                            verbose='error')
-                            ch_types = set(info.get_channel_types())
+                            ch_types = inventory.header(full_file_name).ch_types
                         except Exception as e:
                             print(f"Error reading file {full_file_name}: {e}")
                             ch_types = ['']
@@ -680,29 +814,30 @@ def generate_new_conversion_table(
                     else:
                         datatype = 'meg'
                         
-                    bids_path = BIDSPath(
-                        subject=subject,
-                        session=session,
-                        task=task,
-                        acquisition=mod,
-                        processing=None if proc == '' else proc,
-                        run=None if run == '' else run,
-                        datatype=datatype,
-                        description=None if desc == '' else desc,
-                        root=path_BIDS,
-                        extension=extension,
-                        suffix=suffix
-                    )
-                    
-                    # Check if bids exist
-                    run_conversion = 'yes'
-                    if (find_matching_paths(bids_path.directory,
-                                        tasks=task,
-                                        acquisitions=mod,
-                                        suffixes=suffix,
-                                        descriptions=None if desc == '' else desc,
-                                        extensions=extension)):
-                        run_conversion = 'no'
+                    with span('map', file):
+                        bids_path = BIDSPath(
+                            subject=subject,
+                            session=session,
+                            task=task,
+                            acquisition=mod,
+                            processing=None if proc == '' else proc,
+                            run=None if run == '' else run,
+                            datatype=datatype,
+                            description=None if desc == '' else desc,
+                            root=path_BIDS,
+                            extension=extension,
+                            suffix=suffix
+                        )
+                        
+                        # Check if bids exist
+                        run_conversion = 'yes'
+                        if (find_matching_paths(bids_path.directory,
+                                            tasks=task,
+                                            acquisitions=mod,
+                                            suffixes=suffix,
+                                            descriptions=None if desc == '' else desc,
+                                            extensions=extension)):
+                            run_conversion = 'no'
 
                     processing_schema['time_stamp'].append(ts)
                     processing_schema['run_conversion'].append(run_conversion)
@@ -726,19 +861,20 @@ def generate_new_conversion_table(
 
     df = pd.DataFrame(processing_schema)
     
-    df.insert(2, 'task_count',
-              df.groupby(['participant_to', 'acquisition', 'datatype', 'split', 'task', 'processing', 'description'])['task'].transform('count'))
-    
-    df.insert(3, 'task_flag', df.apply(
-                lambda x: 'check' if x['task_count'] != df['task_count'].max() else 'ok', axis=1))
+    task_count, task_flag = count_tasks(df)
+    df.insert(2, 'task_count', task_count)
+    df.insert(3, 'task_flag', task_flag)
     
 
-    os.makedirs(f'{path_BIDS}/conversion_logs', exist_ok=True)
-    df.to_csv(f'{path_BIDS}/conversion_logs/{ts}_bids_conversion.tsv', sep='\t', index=False) 
+    if save:
+        os.makedirs(f'{path_BIDS}/conversion_logs', exist_ok=True)
+        df.to_csv(f'{path_BIDS}/conversion_logs/{ts}_bids_conversion.tsv', sep='\t', index=False) 
+    return df
 
 def load_conversion_table(config_dict: dict,
                           conversion_file: str=None):
         # Load the most recent conversion table
+    import pandas as pd
     path_BIDS = config_dict.get('BIDS')
     conversion_logs_path = os.path.join(path_BIDS, 'conversion_logs')
     if not os.path.exists(conversion_logs_path):
@@ -763,32 +899,88 @@ def load_conversion_table(config_dict: dict,
         
     return conversion_table
 
+def latest_conversion_file(config_dict: dict):
+    """
+    Path of the most recent conversion table, a new table is created if
+    there is none.
+    """
+    conversion_table = load_conversion_table(config_dict)
+    if conversion_table is None:
+        conversion_table = load_conversion_table(config_dict)
+    # By name, a table copied for editing keeps the time_stamp of the original
+    return sorted(glob(f"{config_dict['BIDS']}/conversion_logs/*_bids_conversion.tsv"))[-1]
+
 def update_conversion_table(conversion_table: pd.DataFrame, 
                             conversion_file: str=None):
+    """
+    Set the rows without BIDS output to run_conversion=yes, and write the
+    table to conversion_file if given.
+    """
     for i, row in conversion_table.iterrows():
         
         path = row['bids_path']
         datatype = basename(row['bids_path'])
         file = row['bids_name'].split(datatype)[0]
-        files = glob(f'{file}*', root_dir=path)
+        files = inventory.glob(f'{file}*', root_dir=path)
         if not files:
             conversion_table.at[i, 'run_conversion'] = 'yes'
             print(f'Running conversion on {row['raw_name']}')
     
-    conversion_table.to_csv(conversion_file, sep='\t', index=False)
+    if conversion_file:
+        conversion_table.to_csv(conversion_file, sep='\t', index=False)
     return conversion_table
 
         
-def bidsify(config_dict: dict, conversion_file: str=None):
+def bidsify(config_dict: dict,
+            conversion_file: str=None,
+            participants: list=None,
+            sessions: list=None,
+            files: set=None,
+            conversion_table: pd.DataFrame=None,
+            save: bool=True):
+    """
+    Convert the files in the conversion table to BIDS.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        conversion_file (str): Conversion table, defaults to the latest.
+        participants (list): Only convert these raw participants
+            (participant_from).
+        sessions (list): Only convert these raw sessions (session_from).
+        files (set): Only convert these raw files (raw_path, raw_name),
+            e.g. the rows changed since an earlier table.
+        conversion_table (pd.DataFrame): Contents of conversion_file if
+            already loaded, updated in place instead of reading it again.
+        save (bool): Write the conversion table to conversion_file.
+
+    Returns:
+        BidsIndex: the files of the BIDS tree and the changes of this run.
+    """
+    import pandas as pd
+    import mne
+    from mne_bids import BIDSPath, write_raw_bids, write_meg_calibration, write_meg_crosstalk
     
     path_BIDS = config_dict.get('BIDS')
     calibration = config_dict['Calibration']
     crosstalk = config_dict['Crosstalk']
     overwrite = config_dict['Overwrite']
 
-    df = load_conversion_table(config_dict, conversion_file)
-    df = update_conversion_table(df, conversion_file)
-    df = df.where(pd.notnull(df), None)
+    conversion_file = conversion_file or latest_conversion_file(config_dict)
+    if conversion_table is None:
+        conversion_table = load_conversion_table(config_dict, conversion_file)
+    df = conversion_table.astype(object).where(pd.notnull(conversion_table), None)
+    if participants:
+        df = df[df['participant_from'].isin(participants)]
+    if sessions:
+        df = df[df['session_from'].isin(sessions)]
+    if files is not None:
+        df = df[[(p, n) in files for p, n in zip(df['raw_path'], df['raw_name'])]]
+    # Only the selected rows are checked for missing outputs
+    df = update_conversion_table(df)
+    conversion_table.loc[df.index, 'run_conversion'] = df['run_conversion']
+    headpos_cache = HeadposCache()
+    report = ResourceReport()
+    tree = BidsIndex(path_BIDS)
     
     # Start by creating the BIDS directory structure
     unique_participants_sessions = df[['participant_to', 'session_to', 'datatype']].drop_duplicates()
@@ -802,8 +994,10 @@ def bidsify(config_dict: dict, conversion_file: str=None):
         if row['datatype'] == 'meg':
             if not bids_path.meg_calibration_fpath:
                     write_meg_calibration(calibration, bids_path)
+                    tree.record(bids_path.meg_calibration_fpath)
             if not bids_path.meg_crosstalk_fpath:
                 write_meg_crosstalk(crosstalk, bids_path)
+                tree.record(bids_path.meg_crosstalk_fpath)
     
     # ignore split files as they are processed automatically
     df = df[df['split'].isna()]
@@ -812,111 +1006,293 @@ def bidsify(config_dict: dict, conversion_file: str=None):
     if len(deviants) > 0:
         print('Deviants found:')
         print(deviants)
-        print('Please check the conversion table')
-        sys.exit(1)
-
-    for i, d in df.iterrows():
+        # An exception and not sys.exit, a session job of maxfilter.py
+        # fails without stopping the other jobs of the run
+        raise DeviantsError(f'{len(deviants)} deviant rows in {basename(conversion_file)}, '
+                            'please check the conversion table')
+
+    # Copied to scratch ahead of the conversion if staging is enabled
+    staging.queue(f"{d['raw_path']}/{d['raw_name']}" for d in df.to_dict('records')
+                  if not (d['run_conversion'] == 'no' and overwrite == 'off'))
+
+    # scans.tsv and participants.tsv are written once, when the block ends
+    scans_dirs = set()
+    with tables.buffered():
+        # Rows as dicts, iterrows would turn missing values back into NaN
+        for i, d in df.to_dict('index').items():
         
-        # Ignore files that are already converted
-        if d['run_conversion'] == 'no' and overwrite == 'off':
-            print(f"{d['bids_name']} already converted")
-            continue
+            # Ignore files that are already converted
+            if d['run_conversion'] == 'no' and overwrite == 'off':
+                print(f"{d['bids_name']} already converted")
+                metrics.record_file('bidsify', 'skipped')
+                continue
         
-        raw_file = f"{d['raw_path']}/{d['raw_name']}"
-        if not file_contains(raw_file, headpos_patterns):
-            raw = mne.io.read_raw_fif(raw_file,
-                                    allow_maxshield=True,
-                                    verbose='error')
-
-            ch_types = set(raw.info.get_channel_types())
-
-            if 'mag' in ch_types:
-                datatype = 'meg'
-                extension = '.fif'
-                suffix = 'meg'
-            elif 'eeg' in ch_types:
-                datatype = 'eeg'
-                extension = None
-                suffix = None
+            raw_file = f"{d['raw_path']}/{d['raw_name']}"
+            usage = report.add(Usage('bidsify', f"{d['raw_name']} -> {d['bids_name']}"))
+            with (metrics.recorded('bidsify', usage), measure(usage),
+                  staging.staged(raw_file) as staged_file,
+                  limits.access(staged_file, path_BIDS)):
+                if not file_contains(raw_file, headpos_patterns):
+                    # Opened once per process, e.g. by maxfilter.py in natmeg.py
+                    raw = inventory.raw(raw_file)
+
+                    ch_types = set(raw.info.get_channel_types())
+
+                    if 'mag' in ch_types:
+                        datatype = 'meg'
+                        extension = '.fif'
+                        suffix = 'meg'
+                    elif 'eeg' in ch_types:
+                        datatype = 'eeg'
+                        extension = None
+                        suffix = None
             
-            subject = d['participant_to']
-            session = d['session_to']
-            task = d['task']
-            acquisition = d['acquisition']
-            processing = d['processing']
-            run = d['run']
-
-            # Create BIDS path
-            bids_path = BIDSPath(
-                subject=subject,
-                session=session,
-                task=task,
-                run=run,
-                datatype=datatype,
-                acquisition=acquisition,
-                processing=processing,
-                suffix=suffix,
-                extension=extension,
-                root=path_BIDS
-            )
-        # Write the BIDS file
-            try:
-                write_raw_bids(
-                    raw=raw,
-                    bids_path=bids_path,
-                    empty_room=None,
-                    events=None,
-                    overwrite=True,
-                    verbose='error'
-                )
-            except Exception as e:
-                print(f"Error writing BIDS file: {e}")
-                # If write_raw_bids fails, try to save the raw file directly
-                # Fall back on raw.save if write_raw_bids fails
-                fname = bids_path.copy().update(suffix=datatype, extension = '.fif').fpath
-                raw.save(fname, overwrite=True)
-
-            # Copy EEG to MEG
-            if datatype == 'eeg':
-                copy_eeg_to_meg(raw_file, bids_path)
-                
-            # Update the sidecar file
-            else:
-                update_sidecar(bids_path)
-
-            # Add channel parameters 
-            if acquisition == 'hedscan':
-                opm_tsv = f"{d['raw_path']}/{d['raw_name']}".replace('raw.fif', 'channels.tsv')
-                
-                bids_tsv = bids_path.copy().update(suffix='channels', extension='.tsv')
-                add_channel_parameters(bids_tsv, opm_tsv)
+                    subject = d['participant_to']
+                    session = d['session_to']
+                    task = d['task']
+                    acquisition = d['acquisition']
+                    processing = d['processing']
+                    run = d['run']
+
+                    # Create BIDS path
+                    bids_path = BIDSPath(
+                        subject=subject,
+                        session=session,
+                        task=task,
+                        run=run,
+                        datatype=datatype,
+                        acquisition=acquisition,
+                        processing=processing,
+                        suffix=suffix,
+                        extension=extension,
+                        root=path_BIDS
+                    )
+                # Write the BIDS file
+                    with span('write', bids_path.basename):
+                        try:
+                            copied = False
+                            if datatype == 'meg':
+                                # Copy the FIF files as they are, at disk speed
+                                try:
+                                    write_fif_copy(raw, bids_path)
+                                    copied = True
+                                except ValueError as e:
+                                    print(f'Block copy not possible, writing with MNE: {e}')
+                            if not copied:
+                                write_raw_bids(
+                                    raw=raw,
+                                    bids_path=bids_path,
+                                    empty_room=None,
+                                    events=None,
+                                    overwrite=True,
+                                    verbose='error'
+                                )
+                        except Exception as e:
+                            print(f"Error writing BIDS file: {e}")
+                            metrics.retries.inc(stage='write', reason='raw_save')
+                            # If write_raw_bids fails, try to save the raw file directly
+                            # Fall back on raw.save if write_raw_bids fails
+                            fname = bids_path.copy().update(suffix=datatype, extension = '.fif').fpath
+                            raw.save(fname, overwrite=True)
+
+                        # Copy EEG to MEG
+                        if datatype == 'eeg':
+                            copy_eeg_to_meg(staged_file, bids_path)
+
+                    with span('sidecar', bids_path.basename):
+                        # Update the sidecar file
+                        if datatype != 'eeg':
+                            update_sidecar(bids_path)
+
+                        # Add channel parameters 
+                        if acquisition == 'hedscan':
+                            opm_tsv = f"{d['raw_path']}/{d['raw_name']}".replace('raw.fif', 'channels.tsv')
+                    
+                            bids_tsv = bids_path.copy().update(suffix='channels', extension='.tsv')
+                            add_channel_parameters(bids_tsv, opm_tsv)
+
+                    # Data, sidecars and split files of the recording
+                    recording = f'{bids_path.copy().update(suffix=None, extension=None).basename}_*'
+                    tree.update(bids_path.directory, recording)
+                    tree.update(bids_path.directory, '*_coordsystem.json')
+                    written = glob(f'{bids_path.directory}/{recording}')
+                    if datatype == 'eeg':
+                        tree.update(bids_path.copy().update(datatype='meg').directory, recording)
+                        written += glob(f"{bids_path.copy().update(datatype='meg').directory}/{recording}")
+                    scans_dirs.add(dirname(bids_path.directory))
+
+                    # Read and written by MNE, block copies are throttled
+                    # while copying, see iolimits.py
+                    if copied:
+                        limits.charge(*[f for f in written if not f.endswith('.fif')])
+                    else:
+                        limits.charge(*map(str, raw.filenames), *written)
 
-        # If the file is a head position file, copy it to the BIDS directory
-        # and rename it to the BIDS format
-        else:
-            bids_path = f"{d['bids_path']}/{d['bids_name']}"
-
-            if 'headpos' in d['description']:
-                headpos = mne.chpi.read_head_pos(raw_file)
-                mne.chpi.write_head_pos(bids_path, headpos)
-            elif 'trans' in d['description']:
-                trans = mne.read_trans(raw_file)
-                mne.write_trans(bids_path, trans, overwrite=True)
-
-        # Log the conversion
-        log( 
-            f'{raw_file} -> {bids_path}',
-            level='info',
-            logfile='log.tsv',
-            logpath=path_BIDS
-        )
-        # Print the conversion
-        print(f'{raw_file} -> {bids_path}')
+                # If the file is a head position file, copy it to the BIDS directory
+                # and rename it to the BIDS format
+                else:
+                    bids_path = f"{d['bids_path']}/{d['bids_name']}"
+
+                    with span('write', d['bids_name']):
+                        # Files computed by maxfilter.py are linked from the cache as is
+                        if headpos_cache.link(raw_file, bids_path):
+                            pass
+                        elif 'headpos' in d['description']:
+                            headpos = mne.chpi.read_head_pos(raw_file)
+                            # Write to a new file, the old one may be hard linked to the cache
+                            mne.chpi.write_head_pos(f'{bids_path}.tmp', headpos)
+                            os.replace(f'{bids_path}.tmp', bids_path)
+                        elif 'trans' in d['description']:
+                            trans = mne.read_trans(raw_file)
+                            mne.write_trans(f'{bids_path}.tmp.fif', trans, overwrite=True, verbose='error')
+                            os.replace(f'{bids_path}.tmp.fif', bids_path)
+                    tree.record(bids_path)
+
+                # Log the conversion
+                log( 
+                    f'{raw_file} -> {bids_path}',
+                    level='info',
+                    logfile='log.tsv',
+                    logpath=path_BIDS
+                )
+                # Print the conversion
+                print(f'{raw_file} -> {bids_path}')
         
-        df.at[i, 'run_conversion'] = 'no'
+            df.at[i, 'run_conversion'] = 'no'
+
+    # The scans.tsv files as written at the end of the block
+    for directory in sorted(scans_dirs):
+        tree.update(directory, '*_scans.tsv')
     
     # Update the conversion table
-    df.to_csv(f'{path_BIDS}/conversion_logs/{df["time_stamp"].iloc[0]}_bids_conversion.tsv', sep='\t', index=False)
+    conversion_table.loc[df.index, 'run_conversion'] = df['run_conversion']
+    if save:
+        conversion_table.to_csv(conversion_file, sep='\t', index=False)
+
+    # Resources used by each converted file
+    report.write(f'{path_BIDS}/conversion_logs/{datetime.now().strftime("%Y%m%d")}_bids_resources.tsv')
+    report.summary()
+
+    # participants.tsv, dataset_description.json, ...
+    tree.update(path_BIDS)
+    tree.save()
+    return tree
+
+def bidsify_session(config_dict: dict,
+                    participant: str,
+                    session: str,
+                    conversion_file: str=None):
+    """
+    Convert one raw participant session to BIDS, see SessionConversion.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        participant (str, required): Raw participant folder, e.g. NatMEG_0001.
+        session (str, required): Raw session folder.
+        conversion_file (str): Conversion table, defaults to the latest.
+    """
+    conversion = SessionConversion(config_dict, conversion_file)
+    conversion.convert(participant, session)
+    conversion.save()
+
+class SessionConversion:
+    """
+    BIDS conversion of one session at a time, e.g. by the session jobs of
+    maxfilter.py, with one conversion table for all sessions.
+
+    The table is read by the first session. Each session adds its files
+    that are not in the table yet, e.g. MaxFilter outputs created after the
+    table, and checks and converts only its own rows. The table is written
+    back once by save(). Sessions must be converted one at a time.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        conversion_file (str): Conversion table, defaults to the latest.
+    """
+
+    def __init__(self, config_dict: dict, conversion_file: str=None):
+        self.config_dict = config_dict
+        self.conversion_file = conversion_file
+        self.table = None
+
+    def load(self):
+        if self.table is None:
+            if not self.conversion_file:
+                self.conversion_file = latest_conversion_file(self.config_dict)
+            self.table = load_conversion_table(self.config_dict, self.conversion_file)
+        return self.table
+
+    def convert(self, participant: str, session: str):
+        """
+        Convert one raw participant session to BIDS.
+
+        Args:
+            participant (str, required): Raw participant folder, e.g. NatMEG_0001.
+            session (str, required): Raw session folder.
+        """
+        import pandas as pd
+        conversion_table = self.load()
+        conversion_file = self.conversion_file
+
+        new_rows = generate_new_conversion_table(self.config_dict,
+                                                 participants=[participant],
+                                                 sessions=[session],
+                                                 save=False)
+        known = set(zip(conversion_table['raw_path'], conversion_table['raw_name']))
+        new_rows = new_rows[[(p, n) not in known for p, n
+                             in zip(new_rows['raw_path'], new_rows['raw_name'])]]
+        if len(new_rows) > 0:
+            print(f'Adding {len(new_rows)} new files of {participant}/{session} to {basename(conversion_file)}')
+            new_rows = new_rows.assign(time_stamp=conversion_table['time_stamp'].iloc[0])
+            conversion_table = pd.concat([conversion_table, new_rows], ignore_index=True)
+            # Flagged against the whole table as when it is generated, not
+            # against the largest count of the session
+            task_count, task_flag = count_tasks(conversion_table)
+            rows = ((conversion_table['participant_from'] == participant)
+                    & (conversion_table['session_from'] == session))
+            conversion_table.loc[rows, 'task_count'] = task_count[rows].astype(str)
+            conversion_table.loc[rows, 'task_flag'] = pd.Series(task_flag, index=conversion_table.index)[rows]
+            self.table = conversion_table
+
+        bidsify(self.config_dict, conversion_file, participants=[participant], sessions=[session],
+                conversion_table=conversion_table, save=False)
+
+    def save(self):
+        """Write the conversion table, if a session has read it."""
+        if self.table is not None:
+            self.table.to_csv(self.conversion_file, sep='\t', index=False)
+
+def conversion_delta(config_dict: dict,
+                     conversion_file: str=None,
+                     old_file: str='previous'):
+    """
+    Rows of a conversion table added or edited since an earlier table, set
+    to run_conversion=yes.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        conversion_file (str): Conversion table, defaults to the latest.
+        old_file (str): Earlier table, 'previous' for the dated table
+            before conversion_file.
+
+    Returns:
+        tuple: the raw files (raw_path, raw_name) of the changed rows and
+            the conversion file.
+    """
+    from conversiondiff import (apply_delta, delta_keys, diff_tables, previous_conversion_file,
+                                print_diff, read_table)
+    conversion_file = conversion_file or latest_conversion_file(config_dict)
+    if old_file == 'previous':
+        old_file = previous_conversion_file(config_dict, conversion_file)
+    if not old_file:
+        print(f'No conversion file before {basename(conversion_file)} to compare with')
+        sys.exit(1)
+    print(f'Converting the changes of {basename(conversion_file)} since {basename(old_file)}')
+    table = read_table(conversion_file)
+    diff = diff_tables(read_table(old_file), table)
+    print_diff(diff)
+    apply_delta(table, diff).to_csv(conversion_file, sep='\t', index=False)
+    return delta_keys(diff), conversion_file
 
 def args_parser():
     parser = argparse.ArgumentParser(description='''BIDSify
@@ -925,10 +1301,19 @@ def args_parser():
                                      
                                      ''',
                                      add_help=True,
-                                     usage='bidsify [-h] [-c CONFIG] [-e] [--conversion CONVERSION]',)
+                                     prog='bidsify')
     parser.add_argument('-c', '--config', type=str, help='Path to the configuration file')
     parser.add_argument('-e', '--edit', action='store_true', help='Launch the UI for configuration file')
     parser.add_argument('--conversion', type=str, help='Path to the conversion file')
+    parser.add_argument('--profile', action='store_true', help='Write a trace of the conversion stages and a cProfile of the run to conversion_logs')
+    parser.add_argument('--metrics-file', type=str, help='Write metrics in Prometheus text format to this file while running')
+    parser.add_argument('--metrics-port', type=int, help='Serve metrics in Prometheus text format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--scratch', type=str, help='Copy raw files to this local directory once and read them from there')
+    parser.add_argument('--scratch-size', type=float, default=100, help='Largest size of the scratch directory in GB (default 100)')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of raw files copied to scratch ahead of processing (default 2)')
+    parser.add_argument('--io-limits', type=str, help='JSON file with limits on concurrent access and MB/s per storage mount, see iolimits.py')
+    parser.add_argument('--delta', type=str, nargs='?', const='previous', help='Only convert the rows added or edited since an earlier conversion file, by default the one before the conversion file, see conversiondiff.py')
+    parser.add_argument('--tree-depth', type=int, default=2, help='Directory levels in the summary of the BIDS tree: 0 totals, 1 subjects, 2 sessions (default), 3 datatypes')
     args = parser.parse_args()
 
     return args
@@ -960,11 +1345,33 @@ def main():
 
         create_dataset_description(config_dict['BIDS'], args.edit)
         
-        bidsify(config_dict, args.conversion)
-        
-        update_sidecars(config_dict['BIDS'])
+        if args.metrics_file or args.metrics_port is not None:
+            metrics.enable(args.metrics_file, args.metrics_port)
+        if args.profile:
+            profiler.enable()
+        if args.io_limits:
+            limits.load(args.io_limits, {key: config_dict[key] for key in ['squidMEG', 'opmMEG', 'BIDS']})
+        if args.scratch:
+            staging.enable(args.scratch, args.scratch_size, args.prefetch,
+                           [config_dict['squidMEG'], config_dict['opmMEG']])
+        files = None
+        conversion_file = args.conversion
+        if args.delta:
+            files, conversion_file = conversion_delta(config_dict, conversion_file, args.delta)
+        try:
+            tree = bidsify(config_dict, conversion_file, files=files)
+            
+            update_sidecars(config_dict['BIDS'], tree)
+        except DeviantsError as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            staging.close()
+            if args.profile:
+                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+                profiler.write(f"{config_dict['BIDS']}/conversion_logs/{ts}_bids_profile")
 
-        print_dir_tree(config_dict['BIDS'])
+        tree.summary(args.tree_depth)
     else:
         print('No configuration file selected')
         sys.exit(1)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Buffered scans.tsv and participants.tsv tables of the BIDS conversion.
+
+write_raw_bids reads and rewrites the scans.tsv of the session and the
+participants.tsv of the dataset for every recording. While a conversion
+runs within tables.buffered() these tables are kept in memory: the
+recordings add their rows to the buffered tables and each table is written
+once when the block ends, atomically through a temporary file. A table
+that does not exist yet is written when it is created, as MNE-BIDS checks
+for the file before reading it.
+
+Other TSV files (channels, events) are written by MNE-BIDS as before.
+
+The tables of write_raw_bids are buffered by replacing _from_tsv and
+_write_tsv of mne_bids.write, which are private. The versions of MNE-BIDS
+this was tested with are listed in mne_bids_versions, buffered() raises for
+other versions or if the functions changed. One block runs at a time, and
+only calls from the thread that runs it are buffered; other threads read
+and write the files as before.
+"""
+
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+
+# Minor versions of MNE-BIDS whose mne_bids.write functions are replaced
+mne_bids_versions = ['0.20']
+_replaced = {
+    '_from_tsv': ['fname', 'dtypes'],
+    '_write_tsv': ['fname', 'dictionary', 'overwrite', 'lock', 'compress', 'verbose'],
+}
+
+
+def _check_mne_bids(mne_bids_write):
+    """
+    Raises:
+        RuntimeError: If the functions of mne_bids.write that are replaced
+            are missing or changed, or the version was not tested.
+    """
+    import mne_bids
+    version = '.'.join(mne_bids.__version__.split('.')[:2])
+    if version not in mne_bids_versions:
+        raise RuntimeError(f'Buffered BIDS tables are not tested with MNE-BIDS {mne_bids.__version__}, '
+                           f'only {", ".join(mne_bids_versions)}, see bidstables.py')
+    for name, parameters in _replaced.items():
+        function = getattr(mne_bids_write, name, None)
+        if function is None or list(inspect.signature(function).parameters) != parameters:
+            raise RuntimeError(f'mne_bids.write.{name} is missing or changed in MNE-BIDS '
+                               f'{mne_bids.__version__}, see bidstables.py')
+
+
+def _buffered_name(file_name):
+    name = os.path.basename(str(file_name))
+    return name == 'participants.tsv' or name.endswith('_scans.tsv')
+
+
+class TableBuffer:
+    """
+    Tables kept in memory during a conversion, a single instance (tables)
+    is shared by all modules and threads. Outside of buffered() tables are
+    read from and written to disk.
+    """
+    def __init__(self):
+        self._tables = {}
+        self._dirty = set()
+        self._depth = 0
+        # Thread running the buffered block, None outside of it
+        self._owner = None
+        self._lock = threading.RLock()
+        # Held for the whole block, one block at a time
+        self._block = threading.RLock()
+        self._originals = None
+        self.updates = 0
+        self.written = 0
+
+    def read(self, file_name):
+        """
+        Table as an OrderedDict of columns, as mne_bids _from_tsv.
+        """
+        from mne_bids.tsv_handler import _from_tsv
+        key = os.path.abspath(str(file_name))
+        with self._lock:
+            if key in self._tables:
+                return deepcopy(self._tables[key])
+        return _from_tsv(file_name)
+
+    def write(self, file_name, data: OrderedDict):
+        """
+        Replace a table, kept in memory until the end of buffered() if it
+        is a scans.tsv or participants.tsv file that already exists.
+        """
+        key = os.path.abspath(str(file_name))
+        with self._lock:
+            if self._owner == threading.get_ident() and _buffered_name(key):
+                self._tables[key] = deepcopy(data)
+                if os.path.exists(key):
+                    self._dirty.add(key)
+                    self.updates += 1
+                    return
+        self._write(key, data)
+
+    def _write(self, file_name, data):
+        from mne_bids.utils import _write_tsv
+        tmp_file = f'{file_name}.tmp{os.getpid()}.tsv'
+        _write_tsv(tmp_file, data, overwrite=True, lock=False, verbose='error')
+        os.replace(tmp_file, file_name)
+        self.written += 1
+
+    def flush(self):
+        """Write the changed tables."""
+        with self._lock:
+            for key in sorted(self._dirty):
+                self._write(key, self._tables[key])
+            self._dirty.clear()
+
+    def _from_tsv(self, fname, dtypes=None, _original=None):
+        if self._owner == threading.get_ident() and dtypes is None and _buffered_name(fname):
+            return self.read(fname)
+        return _original(fname, dtypes)
+
+    def _write_tsv(self, fname, dictionary, *, overwrite=False, lock=True, compress=False, verbose=None,
+                   _original=None):
+        if self._owner == threading.get_ident() and _buffered_name(fname) and overwrite and not compress:
+            self.write(fname, dictionary)
+            return
+        _original(fname, dictionary, overwrite=overwrite, lock=lock,
+                  compress=compress, verbose=verbose)
+
+    @contextmanager
+    def buffered(self):
+        """
+        Keep the scans.tsv and participants.tsv tables written by this
+        package and by write_raw_bids in memory while the block runs. Blocks
+        of other threads wait until it ends.
+
+        Raises:
+            RuntimeError: If the installed MNE-BIDS is not supported, see
+                mne_bids_versions.
+        """
+        from functools import partial
+        import mne_bids.write as mne_bids_write
+        with self._block:
+            with self._lock:
+                if self._depth == 0:
+                    _check_mne_bids(mne_bids_write)
+                    self._originals = {name: getattr(mne_bids_write, name) for name in _replaced}
+                    for name, function in self._originals.items():
+                        setattr(mne_bids_write, name, partial(getattr(self, name), _original=function))
+                    self._owner = threading.get_ident()
+                self._depth += 1
+            try:
+                yield self
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        try:
+                            self.flush()
+                        finally:
+                            for name, function in self._originals.items():
+                                setattr(mne_bids_write, name, function)
+                            self._originals = None
+                            self._owner = None
+                            self._tables.clear()
+                            if self.updates:
+                                print(f'Tables: {self.updates} updates of scans.tsv and participants.tsv, '
+                                      f'{self.written} files written')
+                            self.updates = self.written = 0
+
+
+tables = TableBuffer()
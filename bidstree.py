@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Summary of the BIDS tree from an index of its files, printed at the end of
+a conversion instead of the full directory tree.
+
+The index (conversion_logs/bids_index.json) holds the size and
+modification time of each file. bidsify.py updates the entries of the
+files it writes, so the summary costs a stat per written file and the tree
+is only walked once, when the index does not exist yet. Files changed
+outside of the conversion are picked up when their recording is converted
+again, or when the index is deleted and rebuilt.
+"""
+
+import os
+from collections import defaultdict
+from fnmatch import fnmatch
+
+from utils import read_manifest, write_manifest
+from inventory import inventory
+
+# Changed files listed by name in the summary
+default_n_changed = 20
+
+
+def format_size(n_bytes: float):
+    """Bytes as a readable size, e.g. 1.2 GB."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n_bytes < 1024:
+            return f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1024
+    return f'{n_bytes:.1f} TB'
+
+
+class BidsIndex:
+    """
+    Files of a BIDS tree and the changes made to it in this run.
+
+    Args:
+        root (str, required): BIDS root directory.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.file = os.path.join(self.root, 'conversion_logs', 'bids_index.json')
+        self.files = read_manifest(self.file)
+        # Relative path: 'new', 'updated' or 'removed'
+        self.changes = {}
+        if not os.path.exists(self.file) and os.path.isdir(self.root):
+            self.rebuild()
+        # Names of the indexed files per directory
+        self._dirs = defaultdict(set)
+        for key in self.files:
+            directory, name = os.path.split(key)
+            self._dirs[directory].add(name)
+
+    def _relative(self, file_name: str):
+        return os.path.relpath(os.path.abspath(str(file_name)), self.root)
+
+    def rebuild(self):
+        """Index all files of the tree, without counting them as changes."""
+        print(f'Indexing the files in {self.root}')
+        self.files = {}
+        for path, dirs, names in os.walk(self.root):
+            dirs[:] = [d for d in dirs if d != 'conversion_logs' and not d.startswith('.')]
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                self.files[self._relative(os.path.join(path, name))] = [stat.st_size, stat.st_mtime_ns]
+
+    def update(self, directory: str, pattern: str='*'):
+        """
+        Update the entries of the files in a directory matching a pattern.
+
+        Args:
+            directory (str, required): Directory of the written files.
+            pattern (str): Names of the written files, e.g. 'sub-01_ses-01_task-rest_*'.
+        """
+        directory = str(directory)
+        relative = self._relative(directory)
+        relative = '' if relative == '.' else relative
+        present = set()
+        for name in inventory.glob(pattern, root_dir=directory):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if not os.path.isfile(os.path.join(directory, name)):
+                continue
+            key = os.path.join(relative, name)
+            present.add(name)
+            entry = [stat.st_size, stat.st_mtime_ns]
+            old = self.files.get(key)
+            if old != entry:
+                new = self.changes.get(key) == 'new' or (not old and key not in self.changes)
+                self.changes[key] = 'new' if new else 'updated'
+                self.files[key] = entry
+                self._dirs[relative].add(name)
+        # Files replaced by others, e.g. split files by a single file
+        names = self._dirs[relative]
+        for name in [n for n in names if n not in present and fnmatch(n, pattern)]:
+            key = os.path.join(relative, name)
+            del self.files[key]
+            names.discard(name)
+            self.changes[key] = 'removed'
+
+    def record(self, file_name: str):
+        """Update the entry of one written file."""
+        self.update(os.path.dirname(os.path.abspath(str(file_name))), os.path.basename(str(file_name)))
+
+    def save(self):
+        write_manifest(self.file, self.files)
+
+    def summary(self, depth: int=2, n_changed: int=default_n_changed):
+        """
+        Print the number of files, bytes and changes per directory.
+
+        Args:
+            depth (int): Directory levels shown, 0 for the totals only,
+                1 per subject, 2 per session, 3 per datatype.
+            n_changed (int): Changed files listed by name.
+        """
+        totals = {}
+        for key, (size, _) in self.files.items():
+            parts = key.split(os.sep)[:-1]
+            for level in range(min(depth, len(parts)) + 1):
+                node = totals.setdefault(tuple(parts[:level]), [0, 0, 0])
+                node[0] += 1
+                node[1] += size
+        for key in self.changes:
+            parts = key.split(os.sep)[:-1]
+            for level in range(min(depth, len(parts)) + 1):
+                totals.setdefault(tuple(parts[:level]), [0, 0, 0])[2] += 1
+
+        n_files, n_bytes, n_changes = totals.get((), [0, 0, 0])
+        n_subjects = len({key.split(os.sep)[0] for key in self.files if key.startswith('sub-') and os.sep in key})
+        print(f'{self.root}: {n_subjects} subjects, {n_files} files, {format_size(n_bytes)}, '
+              f'{n_changes} changed in this run')
+        for node in sorted(totals):
+            if not node:
+                continue
+            n_files, n_bytes, n_changes = totals[node]
+            name = '  ' * (len(node) - 1) + node[-1]
+            changed = f', {n_changes} changed' if n_changes else ''
+            print(f'  {name:<40} {n_files:>7} files {format_size(n_bytes):>10}{changed}')
+
+        if self.changes:
+            print('Changed in this run:')
+            for key in sorted(self.changes)[:n_changed]:
+                size = self.files[key][0] if key in self.files else 0
+                print(f'  {self.changes[key]:<8} {key} ({format_size(size)})')
+            if len(self.changes) > n_changed:
+                print(f'  ... and {len(self.changes) - n_changed} more')
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Differences between conversion tables, keyed on raw_path and raw_name.
+
+Compares two conversion tables, by default the latest and the one before
+it, or the latest table with the files in the raw directories. Rows are
+matched on their raw file in one pass over each table and reported as
+added, removed or edited, with the columns that changed. Edits of
+time_stamp, run_conversion, task_count and task_flag are not changes of
+the BIDS output and are ignored.
+
+With --apply the changed rows are set to run_conversion=yes (and in raw
+mode the new raw files are added), so that the next run of bidsify.py
+converts only them, e.g. the files of a task renamed by hand:
+
+    python conversiondiff.py --config=bids_config.json --apply
+    python conversiondiff.py --config=bids_config.json --raw --apply
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from glob import glob
+from os.path import basename
+
+key_columns = ['raw_path', 'raw_name']
+# Bookkeeping columns, not part of the BIDS output of a row
+ignored_columns = ['time_stamp', 'run_conversion', 'task_count', 'task_flag']
+diff_columns = ['raw_path', 'raw_name', 'change', 'columns', 'details']
+
+
+def read_table(file_name: str):
+    """Conversion table with all values as strings, missing values as ''."""
+    import pandas as pd
+    return pd.read_csv(file_name, sep='\t', dtype=str, keep_default_na=False)
+
+
+def _records(table):
+    """Rows of a table as lists of strings by raw file, and their columns."""
+    table = table.astype(object).where(table.notnull(), '').astype(str)
+    columns = list(table.columns)
+    path, name = columns.index('raw_path'), columns.index('raw_name')
+    # Lists from numpy, to_dict boxes every value and is much slower
+    records = {(row[path], row[name]): row for row in table.to_numpy(dtype=object).tolist()}
+    if len(records) < len(table):
+        print(f'{len(table) - len(records)} raw files are listed more than once, using their last rows')
+    return records, columns
+
+
+def diff_tables(old, new, columns: list=None):
+    """
+    Rows added, removed and edited from one conversion table to another.
+
+    Args:
+        old (pd.DataFrame, required): Earlier table.
+        new (pd.DataFrame, required): Later table.
+        columns (list): Columns compared for edits, defaults to all but the
+            raw file and the bookkeeping columns. [] reports only added
+            and removed rows.
+
+    Returns:
+        pd.DataFrame: raw_path, raw_name, change ('added', 'removed' or
+            'edited'), the edited columns and their old and new values.
+    """
+    import pandas as pd
+    old_rows, old_columns = _records(old)
+    new_rows, new_columns = _records(new)
+    if columns is None:
+        columns = [c for c in new_columns if c not in key_columns + ignored_columns]
+    # Positions of the compared columns in both tables, columns missing in
+    # a table compare as ''
+    positions = [(c, old_columns.index(c) if c in old_columns else None,
+                  new_columns.index(c) if c in new_columns else None) for c in columns]
+
+    def value(row, i):
+        return '' if i is None else row[i]
+
+    changes = []
+    for key, row in new_rows.items():
+        old_row = old_rows.get(key)
+        if old_row is None:
+            changes.append(key + ('added', '', ''))
+            continue
+        edited = [(c, i, j) for c, i, j in positions if value(old_row, i) != value(row, j)]
+        if edited:
+            details = '; '.join(f'{c}: {value(old_row, i)} -> {value(row, j)}' for c, i, j in edited)
+            changes.append(key + ('edited', ','.join(c for c, _, _ in edited), details))
+    for key in old_rows.keys() - new_rows.keys():
+        changes.append(key + ('removed', '', ''))
+    return pd.DataFrame(changes, columns=diff_columns)
+
+
+def diff_raw_tree(config_dict: dict, table):
+    """
+    Raw files added and removed since a conversion table was made.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        table (pd.DataFrame, required): Conversion table.
+
+    Returns:
+        tuple: the differences as returned by diff_tables and the table
+            generated from the raw directories.
+    """
+    from bidsify import generate_new_conversion_table
+    current = generate_new_conversion_table(config_dict, save=False)
+    # The mapping of rows that are in both is kept as edited by hand
+    return diff_tables(table, current, columns=[]), current
+
+
+def apply_delta(table, diff, current=None):
+    """
+    Mark the added and edited rows of a diff for conversion.
+
+    Args:
+        table (pd.DataFrame, required): Conversion table to update.
+        diff (pd.DataFrame, required): Differences to the table.
+        current (pd.DataFrame): Table the added rows are taken from, when
+            they are not in the table yet (raw mode).
+
+    Returns:
+        pd.DataFrame: the updated table.
+    """
+    import pandas as pd
+    changed = set(zip(diff.loc[diff['change'] != 'removed', 'raw_path'],
+                      diff.loc[diff['change'] != 'removed', 'raw_name']))
+    if current is not None:
+        added = set(zip(diff.loc[diff['change'] == 'added', 'raw_path'],
+                        diff.loc[diff['change'] == 'added', 'raw_name']))
+        new_rows = current[[(p, n) in added for p, n in zip(current['raw_path'], current['raw_name'])]]
+        if len(new_rows) > 0:
+            new_rows = new_rows.assign(time_stamp=table['time_stamp'].iloc[0])
+            table = pd.concat([table, new_rows], ignore_index=True)
+    marked = [(p, n) in changed for p, n in zip(table['raw_path'], table['raw_name'])]
+    table.loc[marked, 'run_conversion'] = 'yes'
+    return table
+
+
+def delta_keys(diff):
+    """Raw files (raw_path, raw_name) of the added and edited rows."""
+    rows = diff[diff['change'] != 'removed']
+    return set(zip(rows['raw_path'], rows['raw_name']))
+
+
+def previous_conversion_file(config_dict: dict, conversion_file: str):
+    """The dated conversion table before conversion_file, None if none."""
+    files = sorted(glob(os.path.join(config_dict['BIDS'], 'conversion_logs', '*_bids_conversion.tsv')))
+    earlier = [f for f in files if basename(f) < basename(conversion_file)]
+    return earlier[-1] if earlier else None
+
+
+def print_diff(diff, n: int=20):
+    """Print the number of changes and the first n changed rows."""
+    counts = diff['change'].value_counts()
+    print(f"{counts.get('added', 0)} added, {counts.get('removed', 0)} removed, "
+          f"{counts.get('edited', 0)} edited")
+    for row in diff.head(n).to_dict('records'):
+        details = f" ({row['details']})" if row['details'] else ''
+        print(f"  {row['change']:<8} {row['raw_path']}/{row['raw_name']}{details}")
+    if len(diff) > n:
+        print(f'  ... and {len(diff) - n} more')
+
+
+def write_diff(config_dict: dict, diff):
+    """Write the differences to conversion_logs, returns the file name."""
+    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+    diff_file = f"{config_dict['BIDS']}/conversion_logs/{ts}_bids_diff.tsv"
+    os.makedirs(os.path.dirname(diff_file), exist_ok=True)
+    diff.to_csv(diff_file, sep='\t', index=False)
+    return diff_file
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='''Conversion table diff
+
+                                     Compares two conversion tables, or a conversion table with the raw directories.
+
+                                     ''',
+                                     add_help=True)
+    parser.add_argument('-c', '--config', type=str, required=True, help='Path to the BIDS configuration file')
+    parser.add_argument('--conversion', type=str, help='Path to the conversion file, defaults to the latest')
+    parser.add_argument('--old', type=str, help='Conversion file to compare with, defaults to the one before --conversion')
+    parser.add_argument('--raw', action='store_true', help='Compare with the files in the raw directories instead')
+    parser.add_argument('--apply', action='store_true', help='Set the added and edited rows to run_conversion=yes in the conversion file')
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    with open(args.config, 'r') as f:
+        config_dict = json.load(f)
+
+    from bidsify import latest_conversion_file
+    conversion_file = args.conversion or latest_conversion_file(config_dict)
+    table = read_table(conversion_file)
+
+    current = None
+    if args.raw:
+        print(f'Comparing {basename(conversion_file)} with the raw directories')
+        diff, current = diff_raw_tree(config_dict, table)
+    else:
+        old_file = args.old or previous_conversion_file(config_dict, conversion_file)
+        if not old_file:
+            print(f'No conversion file before {basename(conversion_file)}, use --old or --raw')
+            sys.exit(1)
+        print(f'Comparing {basename(conversion_file)} with {basename(old_file)}')
+        diff = diff_tables(read_table(old_file), table)
+
+    print_diff(diff)
+    if not diff.empty:
+        print(f'Differences written to {write_diff(config_dict, diff)}')
+    if args.apply and not diff.empty:
+        table = apply_delta(table, diff, current)
+        table.to_csv(conversion_file, sep='\t', index=False)
+        print(f'{len(delta_keys(diff))} rows set to run_conversion=yes in {basename(conversion_file)}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the MaxFilter binary, to test scheduling, skipping and failure
+handling of maxfilter.py on machines without MaxFilter.
+
+Accepts the command line built by maxfilter.py, replays the console output
+of a MaxFilter -v log and writes a copy of the input with a MaxFilter record
+in its processing history, so update_sidecars can read it. The log is
+tests/data/maxfilter_sample.log, which is a stand-in until it is replaced
+with a captured log. Runtime, memory use and failures are simulated and set
+with options or environment variables, options win:
+
+    FAKE_MAXFILTER_RUNTIME     Seconds per file (1)
+    FAKE_MAXFILTER_JITTER      Relative variation of the runtime (0.2)
+    FAKE_MAXFILTER_MEMORY_MB   Memory held while running (0)
+    FAKE_MAXFILTER_FAIL_RATE   Probability that a file fails (0)
+    FAKE_MAXFILTER_FAIL_MATCH  Files containing this text always fail
+    FAKE_MAXFILTER_SEED        Seed, the outcome of a file is repeatable (0)
+    FAKE_MAXFILTER_LOG         MaxFilter log to replay (the sample log)
+
+Set maxfilter_version in the MaxFilter config to the path of this file.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sample_log = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'tests', 'data', 'maxfilter_sample.log')
+
+
+def env(name: str, default, cast=float):
+    value = os.environ.get(f'FAKE_MAXFILTER_{name}')
+    return default if value in [None, ''] else cast(value)
+
+
+def args_parser(argv=None):
+    parser = argparse.ArgumentParser(description='''Fake MaxFilter
+
+                                     Simulates MaxFilter runs for testing.
+
+                                     ''',
+                                     add_help=True,
+                                     allow_abbrev=False)
+    # MaxFilter options, as written by maxfilter.py
+    parser.add_argument('-f', required=True, help='Input file')
+    parser.add_argument('-o', required=True, help='Output file')
+    parser.add_argument('-cal', help='Fine calibration file')
+    parser.add_argument('-ctc', help='Cross-talk file')
+    parser.add_argument('-trans', help='Transform to this head position')
+    parser.add_argument('-st', nargs='?', type=float, const=10., help='tSSS buffer length')
+    parser.add_argument('-corr', type=float, default=0.98, help='tSSS correlation limit')
+    parser.add_argument('-movecomp', nargs='?', const='on', help='Movement compensation')
+    parser.add_argument('-autobad', default='off', help='Automatic bad channel detection')
+    parser.add_argument('-badlimit', type=float, default=7, help='Bad channel limit')
+    parser.add_argument('-bad', nargs='*', default=[], help='Static bad channels, may be empty')
+    parser.add_argument('-linefreq', type=float, help='Line frequency')
+    parser.add_argument('-ds', type=int, help='Downsampling factor, ignored')
+    parser.add_argument('-force', action='store_true', help='Overwrite the output')
+    parser.add_argument('-v', action='store_true', help='Verbose')
+
+    # Simulation
+    parser.add_argument('--runtime', type=float, default=env('RUNTIME', 1.),
+                        help='Seconds per file')
+    parser.add_argument('--jitter', type=float, default=env('JITTER', .2),
+                        help='Relative variation of the runtime')
+    parser.add_argument('--memory', type=float, default=env('MEMORY_MB', 0.),
+                        help='MB of memory held while running')
+    parser.add_argument('--fail-rate', type=float, default=env('FAIL_RATE', 0.),
+                        help='Probability that a file fails')
+    parser.add_argument('--fail-match', default=env('FAIL_MATCH', '', str),
+                        help='Files containing this text always fail')
+    parser.add_argument('--seed', type=int, default=env('SEED', 0, int),
+                        help='Seed of the simulation')
+    parser.add_argument('--log', default=env('LOG', sample_log, str),
+                        help='MaxFilter log to replay')
+    args, unknown = parser.parse_known_args(argv)
+    if unknown:
+        print(f'Ignoring options: {" ".join(unknown)}')
+    return args
+
+
+def read_log(log_file: str):
+    """
+    Read a MaxFilter log to replay.
+
+    Args:
+        log_file (str, required): Console output of MaxFilter -v, lines
+            starting with '#' are comments.
+
+    Returns:
+        list: output lines of the log.
+    """
+    with open(log_file) as f:
+        return [line.rstrip('\n') for line in f if not line.startswith('#')]
+
+
+def proc_record(raw, args):
+    """
+    MaxFilter record of the processing history, with the fields MaxFilter
+    writes and update_sidecars reads.
+    """
+    import numpy as np
+    import mne
+
+    now = time.time()
+    n_meg = len(mne.pick_types(raw.info, meg=True, exclude=[]))
+    # 80 internal and 15 external moments, as with the default orders 8 and 3
+    components = np.ones(95, dtype='int32')
+    sss_info = {
+        'job': 0,
+        'frame': 4,
+        'origin': np.array([0., 0., 0.04], dtype='float32'),
+        'in_order': 8,
+        'out_order': 3,
+        'nchan': n_meg,
+        'components': components,
+        'nfree': int(components[:80].sum()),
+        'hpi_g_limit': 0.98,
+        'hpi_dist_limit': 0.005
+    }
+    max_st = {}
+    if args.st is not None:
+        max_st = {'job': 10, 'subspcorr': args.corr, 'buflen': args.st}
+    return {
+        'block_id': {'version': 65540,
+                     'machid': np.zeros(2, dtype='int32'),
+                     'secs': int(now),
+                     'usecs': int(now % 1 * 1e6)},
+        'date': (int(now), 0),
+        'experimenter': '',
+        'creator': 'fake_maxfilter',
+        'max_info': {'sss_info': sss_info, 'max_st': max_st,
+                     'sss_ctc': {}, 'sss_cal': {}}
+    }
+
+
+def main(argv=None):
+    args = args_parser(argv)
+    rng = random.Random(f'{args.seed}:{os.path.abspath(args.f)}')
+
+    if not os.path.exists(args.f):
+        print(f'Error: cannot open {args.f}', file=sys.stderr)
+        return 2
+    if os.path.exists(args.o) and not args.force:
+        print(f'Error: output file {args.o} exists, use -force to overwrite', file=sys.stderr)
+        return 2
+
+    import mne
+    raw = mne.io.read_raw_fif(args.f, allow_maxshield=True, verbose='error')
+    meg_channels = [raw.ch_names[i] for i in mne.pick_types(raw.info, meg=True, exclude=[])]
+    lines = read_log(args.log)
+
+    # Held until the end of the run
+    ballast = b'\x01' * int(args.memory * 1024**2)
+
+    runtime = max(args.runtime * (1 + rng.uniform(-args.jitter, args.jitter)), 0.)
+    fails = (args.fail_match and args.fail_match in args.f) or rng.random() < args.fail_rate
+    fail_at = rng.uniform(0.1, 0.9) if fails else None
+
+    # The log is replayed as is, with the runtime spread over its lines
+    for i, line in enumerate(lines):
+        if fail_at is not None and i / len(lines) >= fail_at:
+            print(f'Error: simulated failure after line {i} of the log', file=sys.stderr)
+            return 1
+        time.sleep(runtime / len(lines))
+        print(line, flush=True)
+    if fail_at is not None:
+        print('Error: simulated failure while writing', file=sys.stderr)
+        return 1
+
+    with raw.info._unlock():
+        raw.info['maxshield'] = False
+        raw.info['proc_history'].insert(0, proc_record(raw, args))
+    raw.info['bads'] = [ch for ch in raw.info['bads'] if ch not in meg_channels]
+    raw.save(args.o, overwrite=args.force, verbose='error')
+    del ballast
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Block-level copy of raw FIF recordings, used by bidsify to write TRIUX data
+to BIDS without decoding and encoding the data buffers through MNE.
+
+A FIF file is a sequence of tags (16 byte header: kind, type, size, next,
+followed by the data). The tags are copied as byte ranges with
+os.copy_file_range, which copies inside the kernel (or reflinks where the
+file system allows it). Only the tags that must change are rewritten:
+
+    FIFF_REF_FILE_NAME  Names of the previous and next split file
+    FIFF_DIR_POINTER    Position of the tag directory
+    FIFF_DIR            Positions of all tags
+
+Files that are not written sequentially are not supported and raise
+ValueError, the caller falls back on MNE.
+"""
+
+import os
+import struct
+from typing import NamedTuple
+
+from iolimits import limits, throttle_chunk
+
+# Tag kinds, as in mne.io.constants.FIFF
+FIFF_DIR_POINTER = 101
+FIFF_DIR = 102
+FIFF_BLOCK_END = 105
+FIFF_REF_ROLE = 115
+FIFF_REF_FILE_NAME = 118
+FIFFV_ROLE_PREV_FILE = 1
+FIFFV_ROLE_NEXT_FILE = 2
+FIFFV_NEXT_SEQ = 0
+FIFFV_NEXT_NONE = -1
+
+header_format = '>iiii'
+header_size = 16
+# Largest range copied by one system call
+copy_chunk = 1024**3
+
+
+class Tag(NamedTuple):
+    kind: int
+    type: int
+    size: int
+    next: int
+    pos: int
+
+
+def read_tags(file_name: str):
+    """
+    Headers of all tags of a sequentially written FIF file.
+
+    Returns:
+        list: Tag per tag in file order.
+    """
+    tags = []
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        pos = 0
+        while pos + header_size <= file_size:
+            f.seek(pos)
+            kind, type_, size, next_ = struct.unpack(header_format, f.read(header_size))
+            if next_ not in [FIFFV_NEXT_SEQ, FIFFV_NEXT_NONE] or size < 0:
+                raise ValueError(f'{file_name} is not a sequential FIF file')
+            tags.append(Tag(kind, type_, size, next_, pos))
+            if next_ == FIFFV_NEXT_NONE:
+                break
+            pos += header_size + size
+    return tags
+
+
+def _read_data(f, tag: Tag):
+    f.seek(tag.pos + header_size)
+    return f.read(tag.size)
+
+
+def _copy_range(src: int, dst: int, offset: int, count: int, throttle=None):
+    """
+    Copy count bytes of src from offset to the current position of dst,
+    in steps of throttle_chunk passed to throttle if it is set.
+    """
+    chunk = copy_chunk if throttle is None else throttle_chunk
+    while count > 0:
+        if throttle is not None:
+            throttle(min(count, chunk))
+        try:
+            n = os.copy_file_range(src, dst, min(count, chunk), offset)
+        except (AttributeError, OSError):
+            # Other file systems or kernels
+            n = os.sendfile(dst, src, offset, min(count, chunk))
+        if n == 0:
+            raise OSError('Unexpected end of file while copying')
+        offset += n
+        count -= n
+
+
+def copy_fif(src: str, dst: str, prev_name: str=None, next_name: str=None):
+    """
+    Copy a FIF file, changing the names of the previous and next split files.
+
+    Args:
+        src (str, required): Source file.
+        dst (str, required): Destination file, overwritten.
+        prev_name (str): File name of the previous split file.
+        next_name (str): File name of the next split file.
+
+    Returns:
+        int: number of bytes written.
+    """
+    tags = read_tags(src)
+    names = {FIFFV_ROLE_PREV_FILE: prev_name, FIFFV_ROLE_NEXT_FILE: next_name}
+
+    with open(src, 'rb') as f:
+        # New data of the rewritten tags
+        new_data = {}
+        role = None
+        for i, tag in enumerate(tags):
+            if tag.kind == FIFF_REF_ROLE:
+                role = struct.unpack('>i', _read_data(f, tag))[0]
+            elif tag.kind == FIFF_BLOCK_END:
+                role = None
+            elif tag.kind == FIFF_REF_FILE_NAME and names.get(role):
+                new_data[i] = names[role].encode()
+
+        # Positions and sizes in the copy
+        positions = {}
+        sizes = {}
+        shift = 0
+        for i, tag in enumerate(tags):
+            positions[tag.pos] = tag.pos + shift
+            if i in new_data:
+                sizes[tag.pos] = len(new_data[i])
+                shift += len(new_data[i]) - tag.size
+
+        if shift:
+            for i, tag in enumerate(tags):
+                if tag.kind == FIFF_DIR_POINTER:
+                    pos = struct.unpack('>i', _read_data(f, tag))[0]
+                    new_data[i] = struct.pack('>i', positions.get(pos, pos))
+                elif tag.kind == FIFF_DIR:
+                    entries = list(struct.iter_unpack('>iiii', _read_data(f, tag)))
+                    new_data[i] = b''.join(
+                        struct.pack('>iiii', kind, type_, sizes.get(pos, size), positions.get(pos, pos))
+                        for kind, type_, size, pos in entries)
+
+    src_size = os.path.getsize(src)
+    # Bandwidth of the mounts, see iolimits.py
+    throttle = limits.throttler(src, dst)
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        src_fd, dst_fd = fin.fileno(), fout.fileno()
+        start = 0
+        for i, tag in enumerate(tags):
+            if i not in new_data:
+                continue
+            _copy_range(src_fd, dst_fd, start, tag.pos - start, throttle)
+            data = new_data[i]
+            os.write(dst_fd, struct.pack(header_format, tag.kind, tag.type, len(data), tag.next) + data)
+            start = tag.pos + header_size + tag.size
+        _copy_range(src_fd, dst_fd, start, src_size - start, throttle)
+        return os.fstat(dst_fd).st_size
+
+
+def copy_split_fif(src_files: list, dst_files: list):
+    """
+    Copy the files of a split recording, linking the copies to each other
+    by their new names.
+
+    Args:
+        src_files (list, required): Source files in split order.
+        dst_files (list, required): Destination files in split order.
+
+    Returns:
+        int: number of bytes written.
+    """
+    if len(src_files) != len(dst_files):
+        raise ValueError('Number of source and destination files differ')
+    names = [os.path.basename(str(dst)) for dst in dst_files]
+    written = 0
+    for i, (src, dst) in enumerate(zip(src_files, dst_files)):
+        written += copy_fif(src, dst,
+                            prev_name=names[i - 1] if i > 0 else None,
+                            next_name=names[i + 1] if i + 1 < len(names) else None)
+    return written
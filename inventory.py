@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Inventory of the raw and BIDS trees shared by maxfilter.py and bidsify.py:
+directory listings, parsed file names and FIF headers, each read once per
+process.
+
+Listings are reused while the modification time of the directory is
+unchanged and headers while the size and modification time of the file are
+unchanged, so files written during a run, e.g. MaxFilter outputs, are
+picked up. In a combined run of natmeg.py the raw tree is walked and each
+header is read once for both tools: the conversion table, the head position
+contexts, the movement plots and the BIDS conversion open raw files through
+inventory.raw.
+
+Worker processes read the data of a file and open it again themselves:
+head positions computed in the shared pool, the mne engine and the digests
+of verify.py. A raw file read from scratch (staging.py) is opened again
+once staged.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from fnmatch import fnmatch
+
+from utils import extract_info_from_filename
+from profiling import span
+from staging import staging
+from iolimits import limits
+
+
+@dataclass(frozen=True)
+class Header:
+    """The parts of a FIF header used to plan the work on a file."""
+    ch_types: frozenset
+    sfreq: float
+    first_samp: int
+    n_times: int
+
+    @property
+    def duration(self):
+        """Seconds from the first to the last sample, as raw.times[-1]."""
+        return (self.n_times - 1) / self.sfreq
+
+
+class Inventory:
+    """
+    Cached listings, names and headers, a single instance (inventory) is
+    shared by all modules and threads.
+    """
+    # Raw objects kept for inventory.raw, headers are kept for all files
+    max_raws = 64
+
+    def __init__(self):
+        self._listings = {}
+        self._names = {}
+        self._headers = {}
+        self._raws = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {'listings': 0, 'names': 0, 'headers': 0}
+        self.misses = {'listings': 0, 'names': 0, 'headers': 0}
+
+    def _count(self, kind: str, hit: bool):
+        with self._lock:
+            (self.hits if hit else self.misses)[kind] += 1
+
+    def listdir(self, path: str):
+        """
+        Names in a directory, an empty list if it does not exist.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._listings.get(path)
+        if cached and cached[0] == mtime:
+            self._count('listings', True)
+            return cached[1]
+        self._count('listings', False)
+        names = os.listdir(path)
+        self._listings[path] = (mtime, names)
+        return names
+
+    def glob(self, pattern: str, root_dir: str):
+        """
+        As glob.glob(pattern, root_dir=root_dir) for patterns without a
+        directory part, hidden files only match patterns starting with a dot.
+        """
+        return [name for name in self.listdir(root_dir)
+                if fnmatch(name, pattern) and (pattern.startswith('.') or not name.startswith('.'))]
+
+    def file_info(self, file_name: str):
+        """
+        extract_info_from_filename of a file, the dict is shared and must
+        not be changed.
+        """
+        if file_name in self._names:
+            self._count('names', True)
+            return self._names[file_name]
+        self._count('names', False)
+        info = extract_info_from_filename(file_name)
+        self._names[file_name] = info
+        return info
+
+    def _read(self, file_name: str, key: tuple):
+        """Open a raw file without data and cache its header and Raw."""
+        import mne
+        local_file = staging.path(file_name)
+        with span('probe', os.path.basename(file_name)), limits.access(local_file):
+            raw = mne.io.read_raw_fif(local_file, allow_maxshield=True, verbose='error')
+        header = Header(frozenset(raw.get_channel_types()), raw.info['sfreq'],
+                        raw.first_samp, raw.n_times)
+        with self._lock:
+            self._headers[file_name] = (key, header)
+            self._raws[file_name] = (key, local_file, raw)
+            self._raws.move_to_end(file_name)
+            while len(self._raws) > self.max_raws:
+                self._raws.popitem(last=False)
+        return header, raw
+
+    @staticmethod
+    def _key(file_name: str):
+        stat = os.stat(file_name)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def header(self, file_name: str):
+        """
+        Header of a FIF file, read without data.
+
+        Raises:
+            OSError, ValueError: If the file cannot be read.
+        """
+        key = self._key(file_name)
+        cached = self._headers.get(file_name)
+        if cached and cached[0] == key:
+            self._count('headers', True)
+            return cached[1]
+        self._count('headers', False)
+        return self._read(file_name, key)[0]
+
+    def raw(self, file_name: str):
+        """
+        Raw FIF file opened without data, as mne.io.read_raw_fif with
+        allow_maxshield. Opened from the scratch copy if the file is
+        staged. Returns a copy, which can be changed.
+
+        Raises:
+            OSError, ValueError: If the file cannot be read.
+        """
+        key = self._key(file_name)
+        with self._lock:
+            cached = self._raws.get(file_name)
+            if cached:
+                self._raws.move_to_end(file_name)
+        if cached and cached[0] == key and cached[1] == staging.path(file_name):
+            self._count('headers', True)
+            return cached[2].copy()
+        self._count('headers', False)
+        return self._read(file_name, key)[1].copy()
+
+    def summary(self):
+        """Print how often each kind of entry was reused."""
+        for kind in self.hits:
+            total = self.hits[kind] + self.misses[kind]
+            if total:
+                print(f'Inventory {kind}: {self.misses[kind]} read, {self.hits[kind]} reused')
+
+
+inventory = Inventory()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Limits on concurrent access and bandwidth per storage mount, so that
+parallel MaxFilter and BIDS runs do not starve the acquisition servers.
+Enabled with --io-limits=limits.json:
+
+    {
+        "squidMEG": {
+            "concurrent": 2,
+            "mb_per_s": 100,
+            "schedule": [
+                {"hours": "19-07", "concurrent": 0, "mb_per_s": 0},
+                {"days": "Sat-Sun", "concurrent": 0, "mb_per_s": 0}
+            ]
+        },
+        "opmMEG": {"concurrent": 1, "mb_per_s": 50},
+        "/neuro/data/local": {"concurrent": 8}
+    }
+
+Mounts are given as paths or as the names of the directories in the BIDS
+configuration (squidMEG, opmMEG, BIDS). Missing or 0 values are unlimited.
+The first schedule window matching the current day and hour replaces the
+values of the mount, hours wrap around midnight.
+
+Each stage holds a slot on the mounts of the files it reads and writes
+(header reads, head positions, MaxFilter runs, BIDS conversions) for as long
+as it works on them. Copies made by this package (staging, FIF block copies)
+are limited in MB/s while they copy. The MaxFilter binary, MNE (head
+positions, the mne engine, write_raw_bids, raw.save) and the digests of
+verify.py read and write at their own pace; the files they read and wrote
+are charged afterwards (charge), the stage waits until their size fits in
+the bandwidth. The bandwidth then holds on average, not within one run.
+Header reads and rewritten sidecars are not counted. Limits hold within one
+process, run natmeg.py to share them between MaxFilter and the BIDS
+conversion.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+from profiling import span
+
+day_names = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+# Size of throttled copy steps
+throttle_chunk = 16 * 1024**2
+# Seconds between checks of the schedule while waiting for a slot
+schedule_check = 60
+
+
+def _parse_days(days):
+    """Day numbers (Monday is 0) of 'Mon-Fri', 'Sat' or ['Sat', 'Sun']."""
+    if isinstance(days, str):
+        days = [days]
+    numbers = set()
+    for day in days:
+        first, _, last = day.partition('-')
+        start = day_names.index(first[:3].title())
+        stop = day_names.index((last or first)[:3].title())
+        numbers.update((start + i) % 7 for i in range((stop - start) % 7 + 1))
+    return numbers
+
+
+def _parse_hours(hours: str):
+    """Start and end hour of '08-18', the end hour is not included."""
+    start, _, stop = str(hours).partition('-')
+    return int(start), int(stop or int(start) + 1)
+
+
+class MountLimit:
+    """
+    Concurrent access and bandwidth of one mount.
+
+    Args:
+        root (str, required): Directory of the mount.
+        concurrent (int): Stages working on the mount at the same time.
+        mb_per_s (float): Bandwidth of copies in MB/s.
+        schedule (list): Time windows with other values.
+    """
+    def __init__(self, root: str, concurrent: int=0, mb_per_s: float=0, schedule: list=()):
+        self.root = root
+        self.concurrent = concurrent
+        self.mb_per_s = mb_per_s
+        self.schedule = []
+        for window in schedule:
+            self.schedule.append((
+                _parse_days(window.get('days', day_names[0] + '-' + day_names[-1])),
+                _parse_hours(window.get('hours', '0-24')),
+                window.get('concurrent', 0),
+                window.get('mb_per_s', 0)))
+        self.active = 0
+        self._condition = threading.Condition()
+        self._next_free = 0.
+
+    def current(self, now: datetime=None):
+        """
+        Returns:
+            tuple: concurrent and mb_per_s at the given time, default now.
+        """
+        now = now or datetime.now()
+        for days, (start, stop), concurrent, mb_per_s in self.schedule:
+            hour = now.hour
+            in_hours = start <= hour < stop if start < stop else (hour >= start or hour < stop)
+            # A window past midnight belongs to the day it started
+            day = now.weekday() if start < stop or hour >= start else (now.weekday() - 1) % 7
+            if in_hours and day in days:
+                return concurrent, mb_per_s
+        return self.concurrent, self.mb_per_s
+
+    def acquire(self):
+        with self._condition:
+            if not self._full():
+                self.active += 1
+                return
+            with span('io_wait', self.root):
+                while self._full():
+                    self._condition.wait(schedule_check)
+                self.active += 1
+
+    def _full(self):
+        concurrent = self.current()[0]
+        return bool(concurrent) and self.active >= concurrent
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def throttle(self, n_bytes: int):
+        """Wait until n_bytes more fit in the bandwidth of the mount."""
+        mb_per_s = self.current()[1]
+        if not mb_per_s:
+            return
+        with self._condition:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + n_bytes / (mb_per_s * 1024**2)
+        if start > now:
+            time.sleep(start - now)
+
+
+class IOLimits:
+    """
+    The limits of all mounts, a single instance (limits) is shared by all
+    modules and threads. Without limits loaded nothing is limited.
+    """
+    def __init__(self):
+        self.mounts = []
+        self._held = threading.local()
+
+    def load(self, file_name: str, aliases: dict=None):
+        """
+        Read the limits from a JSON file.
+
+        Args:
+            file_name (str, required): Limits file.
+            aliases (dict): Directories of the mount names used in the file,
+                e.g. the BIDS configuration.
+        """
+        aliases = aliases or {}
+        try:
+            with open(file_name, 'r') as f:
+                config = json.load(f)
+            mounts = []
+            for name, settings in config.items():
+                root = aliases.get(name, name)
+                if not root or not os.path.isabs(root):
+                    print(f'No directory for mount {name} in {file_name}, ignored')
+                    continue
+                mounts.append(MountLimit(os.path.abspath(root), **settings))
+        except (OSError, ValueError, TypeError) as e:
+            print(f'Invalid IO limits file {file_name}: {e}')
+            sys.exit(1)
+        # Innermost mount first
+        self.mounts = sorted(mounts, key=lambda mount: -len(mount.root))
+        for mount in self.mounts:
+            concurrent, mb_per_s = mount.current()
+            print(f"IO limits {mount.root}: {concurrent or 'any'} concurrent, "
+                  f"{mb_per_s or 'unlimited'} MB/s now")
+
+    def mount(self, file_name):
+        """MountLimit of the mount of a file, None if not limited."""
+        if not self.mounts or not file_name:
+            return None
+        path = os.path.abspath(str(file_name))
+        for mount in self.mounts:
+            if path == mount.root or path.startswith(mount.root + os.sep):
+                return mount
+        return None
+
+    @contextmanager
+    def access(self, *file_names):
+        """
+        Hold a slot on the mounts of the files while the block runs. Slots
+        already held by the thread are not taken again.
+        """
+        held = self._held.__dict__.setdefault('mounts', set())
+        mounts = {self.mount(f) for f in file_names} - {None} - held
+        with ExitStack() as stack:
+            # Always in the same order, so that threads do not deadlock
+            for mount in sorted(mounts, key=lambda mount: mount.root):
+                mount.acquire()
+                held.add(mount)
+                stack.callback(held.discard, mount)
+                stack.callback(mount.release)
+            yield
+
+    def throttler(self, *file_names):
+        """
+        Function limiting the bytes copied between the files to the
+        bandwidth of their mounts, None if they are not limited.
+        """
+        mounts = {self.mount(f) for f in file_names} - {None}
+        if not any(mount.current()[1] for mount in mounts):
+            return None
+
+        def throttle(n_bytes):
+            for mount in mounts:
+                mount.throttle(n_bytes)
+        return throttle
+
+    def charge(self, *file_names):
+        """
+        Wait until the sizes of files read or written outside the package,
+        e.g. by MaxFilter or MNE, fit in the bandwidth of their mounts.
+        Missing files are ignored.
+        """
+        for file_name in file_names:
+            mount = self.mount(file_name)
+            if mount is None or not mount.current()[1]:
+                continue
+            try:
+                n_bytes = os.path.getsize(file_name)
+            except OSError:
+                continue
+            with span('io_wait', mount.root):
+                mount.throttle(n_bytes)
+
+    def copyfile(self, src: str, dst: str):
+        """shutil.copyfile within the bandwidth of the mounts."""
+        import shutil
+        throttle = self.throttler(src, dst)
+        if throttle is None:
+            shutil.copyfile(src, dst)
+            return
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            while chunk := fin.read(throttle_chunk):
+                throttle(len(chunk))
+                fout.write(chunk)
+
+
+limits = IOLimits()
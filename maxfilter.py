@@ -12,31 +12,40 @@ import os
 from os.path import exists, basename, dirname, isdir
 import sys
 import re
-import tkinter as tk
-from tkinter.filedialog import askdirectory, askopenfilename, asksaveasfile
 import json
-import pandas as pd
-import subprocess
+import shlex
 import argparse
 from datetime import datetime
 from shutil import copy2
-import mne
-from mne.transforms import (invert_transform,
-                            read_trans, write_trans)
-from mne.preprocessing import compute_average_dev_head_t
-from mne.chpi import (compute_chpi_amplitudes, compute_chpi_locs,
-                      head_pos_to_trans_rot_t, compute_head_pos,
-                      write_head_pos,
-                      read_head_pos)
-import matplotlib.patches as mpatches
+from functools import partial
+from dataclasses import dataclass
+from typing import NamedTuple
+
+# mne, numpy, pandas, matplotlib and tkinter are imported where they are
+# used, so that the command line starts fast and works without Tk
 
 from utils import (
     log,
     proc_patterns,
     noise_patterns,
     file_contains,
-    askForConfig
+    askForConfig,
+    file_fingerprint,
+    hash_fingerprint,
+    read_manifest,
+    write_manifest,
+    link_file,
+    max_movement,
+    HeadposCache
 )
+from pipeline import JobGraph
+from progress import ProgressBoard, run_streamed
+from resources import Usage, ResourceReport, ProcessSampler, measure, call_measured
+from profiling import profiler, span
+import metrics
+from inventory import inventory
+from staging import staging, split_parts
+from iolimits import limits
 
 ###############################################################################
 # Global variables
@@ -61,6 +70,7 @@ def match_task_files(files, task: str):
     return matched_files
 
 def askForProjectDir():
+    from tkinter.filedialog import askdirectory
     data_path = askdirectory(title='Select project for MEG data', initialdir=default_raw_path)  # shows dialog box and return the MEG path
     print("The folder selected for MEG data is %s." % str(data_path))
 
@@ -106,7 +116,11 @@ def defaultMaxfilterConfig():
         'cal': '/neuro/databases/sss/sss_cal.dat',
         'ctc': '/neuro/databases/ctc/ct_sparse.fif',
         'maxfilter_version': '/neuro/bin/util/maxfilter',
-        'MaxFilter_commands': ''
+        'engine': 'maxfilter',
+        'MaxFilter_commands': '',
+        'n_jobs': 4,
+        'headpos_chunk_duration': 60,
+        'status_interval': 60
         }
     }
     return data
@@ -124,6 +138,8 @@ def OpenMaxFilterSettingsUI(json_name: str = None):
     -------
     data : dict
     """
+    import tkinter as tk
+    from tkinter.filedialog import asksaveasfile
     if not json_name:
         data = defaultMaxfilterConfig()
     else:
@@ -200,6 +216,14 @@ def OpenMaxFilterSettingsUI(json_name: str = None):
             entry.grid(row=i, column=1, padx=2, pady=2, sticky='w')
             selected_option.set(options[0])
             adv_entries[key] = selected_option
+
+        elif key == 'engine':
+            selected_option = tk.StringVar()
+            options = [value] + list({'maxfilter', 'mne'} - {value})
+            entry = tk.OptionMenu(adv_frame, selected_option, *options)
+            entry.grid(row=i, column=1, padx=2, pady=2, sticky='w')
+            selected_option.set(options[0])
+            adv_entries[key] = selected_option
         
         elif value in ['on', 'off']:
             adv_chb[key] = tk.StringVar()
@@ -270,12 +294,18 @@ def OpenMaxFilterSettingsUI(json_name: str = None):
 
 def plot_movement(raw, head_pos, mean_trans):
 
+    import mne
+    # The info of the raw file is enough
+    info = raw if isinstance(raw, mne.Info) else raw.info
+    from mne.transforms import invert_transform, read_trans
+    from mne.chpi import read_head_pos
+    import matplotlib.patches as mpatches
     if isinstance(head_pos, str):
         head_pos = read_head_pos(head_pos)
     if isinstance(mean_trans, str):
         mean_trans = read_trans(mean_trans)
         
-    original_head_dev_t = invert_transform(raw.info["dev_head_t"])
+    original_head_dev_t = invert_transform(info["dev_head_t"])
     
     """
     Plot trances of movement for insepction. Uses mne.viz.plot_head_positions
@@ -294,37 +324,785 @@ def plot_movement(raw, head_pos, mean_trans):
     fig.tight_layout()
     return fig
 
-def import_conversion_table(conversion_file: str):
-        
-    df = pd.read_csv(conversion_file, sep='\t')
-    df = df.where(pd.notnull(df), None)
+def render_movement_plot(info, head_pos_file: str, trans_file: str, fig_name: str):
+    """
+    Render plot_movement to fig_name with the non-interactive Agg backend,
+    in a worker process of MaxFilter.plot_pool. The info of the first raw
+    file is passed from the task, the raw file is not opened again.
+
+    Returns:
+        str: fig_name
+    """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+
+    fig = plot_movement(info, head_pos_file, trans_file)
+    # Write to a new file so that an interrupted run leaves no partial figure
+    fig.savefig(f'{fig_name}.tmp.png')
+    plt.close(fig)
+    os.replace(f'{fig_name}.tmp.png', fig_name)
+    return fig_name
+
+def _select_fits(fits: dict, mask):
+    """Rows of cHPI amplitudes or locations, a dict of arrays by time."""
+    return {key: value[mask] for key, value in fits.items()}
+
+def _concatenate_fits(first: dict, second: dict):
+    """Rows of first followed by those of second, for the keys of second."""
+    import numpy as np
+    return {key: np.concatenate([first[key], second[key]]) for key in second}
+
+def iter_chunk_head_pos(raw, chunk_duration=60., overlap=1.):
+    """
+    Compute head positions over fixed-length windows of a recording.
+
+    cHPI amplitudes are estimated per window, read from disk, instead of
+    over the whole recording at once, so peak memory depends on the window
+    length and not on the recording length. Each window is extended by
+    overlap seconds on both sides so that the amplitude fits at its edges
+    have full data, fits outside the window itself are dropped so that
+    consecutive windows neither overlap nor leave gaps.
+
+    The coil and head position fits continue from the last fits of the
+    previous window, which are fitted again at the start of the window and
+    dropped, so that the windows give the same head positions and
+    velocities as the whole recording in one window.
+
+    Args:
+        raw (Raw, required): Recording, not preloaded.
+        chunk_duration (float): Window length in seconds, None for the
+            whole recording in one window.
+        overlap (float): Seconds of data read around each window, must be
+            longer than the cHPI fitting window.
+
+    Yields:
+        array: head positions of a window, shape (n_pos, 10).
+    """
+    import numpy as np
+    from mne.chpi import compute_chpi_amplitudes, compute_chpi_locs, compute_head_pos
+    duration = raw.times[-1]
+    if not chunk_duration:
+        chunk_duration = duration + 1.
+    # Amplitudes of the last coil fit and the coil fit of the last head position
+    last_amplitudes = last_locs = None
+    for start in np.arange(0., duration, float(chunk_duration)):
+        stop = min(start + float(chunk_duration), duration)
+        chpi_amplitudes = compute_chpi_amplitudes(
+            raw,
+            tmin=max(start - overlap, 0.),
+            tmax=min(stop + overlap, duration),
+            verbose='error')
+        times = chpi_amplitudes['times'] - raw.first_time
+        keep = np.ones(len(times), bool)
+        if start > 0:
+            keep &= times >= start
+        if stop < duration:
+            keep &= times < stop
+        if not keep.any():
+            continue
+        amplitudes = {key: chpi_amplitudes[key][keep] for key in ['times', 'slopes']}
+        if last_amplitudes is not None:
+            amplitudes = _concatenate_fits(last_amplitudes, amplitudes)
+        chpi_amplitudes.update(amplitudes)
+        chpi_locs = compute_chpi_locs(raw.info, chpi_amplitudes, verbose='error')
+        if last_amplitudes is not None:
+            chpi_locs = _select_fits(chpi_locs, chpi_locs['times'] != last_amplitudes['times'][0])
+        if len(chpi_locs['times']):
+            last_amplitudes = _select_fits(amplitudes, amplitudes['times'] == chpi_locs['times'][-1])
+        del chpi_amplitudes, amplitudes
+
+        if last_locs is not None:
+            chpi_locs = _concatenate_fits(last_locs, chpi_locs)
+        head_pos = compute_head_pos(raw.info, chpi_locs, verbose='error')
+        if last_locs is not None:
+            head_pos = head_pos[head_pos[:, 0] != last_locs['times'][0]]
+        if len(head_pos):
+            last_locs = _select_fits(chpi_locs, chpi_locs['times'] == head_pos[-1, 0])
+        yield head_pos
+
+def write_head_pos_header(fid):
+    """Header line of a MaxFilter-formatted head position file."""
+    fid.write(' Time       q1       q2       q3       q4       q5       '
+              'q6       g-value  error    velocity\n')
+
+def append_head_pos(fid, head_pos):
+    """Append rows to an open MaxFilter-formatted head position file."""
+    fmts = ' ' + ' '.join(['% 9.3f'] + ['% 8.5f'] * 9) + '\n'
+    for p in head_pos:
+        fid.write(fmts % tuple(p))
+    fid.flush()
+
+def compute_file_headpos(file_name: str,
+                         chunk_duration: float=60.,
+                         pos_file: str=None):
+    """
+    Compute head positions for a single recording.
+
+    Runs in a worker process, so only one recording is held in memory per
+    worker. See iter_chunk_head_pos for the windowing.
+
+    Args:
+        file_name (str, required): Path to the raw file.
+        chunk_duration (float): Window length in seconds for the cHPI
+            amplitude estimation.
+        pos_file (str): If set, head positions are written incrementally to
+            this file as each window is done.
+
+    Returns:
+        tuple: head_pos array, first_samp, n_times and sfreq of the
+            recording, needed to place it on the time axis of the task.
+    """
+    import numpy as np
+    import mne
+    raw = mne.io.read_raw_fif(file_name,
+                              allow_maxshield=True,
+                              verbose='error')
+    head_pos = []
+    fid = None
+    if pos_file:
+        fid = open(pos_file, 'w')
+        write_head_pos_header(fid)
+    try:
+        for chunk_head_pos in iter_chunk_head_pos(raw, chunk_duration):
+            head_pos.append(chunk_head_pos)
+            if fid:
+                append_head_pos(fid, chunk_head_pos)
+    finally:
+        if fid:
+            fid.close()
+    head_pos = np.concatenate(head_pos, axis=0) if head_pos else np.zeros((0, 10))
+    return head_pos, raw.first_samp, raw.n_times, raw.info['sfreq']
+
+def merge_head_pos(results: list):
+    """
+    Merge per-file head positions into one task-level array.
+
+    Times are shifted to match the time axis of the runs concatenated
+    with mne.concatenate_raws, i.e. each run continues where the previous
+    one ended and the time axis starts at the first_samp of the first run.
+
+    Args:
+        results (list, required): Output of compute_file_headpos per file,
+            in run order.
+
+    Returns:
+        array: head positions, shape (n_pos, 10).
+    """
+    import numpy as np
+    first_samp = results[0][1]
+    n_samples = 0
+    merged = []
+    for head_pos, file_first_samp, n_times, sfreq in results:
+        head_pos = head_pos.copy()
+        head_pos[:, 0] += (first_samp + n_samples - file_first_samp) / sfreq
+        merged.append(head_pos)
+        n_samples += n_times
+    return np.concatenate(merged, axis=0)
+
+def parse_mne_options(options: list):
+    """
+    Translate the mne_mxf strings of set_parameter objects into settings for
+    mne.preprocessing.maxwell_filter.
+
+    Args:
+        options (list, required): mne_mxf strings, e.g. '--st', '--corr=0.98'
+            or '--bad 1433 2511'. Empty strings are ignored.
+
+    Returns:
+        dict: settings used by run_mne_maxfilter.
+    """
+    settings = {
+        'calibration': None,
+        'cross_talk': None,
+        'trans': None,
+        'st': False,
+        'corr': 0.98,
+        'movecomp': False,
+        'autobad': None,
+        'bads': [],
+        'linefreq': None,
+        'ds': None
+    }
+    for option in options:
+        if not option or not option.strip():
+            continue
+        name, _, value = option.strip().lstrip('-').replace('=', ' ', 1).partition(' ')
+        value = value.strip()
+        if name in ['calibration', 'cross_talk', 'trans']:
+            settings[name] = value
+        elif name in ['st', 'movecomp']:
+            settings[name] = True
+        elif name in ['corr', 'autobad', 'linefreq']:
+            settings[name] = float(value)
+        elif name == 'ds':
+            settings['ds'] = int(value)
+        elif name == 'bad':
+            # MaxFilter uses channel numbers, MNE channel names
+            settings['bads'] = [f'MEG{ch.zfill(4)}' if ch.isdigit() else ch
+                                for ch in value.replace(',', ' ').split()]
+    return settings
+
+def run_mne_maxfilter(file: str,
+                      clean: str,
+                      options: list,
+                      log_file: str=None,
+                      head_pos=None,
+                      chunk_duration: float=60.):
+    """
+    Run SSS/tSSS on a file with mne.preprocessing.maxwell_filter.
+
+    The MNE counterpart of running the MaxFilter binary, driven by the same
+    parameters. Runs in a worker process when called through MaxFilter.
+
+    Args:
+        file (str, required): Input raw file.
+        clean (str, required): Output file.
+        options (list, required): mne_mxf strings, see parse_mne_options.
+        log_file (str): File to append the MNE log to.
+        head_pos (array | str): Head positions of the file for movement
+            compensation, or a head position file. Computed from the file
+            if not given.
+        chunk_duration (float): Window length in seconds for computing the
+            head positions, see iter_chunk_head_pos.
+
+    Returns:
+        str: clean
+    """
+    import numpy as np
+    import mne
+    from mne.preprocessing import maxwell_filter, find_bad_channels_maxwell
+    if log_file:
+        mne.set_log_file(log_file, overwrite=False)
+    settings = parse_mne_options(options)
+
+    raw = mne.io.read_raw_fif(file, allow_maxshield=True, verbose='error')
+    raw.info['bads'] = sorted(set(raw.info['bads'] +
+                                  [ch for ch in settings['bads'] if ch in raw.ch_names]))
+
+    # Empty room recordings have no head, process them in device coordinates
+    if file_contains(basename(file).lower(), noise_patterns) or raw.info['dev_head_t'] is None:
+        coord_frame, origin = 'meg', (0., 0., 0.)
+    else:
+        coord_frame, origin = 'head', 'auto'
+
+    if settings['autobad'] is not None:
+        noisy, flat = find_bad_channels_maxwell(
+            raw,
+            calibration=settings['calibration'],
+            cross_talk=settings['cross_talk'],
+            limit=settings['autobad'],
+            coord_frame=coord_frame,
+            origin=origin,
+            verbose='info')
+        raw.info['bads'] = sorted(set(raw.info['bads'] + noisy + flat))
+
+    if not settings['movecomp'] or coord_frame != 'head':
+        head_pos = None
+    elif head_pos is None:
+        head_pos = compute_file_headpos(file, chunk_duration)[0]
+    elif isinstance(head_pos, str):
+        head_pos = mne.chpi.read_head_pos(head_pos)
+
+    raw_sss = maxwell_filter(
+        raw,
+        calibration=settings['calibration'],
+        cross_talk=settings['cross_talk'],
+        st_duration=10. if settings['st'] else None,
+        st_correlation=settings['corr'],
+        head_pos=head_pos,
+        destination=settings['trans'] if coord_frame == 'head' else None,
+        coord_frame=coord_frame,
+        origin=origin,
+        verbose='info')
+
+    if settings['linefreq']:
+        raw_sss.notch_filter(
+            np.arange(settings['linefreq'], raw_sss.info['sfreq'] / 2, settings['linefreq']),
+            picks='meg', verbose='info')
+    if settings['ds'] and settings['ds'] > 1:
+        raw_sss.resample(raw_sss.info['sfreq'] / settings['ds'], verbose='info')
+
+    raw_sss.save(clean, overwrite=True, verbose='info')
+    if log_file:
+        mne.set_log_file(None)
+    return clean
+
+def import_conversion_table(conversion_file: str, tasks: list | tuple=()):
+    """
+    Raw TRIUX recordings of a bidsify conversion table, the inputs of MaxFilter.
+
+    Args:
+        conversion_file (str, required): Conversion table (tsv).
+        tasks (list): MaxFilter task names, each raw file is assigned to
+            the first task it matches (see match_task_files).
+
+    Returns:
+        pd.DataFrame: MEG rows of the table with the matched task in
+            maxfilter_task and run_maxfilter 'yes' for raw files of a task.
+    """
+    import pandas as pd
+    df = pd.read_csv(conversion_file, sep='\t', dtype={'participant_from': str,
+                                                        'session_from': str})
+    df = df.astype(object).where(pd.notnull(df), None)
     df['run_maxfilter'] = 'no'
+    df['maxfilter_task'] = None
     df = df[df['acquisition'] == 'triux']
     df = df[df['datatype'] == 'meg']
     df = df[df['split'].isna()]
-    
-    for _, d in df.groupby(['participant_to', 'session_to', 'task']):
-        if len(d) == 1:
-            df.loc[d.index[0], 'run_maxfilter'] = 'yes'
 
-    # df = df[df['run_maxfilter'] == 'yes']
-    
+    for i, raw_name in df['raw_name'].items():
+        for task in tasks:
+            # MaxFilter outputs and head position files never match
+            if match_task_files([raw_name], task):
+                df.loc[i, ['maxfilter_task', 'run_maxfilter']] = [task, 'yes']
+                break
+
     return df.reset_index(drop=True)
 
-def MaxFilter_from_conversion_table(conversion_file: str):
-        
-    df = import_conversion_table(conversion_file)
-    df = df.where(pd.notnull(df), None)
-    
-    for _, d in df.iterrows():
-        print(d)
+def MaxFilter_from_conversion_table(config_dict: dict,
+                                    conversion_file: str,
+                                    bids_config: dict=None):
+    """Run MaxFilter on the raw files of a bidsify conversion table."""
+    return MaxFilter(config_dict).loop_conversion_table(conversion_file, bids_config)
         
 
-class set_parameter:
-    def __init__(self, mxf, mne_mxf, string):
-        self.mxf = mxf
-        self.mne_mxf = mne_mxf
-        self.string = string
+class TaskContext:
+    """
+    The raw files of one task, each opened once and cached.
+
+    Only headers are read (no preload), the head position, trans and
+    movement plot stages all share the same raw objects and head positions.
+
+    Args:
+        data_path (str, required): Directory of the raw files.
+        files (list | str, required): Raw file names of the task, in run order.
+        merge_runs (bool): Use all runs of the task, otherwise only the first.
+    """
+    def __init__(self, data_path: str, files: list | str, merge_runs=True):
+        if isinstance(files, str):
+            files = [files]
+        self.data_path = data_path
+        self.files = files if merge_runs else files[:1]
+        self.head_pos = None
+        self.mean_trans = None
+        self._raws = {}
+
+    def raw(self, file: str):
+        if file not in self._raws:
+            self._raws[file] = inventory.raw(f'{self.data_path}/{file}')
+        return self._raws[file]
+
+    @property
+    def raws(self):
+        return [self.raw(file) for file in self.files]
+
+    def _headers(self):
+        return [(raw.first_samp, raw.n_times, raw.info['sfreq'])
+                for raw in self.raws]
+
+    def compute_head_pos(self, n_jobs=1, chunk_duration=60., pos_file=None, pool=None):
+        """
+        Compute head positions per file, in parallel worker processes if
+        there are several runs, and merge them on the task time axis.
+
+        The runs are computed by pool if given, e.g. the worker processes
+        shared by all jobs of a graph. Otherwise a single run is computed in
+        this process and several runs by up to n_jobs processes started for
+        this task.
+
+        If pos_file is given the head positions are also written to it. For
+        a single run they are written incrementally while computing, to a
+        temporary file that is renamed when done so that an interrupted run
+        never leaves a partial file behind.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from contextlib import ExitStack
+        with ExitStack() as stack:
+            # Read from the scratch copies if the raw data is staged
+            file_names = [stack.enter_context(staging.staged(f'{self.data_path}/{file}'))
+                          for file in self.files]
+            stack.enter_context(limits.access(*file_names, pos_file))
+            tmp_file = f'{pos_file}.tmp' if pos_file else None
+            if len(file_names) > 1:
+                # One recording per worker, merged on the concatenated time axis
+                compute = partial(compute_file_headpos, chunk_duration=chunk_duration)
+                if pool is None:
+                    with ProcessPoolExecutor(max_workers=min(n_jobs, len(file_names)),
+                                             max_tasks_per_child=1) as task_pool:
+                        results = list(task_pool.map(compute, file_names))
+                else:
+                    results = list(pool.map(compute, file_names))
+                self.head_pos = merge_head_pos(results)
+                if tmp_file:
+                    with open(tmp_file, 'w') as fid:
+                        write_head_pos_header(fid)
+                        append_head_pos(fid, self.head_pos)
+            elif pool is not None:
+                self.head_pos = pool.submit(compute_file_headpos, file_names[0],
+                                            chunk_duration=chunk_duration,
+                                            pos_file=tmp_file).result()[0]
+            else:
+                self.head_pos = compute_file_headpos(file_names[0],
+                                                     chunk_duration=chunk_duration,
+                                                     pos_file=tmp_file)[0]
+            if tmp_file:
+                os.replace(tmp_file, pos_file)
+            # Read by MNE, see iolimits.py
+            limits.charge(*(part for f in file_names for part in split_parts(f)))
+        return self.head_pos
+
+    def file_head_pos(self):
+        """
+        Split the task head positions back into one array per file, with
+        times on the time axis of each file.
+        """
+        headers = self._headers()
+        first_samp = headers[0][0]
+        n_samples = 0
+        file_head_pos = []
+        for file_first_samp, n_times, sfreq in headers:
+            start = (first_samp + n_samples) / sfreq
+            stop = (first_samp + n_samples + n_times) / sfreq
+            mask = (self.head_pos[:, 0] >= start) & (self.head_pos[:, 0] < stop)
+            head_pos = self.head_pos[mask].copy()
+            head_pos[:, 0] -= (first_samp + n_samples - file_first_samp) / sfreq
+            file_head_pos.append(head_pos)
+            n_samples += n_times
+        return file_head_pos
+
+    def average_dev_head_t(self):
+        """
+        Average device to head transform over all runs, computed from the
+        head positions and the raw headers without concatenating data.
+        """
+        from mne.preprocessing import compute_average_dev_head_t
+        raws, head_pos = zip(*[(raw, pos) for raw, pos
+                               in zip(self.raws, self.file_head_pos()) if len(pos)])
+        return compute_average_dev_head_t(list(raws), list(head_pos))
+
+class set_parameter(NamedTuple):
+    mxf: str
+    mne_mxf: str
+    string: str
+
+no_parameter = set_parameter('', '', '')
+
+@dataclass(frozen=True)
+class TaskPlan:
+    """
+    MaxFilter parameters of one variant of a task.
+
+    Tasks only differ in whether the average head position is used, whether
+    they are empty room recordings (no movecomp) and whether they are sss
+    files, so a MaxFilterPlan holds one TaskPlan per combination.
+    """
+    cal: set_parameter
+    ctc: set_parameter
+    tsss: set_parameter
+    ds: set_parameter
+    corr: set_parameter
+    mc: set_parameter
+    autobad: set_parameter
+    bad_channels: set_parameter
+    linefreq: set_parameter
+    force: str
+    additional_cmd: str
+    use_trans: bool
+    proc: str
+
+    def trans(self, trans_file: str):
+        if not self.use_trans:
+            return no_parameter
+        return set_parameter('-trans %s' % trans_file,
+                             '--trans=%s' % trans_file,
+                             'avgHead')
+
+    def parameters(self, trans_file: str):
+        """Parameters in MaxFilter command line order."""
+        return [
+            self.cal,
+            self.ctc,
+            self.trans(trans_file),
+            self.tsss,
+            self.ds,
+            self.corr,
+            self.mc,
+            self.autobad,
+            self.bad_channels,
+            self.linefreq
+        ]
+
+    def mxf_options(self, trans_file: str):
+        return [p.mxf for p in self.parameters(trans_file)] + [
+            self.force,
+            self.additional_cmd]
+
+    def mne_options(self, trans_file: str):
+        return [p.mne_mxf for p in self.parameters(trans_file)]
+
+@dataclass(frozen=True)
+class MaxFilterPlan:
+    """
+    Validated MaxFilter configuration.
+
+    Created once by compile_plan, immutable and picklable so it can be
+    shared with worker processes. Per-task parameters are looked up with
+    task().
+    """
+    data_root: str
+    output_path: str
+    maxfilter_path: str
+    engine: str
+    merge_runs: str
+    n_jobs: int
+    headpos_chunk_duration: float
+    status_interval: float
+    continous: bool
+    trans_conditions: tuple
+    sss_files: tuple
+    empty_room_files: tuple
+    tasks_to_run: tuple
+    variants: tuple
+
+    def subject_paths(self, subject: str, session: str):
+        """Input and output meg directories of a subject and session."""
+        return (f'{self.data_root}/{subject}/{session}/meg',
+                f'{self.output_path}/{subject}/{session}/meg')
+
+    def task(self, task: str):
+        """Parameters of a task, a lookup among the compiled variants."""
+        use_trans = self.continous and task in self.trans_conditions
+        noise = file_contains(task, noise_patterns)
+        sss = task in self.sss_files
+        return self.variants[use_trans * 4 + noise * 2 + sss]
+
+def _as_list(value):
+    if isinstance(value, str):
+        return [value]
+    return list(value or [])
+
+def _check_on_off(parameters: dict, key: str, name: str):
+    value = parameters.get(key)
+    if value not in ['on', 'off']:
+        print(f'faulty "{name}" setting (must be on or off)')
+        sys.exit(1)
+    return value
+
+def compile_plan(parameters: dict):
+    """
+    Validate the MaxFilter settings and compile them into a MaxFilterPlan.
+
+    Args:
+        parameters (dict, required): standard_settings and
+            advanced_settings of the config merged.
+
+    Returns:
+        MaxFilterPlan
+    """
+    data_root = os.path.join(parameters.get('data_path'),
+                             parameters.get('project_name'))
+    # Check if output path is set
+    output_path = parameters.get('output_path') or data_root
+
+    force = _check_on_off(parameters, 'force', 'force')
+    movecomp_default = _check_on_off(parameters, 'movecomp_default', 'movecomp')
+    tsss_default = _check_on_off(parameters, 'tsss_default', 'tsss')
+    downsample = _check_on_off(parameters, 'downsample', 'downsampling')
+    apply_linefreq = _check_on_off(parameters, 'apply_linefreq', 'apply_linefreq')
+    autobad = _check_on_off(parameters, 'autobad', 'autobad')
+
+    cal = parameters.get('cal')
+    if not cal:
+        print('no "cal" file found')
+        sys.exit(1)
+    ctc = parameters.get('ctc')
+    if not ctc:
+        print('no "ctc" file found')
+        sys.exit(1)
+
+    _force = '-force' if force == 'on' else ''
+    _cal = set_parameter('-cal %s' % cal, '--calibration=%s' % cal, 'cal_')
+    _ctc = set_parameter('-ctc %s' % ctc, '--cross_talk=%s' % ctc, 'ctc_')
+
+    if movecomp_default == 'on':
+        _mc = set_parameter('-movecomp', '--movecomp', 'mc')
+    else:
+        _mc = no_parameter
+
+    if tsss_default == 'on':
+        _tsss = set_parameter('-st', '--st', 'tsss')
+    else:
+        _tsss = no_parameter
+
+    _ds = no_parameter
+    if downsample == 'on':
+        factor = parameters.get('downsample_factor')
+        if int(factor) <= 1:
+            print('downsampling factor must be an INTEGER greater than 1')
+            sys.exit(1)
+        _ds = set_parameter('-ds %s' % factor, '--ds=%s' % factor,
+                            'dsfactor-%s_' % factor)
+
+    correlation = parameters.get('correlation')
+    _corr = no_parameter
+    if correlation:
+        _corr = set_parameter('-corr %s' % correlation,
+                              '--corr=%s' % correlation,
+                              'corr %s_' % round(float(correlation)*100))
+
+    _linefreq = no_parameter
+    if apply_linefreq == 'on':
+        linefreq = parameters.get('linefreq_Hz')
+        _linefreq = set_parameter('-linefreq %s' % linefreq,
+                                  '--linefreq %s' % linefreq,
+                                  'linefreq-%s_' % linefreq)
+
+    if autobad == 'on':
+        badlimit = parameters.get('badlimit')
+        _autobad = set_parameter('-autobad %s -badlimit %s' % (autobad, badlimit),
+                                 '--autobad=%s' % badlimit,
+                                 'autobad_%s' % autobad)
+    else:
+        _autobad = set_parameter('-autobad %s' % autobad, '', '')
+
+    bad_channels = parameters.get('bad_channels')
+    _bad_channels = no_parameter
+    if bad_channels:
+        bad_ch = ' '.join(bad_channels) if isinstance(bad_channels, list) else bad_channels
+        _bad_channels = set_parameter('-bad %s' % bad_ch, '--bad %s' % bad_ch,
+                                      '_bad_%s' % bad_ch)
+
+    trans_conditions = _as_list(parameters.get('trans_conditions'))
+    sss_files = _as_list(parameters.get('sss_files'))
+    empty_room_files = _as_list(parameters.get('empty_room_files'))
+    trans_option = parameters.get('trans_option')
+    continous = 'continous' in trans_option
+
+    def task_plan(use_trans, noise, sss):
+        mc = no_parameter if noise else _mc
+        proc = []
+        if tsss_default == 'on' and not sss:
+            proc.append(_tsss.string)
+            if correlation:
+                proc.append(f'corr{round(float(correlation)*100)}')
+        else:
+            proc.append('sss')
+        if movecomp_default == 'on':
+            proc.append(mc.string)
+        if use_trans:
+            proc.append('avgHead')
+        proc = [p for p in proc if p != '']
+
+        return TaskPlan(
+            cal=_cal,
+            ctc=_ctc,
+            tsss=_tsss,
+            ds=_ds,
+            corr=_corr,
+            mc=mc,
+            autobad=_autobad,
+            bad_channels=_bad_channels,
+            linefreq=_linefreq,
+            force=_force,
+            additional_cmd=parameters.get('MaxFilter_commands') or '',
+            use_trans=use_trans,
+            proc='+'.join(proc))
+
+    # Index use_trans * 4 + noise * 2 + sss, see MaxFilterPlan.task
+    variants = tuple(task_plan(use_trans, noise, sss)
+                     for use_trans in (False, True)
+                     for noise in (False, True)
+                     for sss in (False, True))
+
+    tasks_to_run = sorted(set(trans_conditions + sss_files + empty_room_files))
+    tasks_to_run = tuple(t for t in tasks_to_run if t != '')
+
+    return MaxFilterPlan(
+        data_root=data_root,
+        output_path=output_path,
+        maxfilter_path=parameters.get('maxfilter_version'),
+        engine=parameters.get('engine') or 'maxfilter',
+        merge_runs=parameters.get('merge_runs'),
+        n_jobs=int(parameters.get('n_jobs') or 1),
+        headpos_chunk_duration=float(parameters.get('headpos_chunk_duration') or 0),
+        status_interval=float(parameters.get('status_interval', 60) or 0),
+        continous=continous,
+        trans_conditions=tuple(trans_conditions),
+        sss_files=tuple(sss_files),
+        empty_room_files=tuple(empty_room_files),
+        tasks_to_run=tasks_to_run,
+        variants=variants)
+
+def command_fingerprint(plan: MaxFilterPlan,
+                        task_plan: TaskPlan,
+                        file: str,
+                        trans_file: str):
+    """
+    Fingerprint of everything that determines a MaxFilter output.
+
+    Built from the normalized parameters of the task, the identity of the
+    MaxFilter binary (it has no cheap version query, so size and
+    modification time are used) and the identity of the input file. The
+    trans file content is included when -trans is used, since it changes
+    when the head position is recomputed.
+
+    Args:
+        plan (MaxFilterPlan, required): Compiled configuration.
+        task_plan (TaskPlan, required): Parameters of the task.
+        file (str, required): Absolute path to the input file.
+        trans_file (str, required): Average head position file of the task.
+
+    Returns:
+        dict: fingerprint with key 'hash' for quick comparison. For the
+            mne engine the MNE version replaces the binary identity.
+    """
+    params = [p.mxf for p in task_plan.parameters(trans_file)] + [task_plan.additional_cmd]
+    params = [' '.join(str(p).split()) for p in params if p]
+
+    fingerprint = {
+        'params': params,
+        'binary': file_fingerprint(plan.maxfilter_path),
+        'input': file_fingerprint(file)
+    }
+    if task_plan.use_trans:
+        fingerprint['trans'] = file_fingerprint(trans_file)
+    if plan.engine != 'maxfilter':
+        import mne
+        fingerprint['engine'] = plan.engine
+        fingerprint['binary'] = {'mne': mne.__version__}
+    fingerprint['hash'] = hash_fingerprint(fingerprint)
+    return fingerprint
+
+def output_name(file: str, task_plan: TaskPlan):
+    """Name of the MaxFilter output of a raw file name."""
+    clean = file.replace('.fif', f'_proc-{task_plan.proc}.fif')
+    if not re.search(r'raw|meg', clean):
+        clean = clean.replace('.fif', '_meg.fif')
+    return clean
+
+def maxfilter_command(plan: MaxFilterPlan,
+                      task_plan: TaskPlan,
+                      file: str,
+                      clean: str,
+                      trans_file: str):
+    """Command running the MaxFilter binary on a file."""
+    command_list = [
+        plan.maxfilter_path,
+        '-f %s' % file,
+        '-o %s' % clean,
+        *task_plan.mxf_options(trans_file),
+        '-v'
+        ]
+    command_mxf = ' '.join(command_list)
+    return re.sub(r'\\s+', ' ', command_mxf).strip()
+
+def raw_duration(file: str):
+    """Length of a raw file in seconds, None if it cannot be read."""
+    try:
+        return inventory.header(file).duration
+    except Exception:
+        return None
 
 class MaxFilter:
     
@@ -333,6 +1111,112 @@ class MaxFilter:
         parameters = config_dict['standard_settings'] | config_dict['advanced_settings']
 
         self.parameters = parameters
+        self.plan = compile_plan(parameters)
+        self.headpos_cache = HeadposCache()
+        self.pool = None
+        self.board = ProgressBoard(self.plan.status_interval)
+        self.report = ResourceReport()
+        self.plot_pool = None
+        self.plots = []
+        self.conversions = []
+
+    def _cache_key(self, context: TaskContext):
+        return self.headpos_cache.key(
+            [f'{context.data_path}/{file}' for file in context.files],
+            chunk_duration=self.plan.headpos_chunk_duration)
+
+    def task_headpos(self, context: TaskContext, out_path: str, task: str, overwrite=False):
+        """Head position stage, computes or links {task}_headpos.pos."""
+        from mne.chpi import read_head_pos
+        headpos_name = f"{out_path}/{task}_headpos.pos"
+        cache = self.headpos_cache
+        cache_key = self._cache_key(context)
+
+        if not exists(headpos_name) or overwrite:
+            cached = cache.get(cache_key, 'headpos')
+            if cached and not overwrite:
+                link_file(cached, headpos_name)
+                cache.register(headpos_name, cache_key, 'headpos')
+                context.head_pos = read_head_pos(headpos_name)
+                print(f"Linked cached headposition file to: {basename(headpos_name)}")
+            else:
+                print(f"Creating average head position for files: {' | '.join(context.files)}")
+                context.compute_head_pos(
+                    n_jobs=self.plan.n_jobs,
+                    chunk_duration=self.plan.headpos_chunk_duration,
+                    pos_file=headpos_name,
+                    pool=self.pool)
+                # No MaxMovement if no cHPI fit passed
+                movement = max_movement(context.head_pos, context.raw(context.files[0]).info['dev_head_t'])
+                meta = {} if movement is None else {'MaxMovement': movement}
+                cache.put(cache_key, 'headpos', headpos_name, **meta)
+                print(f"Wrote headposition file to: {basename(headpos_name)}")
+        else:
+            print(f'{basename(headpos_name)} already exists. Skipping...')
+            context.head_pos = read_head_pos(headpos_name)
+
+    def task_trans(self, context: TaskContext, out_path: str, task: str, overwrite=False):
+        """Average head position stage, computes or links {task}_trans.fif."""
+        from mne.transforms import invert_transform, read_trans, write_trans
+        trans_file = f"{out_path}/{task}_trans.fif"
+        cache = self.headpos_cache
+        cache_key = self._cache_key(context)
+
+        if not exists(trans_file) or overwrite:
+            cached = cache.get(cache_key, 'trans')
+            if cached and not overwrite:
+                link_file(cached, trans_file)
+                cache.register(trans_file, cache_key, 'trans')
+                context.mean_trans = read_trans(trans_file)
+                print(f'Linked cached trans file to {basename(trans_file)}')
+            else:
+                context.mean_trans = invert_transform(context.average_dev_head_t())
+                # Write to a new file, the old one may be hard linked to the cache
+                write_trans(f'{trans_file}.tmp.fif', context.mean_trans, overwrite=True)
+                os.replace(f'{trans_file}.tmp.fif', trans_file)
+                cache.put(cache_key, 'trans', trans_file)
+                print(f'Wrote trans file to {basename(trans_file)}')
+        
+        else:
+            print(f'{basename(trans_file)} already exists. Skipping...')
+            context.mean_trans = read_trans(trans_file)
+
+    def task_movement_plot(self, context: TaskContext, out_path: str, task: str, overwrite=False):
+        """
+        Movement plot stage, writes {task}_movement.png. Rendered in the
+        background by plot_pool if there is one, existing figures are skipped.
+        """
+        fig_name = f"{out_path}/{task}_movement.png"
+        if exists(fig_name) and not overwrite:
+            return
+        args = (context.raw(context.files[0]).info,
+                f"{out_path}/{task}_headpos.pos",
+                f"{out_path}/{task}_trans.fif",
+                fig_name)
+        if self.plot_pool is None:
+            render_movement_plot(*args)
+        else:
+            self.plots.append(self.plot_pool.submit(render_movement_plot, *args))
+
+    def start_plot_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.plot_pool = ProcessPoolExecutor(max_workers=1,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        self.plots = []
+
+    def finish_plot_pool(self):
+        """Wait for the movement plots still being rendered."""
+        if self.plot_pool is None:
+            return
+        for future in self.plots:
+            try:
+                print(f'Wrote movement plot {basename(future.result())}')
+            except Exception as e:
+                print(f'Movement plot failed: {e!r}')
+        self.plot_pool.shutdown(wait=True)
+        self.plot_pool = None
+        self.plots = []
     
     def create_task_headpos(self, 
                             data_path: str,
@@ -342,453 +1226,302 @@ class MaxFilter:
                             overwrite=False,
                             **kwargs):
 
-        parameters = self.parameters
+        context = TaskContext(data_path, files, merge_runs=self.plan.merge_runs == 'on')
+        self.task_headpos(context, out_path, task, overwrite)
+        self.task_trans(context, out_path, task, overwrite)
+        self.task_movement_plot(context, out_path, task, overwrite)
 
-        merge_headpos = parameters.get('merge_runs')
+    def file_head_pos(self, file: str, context: TaskContext=None):
+        """
+        Head positions of a raw file for movement compensation with the mne
+        engine, from the head position stage of its task or the cache.
 
-        headpos_name = f"{out_path}/{task}_headpos.pos"
-        trans_file = f"{out_path}/{task}_trans.fif"
-        fig_name = f"{out_path}/{task}_movement.png"
+        Args:
+            file (str, required): Path to the raw file.
+            context (TaskContext): Task of the file, if its head positions
+                are computed by the graph.
 
-        if not exists(headpos_name) or overwrite:
-            
-            if isinstance(files, str):
-                files = [files]
-            raws = [mne.io.read_raw_fif(
-                    f'{data_path}/{file}',
-                    allow_maxshield=True,
-                    verbose='error')
-                        for file in files]
-            
-            if merge_headpos == 'on' and len(files) > 1:
-                raws[0].info['dev_head_t'] = raws[1].info['dev_head_t']
-                raw = mne.concatenate_raws(raws)
-            else:
-                raw = raws[0]
-            print(f"Creating average head position for files: {' | '.join(files)}")
-            chpi_amplitudes = compute_chpi_amplitudes(raw)
-            chpi_locs = compute_chpi_locs(raw.info, chpi_amplitudes)
-            head_pos = compute_head_pos(raw.info, chpi_locs, verbose='error')
-            
-            write_head_pos(headpos_name, head_pos)
-            print(f"Wrote headposition file to: {basename(headpos_name)}")
-        else:
-            print(f'{basename(headpos_name)} already exists. Skipping...')
-        
-        if not exists(trans_file) or overwrite:
+        Returns:
+            array | str | None: head positions of the file, a cached head
+                position file, or None if they have to be computed.
+        """
+        if context is not None and context.head_pos is not None and basename(file) in context.files:
+            return context.file_head_pos()[context.files.index(basename(file))]
+        cache = self.headpos_cache
+        return cache.get(cache.key([file], chunk_duration=self.plan.headpos_chunk_duration), 'headpos')
+
+    def run_file(self,
+                 subject: str,
+                 session: str,
+                 task: str,
+                 file: str,
+                 subj_in: str=None,
+                 context: TaskContext=None):
+        """
+        MaxFilter stage of a single file, skipped if the output is up to
+        date with the current parameters.
 
-            if isinstance(files, str):
-                files = [files]
-            raws = [mne.io.read_raw_fif(
-                    f'{data_path}/{file}',
-                    allow_maxshield=True,
-                    verbose='error')
-                        for file in files]
-            
-            if merge_headpos == 'on' and len(files) > 1:
-                raws[0].info['dev_head_t'] = raws[1].info['dev_head_t']
-                raw = mne.concatenate_raws(raws)
+        Args:
+            subj_in (str): Directory of the raw file, defaults to the
+                session meg folder in data_root.
+            context (TaskContext): Task of the file, whose head positions
+                are used for movement compensation with the mne engine.
+        """
+        plan = self.plan
+        default_in, subj_out = plan.subject_paths(subject, session)
+        subj_in = subj_in or default_in
+        task_plan = plan.task(task)
+        trans_file = f'{subj_out}/{task}_trans.fif'
+
+        clean = output_name(file, task_plan)
+
+        # Test absolute path
+        file = f"{subj_in}/{file}"
+        clean = f"{subj_out}/{clean}"
+        log = f'{subj_out}/{'log'}/{basename(clean).replace(".fif",".log")}'
+
+        command_mxf = maxfilter_command(plan, task_plan, file, clean, trans_file)
+
+        manifest_file = f'{subj_out}/{'log'}/{basename(clean).replace(".fif",".json")}'
+        fingerprint = command_fingerprint(plan, task_plan, file, trans_file)
+        manifest = read_manifest(manifest_file)
+
+        if exists(clean) and not manifest:
+            # Output from before manifests were written, adopt it
+            # with the current parameters instead of reprocessing
+            print(f'No manifest for {basename(clean)}, recording current parameters')
+            if not debug:
+                write_manifest(manifest_file, fingerprint)
+            return clean
+
+        if exists(clean) and manifest.get('hash') == fingerprint['hash']:
+            print('''
+                Existing file: %s
+                Parameters unchanged, skipping
+                ''' % clean)
+            metrics.record_file('maxfilter', 'skipped')
+            return clean
+
+        if exists(clean):
+            print(f'Parameters changed since {basename(clean)} was created, rerunning')
+            metrics.retries.inc(stage='maxfilter', reason='parameters_changed')
+
+        print('''
+              Running Maxfilter on
+              Subject: %s
+              Session: %s
+              Task: %s
+              ''' % (subject, 
+                     session,
+                     task))
+        if debug:
+            if plan.engine == 'mne':
+                print(f'mne.preprocessing.maxwell_filter: {file} -> {clean}')
             else:
-                raw = raws[0]
+                print(f'{command_mxf} >> {log}')
+            return clean
+
+        # Remove stale output including split parts
+        for stale in [clean] + glob(clean.replace('.fif', '-[0-9]*.fif')):
+            if exists(stale):
+                os.remove(stale)
+        name = f'{subject}/{session}/{basename(file)}'
+        status = self.board.job(name, raw_duration(file))
+        usage = self.report.add(Usage('maxfilter', name))
+        self.board.start(status)
+        try:
+            # Read from the scratch copy if the raw data is staged
+            with staging.staged(file) as staged_file, limits.access(staged_file, clean):
+                if plan.engine == 'mne':
+                    options = task_plan.mne_options(trans_file)
+                    head_pos = self.file_head_pos(file, context) if task_plan.mc.mne_mxf else None
+                    mne_args = (staged_file, clean, options, log, head_pos, plan.headpos_chunk_duration)
+                    if self.pool is None:
+                        with measure(usage):
+                            run_mne_maxfilter(*mne_args)
+                    else:
+                        # Measured in the worker process, which runs only this job
+                        _, measured = self.pool.submit(
+                            call_measured, usage, run_mne_maxfilter, *mne_args).result()
+                        vars(usage).update(vars(measured))
+                else:
+                    command = maxfilter_command(plan, task_plan, staged_file, clean, trans_file)
+                    returncode = run_streamed(shlex.split(command), subj_in, log, status,
+                                              ProcessSampler(usage))
+                    if returncode != 0:
+                        raise RuntimeError(f'MaxFilter failed on {basename(file)} ({returncode}), see {log}')
+                # Read and written by MaxFilter or MNE, see iolimits.py
+                limits.charge(*split_parts(staged_file), *split_parts(clean))
+            if not exists(clean):
+                raise RuntimeError(f'MaxFilter did not write {clean}, see {log}')
+        except Exception:
+            usage.status = 'failed'
+            self.board.finish(status, ok=False)
+            for line in status.errors[-5:]:
+                print(f'  {line}')
+            metrics.record_file('maxfilter', 'failed', usage)
+            raise
+        self.board.finish(status)
+        write_manifest(manifest_file, fingerprint)
+        metrics.record_file('maxfilter', 'ok', usage)
+        return clean
+
+    def add_session_jobs(self, graph: JobGraph, subject: str, session: str):
+        """
+        Add the jobs of all tasks found in a subject and session directory
+        to a job graph.
 
-            head_pos = read_head_pos(headpos_name)
-            # trans, rot, t = head_pos_to_trans_rot_t(head_pos) 
+        Returns:
+            list: names of the MaxFilter jobs of the session.
+        """
+        plan = self.plan
+        subj_in, subj_out = plan.subject_paths(subject, session)
 
-            mean_trans = invert_transform(
-                compute_average_dev_head_t(raw, head_pos))
-            
-            write_trans(trans_file, mean_trans, overwrite=True)
-            print(f'Wrote trans file to {basename(trans_file)}')
-        
-        else:
-            print(f'{basename(trans_file)} already exists. Skipping...')
-        
-        if not exists(fig_name) or overwrite:
-            plot_movement(raw, headpos_name, trans_file).savefig(fig_name)
+        # List all files in directory
+        with span('scan', f'{subject}/{session}'):
+            all_fifs = sorted(inventory.glob('*.fif', root_dir=subj_in))
 
-    def set_params(self, subject, session, task):
-        
-        parameters = self.parameters
-        """_summary_
+        maxfilter_jobs = []
+        for task in plan.tasks_to_run:
 
-        Args:
-            subject (str): _description_
-            task (str): _description_
-        """
+            files = match_task_files(all_fifs, task)
             
-        data_root = os.path.join(parameters.get('data_path'),
-                                 parameters.get('project_name'))
-        output_path = parameters.get('output_path')
-        # Check if output path is set
-        if not output_path:
-            output_path = data_root
-
-        subj_path = f'{output_path}/{subject}/{session}/meg'
-        trans_file = f'{subj_path}/{task}_trans.fif'
-        trans_conditions = parameters.get('trans_conditions')
-        trans_option = parameters.get('trans_option')
-
-        def set_trans(param=None):
-            if 'continous' in trans_option and task in trans_conditions:
-                if param:
-                    mxf = '-trans %s' % param
-                    mne_mxf = '--trans=%s' % param
-                    string = 'avgHead'
-            else:
-                mxf=''
-                mne_mxf = ''
-                string = ''
-                print('No information about trans')
-                #sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _trans = set_trans(trans_file)
-        
-        # create set_force function
-        def set_force(param=None):
-            if param == 'on':
-                mxf = '-force'
-            elif param == 'off':
-                mxf = ''
-            else:
-                print('faulty "force" setting (must be on or off)')
-                sys.exit(1)
-            return(mxf)
-        _force = set_force(parameters.get('force'))
-        
-        def set_cal(param=None):
-            if param:
-                mxf = '-cal %s' % param
-                mne_mxf = '--calibration=%s' % param
-                string = 'cal_'
-            else:
-                print('no "cal" file found')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _cal = set_cal(parameters.get('cal'))
-        
-        def set_ctc(param=None):
-            if param:
-                mxf = '-ctc %s' % param
-                mne_mxf = '--cross_talk=%s' % param
-                string = 'ctc_'
-            else:
-                print('no "ctc" file found')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _ctc = set_ctc(parameters.get('ctc'))
-        
-        # create set_mc function (sets movecomp according to wishes above and abort if set incorrectly, this is a function such that it can be changed throughout the script if empty_room files are found) 
-        def set_mc(param=None):
-            if param == 'on':
-                mxf = '-movecomp'
-                mne_mxf = '--movecomp'
-                string='mc'
-            elif param == 'off':
-                mxf = ''
-                mne_mxf = ''
-                string = ''
-            else:
-                print('faulty "movecomp" setting (must be on or off)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _mc = set_mc(parameters.get('movecomp_default'))
-        # If empty room file set tsss off and remove trans and headpos
-        if file_contains(task, noise_patterns):
-            _mc.mxf = ''
-            _mc.mne_mxf = ''
-            _mc.string = ''
-
-        # create set_tsss function
-        def set_tsss(param=None):
-            if param == 'on':
-                mxf = '-st'
-                mne_mxf='--st'
-                string='tsss'
-            elif param == 'off':
-                mxf = ''
-                mne_mxf=''
-                string=''
-            else:
-                print('faulty "tsss" setting (must be on or off)')
-                sys.exit(1)
-            return(set_parameter(mxf,mne_mxf, string))
-        _tsss = set_tsss(parameters.get('tsss_default'))
-        
-        # create set_ds function
-        def set_ds(param=None):
-            if param == 'on':
-                if int(parameters.get('downsample_factor')) > 1:
-                    mxf = '-ds %s' % parameters.get('downsample_factor')
-                    mne_mxf = ''
-                    string = 'dsfactor-%s_' % \
-                        parameters.get('downsample_factor')
-                else:
-                    print('downsampling factor must be an INTEGER greater than 1')
-            elif param == 'off':
-                mxf = ''
-                mne_mxf = ''
-                string=''
-            else:
-                print('faulty "downsampling" setting (must be on or off)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _ds = set_ds(parameters.get('downsample'))
-
-        def set_corr(param=None):
-            if param:
-                mxf = '-corr %s' % param
-                mne_mxf = '--corr=%s' % param
-                string = 'corr %s_' % \
-                    round(float(param)*100)
-            elif not param:
-                mxf = ''
-                mne_mxf= ''
-                string=''
-            else:
-                print('faulty "correlation" setting (must be between 0 and 1)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _corr = set_corr(parameters.get('correlation'))
-
-        # set linefreq according to wishes above and abort if set incorrectly
-        def set_linefreq(param=None):
-            if param == 'on':
-                mxf = '-linefreq %s' % parameters.get('linefreq_Hz')
-                mne_mxf = '--linefreq %s' % parameters.get('linefreq_Hz')
-                string = 'linefreq-%s_' % parameters.get('linefreq_Hz')
-            elif param == 'off':
-                mxf = ''
-                mne_mxf = ''
-                string = ''
-            else:
-                print('faulty "apply_linefreq" setting (must be on or off)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _linefreq = set_linefreq(parameters.get('apply_linefreq'))
-
-        # Set autobad parameters
-        def set_autobad(param=None):
-            if param == 'on':
-                mxf = '-autobad %s -badlimit %s' % (param, parameters.get('badlimit'))
-                mne_mxf = '--autobad=%s' % parameters.get('badlimit')
-                string = 'autobad_%s' % param
-            elif param == 'off':
-                mxf = '-autobad %s' % param
-                mxf = '--autobad %s' % param
-                string = ''
-            else:
-                print('faulty "autobad" setting (must be on or off)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _autobad = set_autobad(parameters.get('autobad'))
-
-        def set_bad_channels(param=None):
-            if param:
-                if isinstance(param, list):
-                    bad_ch = ' '.join(param)
-                else:
-                    bad_ch = param
-                mxf = '-bad %s' % bad_ch
-                mne_mxf = '--bad %s' % bad_ch
-                string = '_bad_%s' % bad_ch
-            elif not param:
-                mxf = ''
-                mne_mxf= ''
-                string=''
-            else:
-                print('faulty "bad_channels" setting (must be comma separated list)')
-                sys.exit(1)
-            return(set_parameter(mxf, mne_mxf, string))
-        _bad_channels = set_bad_channels(parameters.get('bad_channels'))
+            if not files:
+                print(f'No files found for task: {task}')
+                continue
 
-        tsss_default = parameters.get('tsss_default')
-        
-        if task in parameters.get('sss_files'):
-            tsss_default = 'off'
-
-        def set_bids_proc():
-            proc = []
-            if tsss_default == 'on':
-                proc.append(_tsss.string)
-                if parameters.get('correlation'):
-                    proc.append(f'corr{round(float(parameters.get('correlation'))*100)}')
-            else:
-                proc.append('sss')
+            maxfilter_jobs += self.add_task_jobs(graph, subject, session, task, files)
 
-            if parameters.get('movecomp_default') == 'on':
-                proc.append(_mc.string)
-            
-            if 'continous' in trans_option and task in parameters.get('trans_conditions'):
-                proc.append(_trans.string)
-            
-            proc = [p for p in proc if p != '']
+        return maxfilter_jobs
 
-            return('+'.join(proc))
-        _proc = set_bids_proc()
-        
-        _merge_runs = parameters.get('merge_runs')
-        _additional_cmd = parameters.get('MaxFilter_commands')
-
-        self._trans = _trans
-        self._force = _force
-        self._cal = _cal
-        self._ctc = _ctc
-        self._ds = _ds
-        self._tsss = _tsss
-        self._corr = _corr
-        self._mc = _mc
-        self._autobad = _autobad
-        self._bad_channels = _bad_channels
-        self._linefreq = _linefreq
-        self._proc = _proc
-        self._merge_runs = _merge_runs
-        self._additional_cmd = _additional_cmd
+    def add_task_jobs(self,
+                      graph: JobGraph,
+                      subject: str,
+                      session: str,
+                      task: str,
+                      files: list,
+                      subj_in: str=None):
+        """
+        Add the head position, average trans, movement plot and MaxFilter
+        jobs of a task to a job graph.
 
-    def run_command(self, subject, session):
+        Args:
+            files (list, required): Raw file names of the task, in run order.
+            subj_in (str): Directory of the raw files, defaults to the
+                session meg folder in data_root.
 
-        parameters = self.parameters
+        Returns:
+            list: names of the MaxFilter jobs of the task.
+        """
+        plan = self.plan
+        default_in, subj_out = plan.subject_paths(subject, session)
+        subj_in = subj_in or default_in
 
-        data_root = os.path.join(parameters.get('data_path'),
-                                 parameters.get('project_name'))
-        output_path = parameters.get('output_path')
-        # Check if output path is set
-        if not output_path:
-            output_path = data_root
- 
-        subj_in = f'{data_root}/{subject}/{session}/meg'
-        subj_out = f'{output_path}/{subject}/{session}/meg'
-        
         # Create log directory if it doesn't exist
         os.makedirs(f'{subj_out}/{'log'}', exist_ok=True)
-        
-        maxfilter_path = parameters.get('maxfilter_version')
-
-        # List all files in directory
-        all_fifs = sorted(glob('*.fif', root_dir=subj_in))
-
-        # Create patterns to exclude files
-        
-        naming_convs = [
-            'raw',
-            'meg'
-        ]
-        naming_conv = re.compile(r'|'.join(naming_convs))
-        
-        trans_files = parameters.get('trans_conditions')
-        sss_files = parameters.get('sss_files')
-        empty_room_files = parameters.get('empty_room_files')
-
-        if isinstance(trans_files, str):
-            trans_files = [trans_files]
-        if isinstance(sss_files, str):
-            sss_files = [sss_files]
-        if isinstance(empty_room_files, str):
-            empty_room_files = [empty_room_files]
-
-        tasks_to_run = sorted(list(set(
-            trans_files +
-            sss_files +
-            empty_room_files)))
-        
-        # Remove if empty
-        tasks_to_run = [t for t in tasks_to_run if t != '']
 
-        for task in tasks_to_run:
+        print(f'''
+            Processing task: {task}
+            Using files: 
+                {'\n'.join(files)}
+            ''')
+
+        # Average head position
+        # TODO: make transname absolute path, or try relative path?
+        staging.queue(f'{subj_in}/{file}' for file in files)
+        deps = []
+        context = None
+        if task in plan.trans_conditions:
+            context = TaskContext(subj_in, files, merge_runs=plan.merge_runs == 'on')
+            name = f'{subject}/{session}/{task}'
+            headpos = graph.add(f'headpos:{name}', self.task_headpos,
+                                context, subj_out, task)
+            trans = graph.add(f'trans:{name}', self.task_trans,
+                              context, subj_out, task, deps=[headpos])
+            graph.add(f'plot:{name}', self.task_movement_plot,
+                      context, subj_out, task, deps=[trans])
+            deps = [trans]
+
+        return [graph.add(f'maxfilter:{subject}/{session}/{file}', self.run_file,
+                          subject, session, task, file, subj_in, deps=deps, context=context)
+                for file in files]
+
+    def run_graph(self, graph: JobGraph):
+        """
+        Run a job graph with the shared worker processes and the movement
+        plot process, then write the conversion tables of the BIDS session
+        jobs and the resource report.
 
-            files = match_task_files(all_fifs, task)
-            
-            if not files:
-                print(f'No files found for task: {task}')
-                continue
-            
-            print(f'''
-                Processing task: {task}
-                Using files: 
-                    {'\n'.join(files)}
-                ''')
-
-            # Average head position
-            # TODO: make transname absolute path, or try relative path?
-            if task in trans_files:
-                self.create_task_headpos(subj_in, subj_out, task, files, overwrite=False)
-
-            self.set_params(subject, session, task)
-            
-            _proc = self._proc
-            
-            for file in files:
-
-                clean = file.replace('.fif', f'_proc-{_proc}.fif')
-                ncov = naming_conv.search(clean)
-                
-                if not ncov:
-                    clean = clean.replace('.fif', '_meg.fif')
-
-                # Test absolute path
-                file = f"{subj_in}/{file}"
-                clean = f"{subj_out}/{clean}"
-                log = f'{subj_out}/{'log'}/{basename(clean).replace(".fif",".log")}'
-
-                command_list = []
-                command_list.extend([
-                    maxfilter_path,
-                    '-f %s' % file,
-                    '-o %s' % clean,
-                    self._cal.mxf,
-                    self._ctc.mxf,
-                    self._trans.mxf,
-                    self._tsss.mxf,
-                    self._ds.mxf,
-                    self._corr.mxf,
-                    self._mc.mxf,
-                    self._autobad.mxf,
-                    self._bad_channels.mxf,
-                    self._linefreq.mxf,
-                    self._force,
-                    self._additional_cmd,
-                    '-v',
-                    '| tee -a %s' % log
-                    ])
-                self.command_mxf = ' '.join(command_list)
-                self.command_mxf = re.sub(r'\\s+', ' ', self.command_mxf).strip()
-
-                if not exists(clean):
-                    print('''
-                          Running Maxfilter on
-                          Subject: %s
-                          Session: %s
-                          Task: %s
-                          ''' % (subject, 
-                                 session,
-                                 task))
-                    if not debug:
-                        subprocess.run(self.command_mxf, shell=True, cwd=subj_in)
-                    else:
-                        print(self.command_mxf)
+        Returns:
+            dict: number of jobs per final status
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        # Worker processes of the MNE engine and the head positions, shared
+        # by all jobs so that at most n_jobs of them run at a time. Also
+        # started in debug mode, which still computes the head positions.
+        self.pool = ProcessPoolExecutor(max_workers=self.plan.n_jobs,
+                                        max_tasks_per_child=1)
+        self.start_plot_pool()
+        try:
+            with self.board:
+                summary = graph.run(self.plan.n_jobs)
+        finally:
+            self.finish_plot_pool()
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+            # Once for all sessions, also if the run failed or was stopped
+            for conversion in self.conversions:
+                conversion.save()
+            self.conversions = []
+            self.write_report()
+        print(f'Finished: {summary}')
+        return summary
 
-                else:
-                    print('''
-                        Existing file: %s
-                        Delete to rerun MaxFilter process
-                        ''' % clean)
+    def run_command(self, subject, session):
+        graph = JobGraph()
+        self.add_session_jobs(graph, subject, session)
+        self.run_graph(graph)
 
         # os.chdir(default_base_path)
 
-    def loop_dirs(self):
-        """Iterates over the subject and session directories and maxfilter.
+    def write_report(self):
+        """Write the resources used by each MaxFilter run and print the slowest."""
+        ts = datetime.now().strftime('%Y%m%d')
+        self.report.write(f'{self.plan.output_path}/log/{ts}_maxfilter_resources.tsv')
+        self.report.summary()
+        self.report = ResourceReport()
 
-        This method loops through the subject and session directories in the specified data root directory.
-        It performs specific tasks on the files found in each directory.
+    def session_conversion(self, bids_config: dict=None, conversion_file: str=None):
+        """
+        Conversion table of the BIDS session jobs of a graph, written when
+        run_graph is done. None without bids_config.
+        """
+        if not bids_config:
+            return None
+        from bidsify import SessionConversion
+        conversion = SessionConversion(bids_config, conversion_file)
+        self.conversions.append(conversion)
+        return conversion
+
+    def build_graph(self, bids_config: dict=None):
+        """
+        Job graph of all subject and session directories in data_root,
+        without running it.
+
+        Args:
+            bids_config (dict): BIDS configuration. If set, each session is
+                converted to BIDS as soon as its MaxFilter outputs exist.
 
         Returns:
-            None
+            JobGraph: the jobs of all sessions.
         """
         parameters = self.parameters
-        data_root = os.path.join(parameters.get('data_path'),
-                                 parameters.get('project_name'))
+        data_root = self.plan.data_root
         
-        subjects = sorted(glob('NatMEG*',
-                               root_dir=data_root))
+        with span('scan', data_root):
+            subjects = sorted(inventory.glob('NatMEG*',
+                                             root_dir=data_root))
         
         skip_subjects = parameters.get('subjects_to_skip')
 
@@ -796,12 +1529,78 @@ class MaxFilter:
 
         subjects = [s for s in subjects if s not in skip_subjects]
 
+        graph = JobGraph()
+        conversion = self.session_conversion(bids_config)
 
         # TODO: include only folders
         for subject in [s for s in subjects if isdir(f'{data_root}/{s}')]:
-            sessions = [s for s in sorted(glob('*', root_dir=f'{data_root}/{subject}')) if isdir(f'{data_root}/{subject}/{s}')]
+            with span('scan', subject):
+                sessions = [s for s in sorted(inventory.glob('*', root_dir=f'{data_root}/{subject}')) if isdir(f'{data_root}/{subject}/{s}')]
             for session in sessions:
-                self.run_command(subject, session)
+                maxfilter_jobs = self.add_session_jobs(graph, subject, session)
+                if conversion:
+                    # BIDS conversion shares the conversion table, one at a time
+                    graph.add(f'bids:{subject}/{session}', conversion.convert,
+                              subject, session,
+                              deps=maxfilter_jobs, lock='bids')
+
+        return graph
+
+    def loop_dirs(self, bids_config: dict=None):
+        """Iterates over the subject and session directories and maxfilter.
+
+        This method loops through the subject and session directories in the specified data root directory.
+        All work is added to a job graph, which runs each job as soon as the
+        jobs it depends on are done.
+
+        Args:
+            bids_config (dict): BIDS configuration. If set, each session is
+                converted to BIDS as soon as its MaxFilter outputs exist.
+
+        Returns:
+            dict: number of jobs per final status
+        """
+        return self.run_graph(self.build_graph(bids_config))
+
+    def loop_conversion_table(self, conversion_file: str, bids_config: dict=None):
+        """
+        Run MaxFilter on the raw files listed in a bidsify conversion table
+        instead of searching the data directory.
+
+        Files are assigned to the configured tasks and added to a job graph
+        per participant, session and task.
+
+        Args:
+            conversion_file (str, required): Conversion table (tsv).
+            bids_config (dict): BIDS configuration. If set, each session is
+                converted to BIDS as soon as its MaxFilter outputs exist.
+
+        Returns:
+            dict: number of jobs per final status
+        """
+        plan = self.plan
+        with span('scan', basename(conversion_file)):
+            df = import_conversion_table(conversion_file, plan.tasks_to_run)
+        df = df[df['run_maxfilter'] == 'yes']
+
+        skip_subjects = self.parameters.get('subjects_to_skip') or []
+        df = df[~df['participant_from'].isin(skip_subjects)]
+
+        graph = JobGraph()
+        conversion = self.session_conversion(bids_config, conversion_file)
+        for (subject, session), session_df in df.groupby(['participant_from', 'session_from'], sort=True):
+            subject, session = str(subject), str(session)
+            maxfilter_jobs = []
+            for (task, subj_in), task_df in session_df.groupby(['maxfilter_task', 'raw_path'], sort=False):
+                files = sorted(task_df['raw_name'])
+                maxfilter_jobs += self.add_task_jobs(graph, subject, session, task, files, subj_in)
+            if conversion:
+                # BIDS conversion shares the conversion table, one at a time
+                graph.add(f'bids:{subject}/{session}', conversion.convert,
+                          subject, session,
+                          deps=maxfilter_jobs, lock='bids')
+
+        return self.run_graph(graph)
 
 def args_parser():
     parser = argparse.ArgumentParser(description=
@@ -812,9 +1611,18 @@ def args_parser():
                                      
                                      ''',
                                      add_help=True,
-                                     usage='maxfilter [-h] [-c CONFIG] [-e]')
+                                     prog='maxfilter')
     parser.add_argument('-c', '--config', type=str, help='Path to the configuration file')
     parser.add_argument('-e', '--edit', action='store_true', help='Launch the UI for Maxfilter configuration')
+    parser.add_argument('--conversion', type=str, help='Path to a bidsify conversion table, run on the files it lists instead of searching the data directory')
+    parser.add_argument('-b', '--bids-config', type=str, help='Path to a BIDS configuration file, convert each session once its MaxFilter outputs exist')
+    parser.add_argument('--profile', action='store_true', help='Write a trace of the pipeline stages and a cProfile of the run to the log folder')
+    parser.add_argument('--metrics-file', type=str, help='Write metrics in Prometheus text format to this file while running')
+    parser.add_argument('--metrics-port', type=int, help='Serve metrics in Prometheus text format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--scratch', type=str, help='Copy raw files to this local directory once and read them from there')
+    parser.add_argument('--scratch-size', type=float, default=100, help='Largest size of the scratch directory in GB (default 100)')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of raw files copied to scratch ahead of processing (default 2)')
+    parser.add_argument('--io-limits', type=str, help='JSON file with limits on concurrent access and MB/s per storage mount, see iolimits.py')
     args = parser.parse_args()
     return args
 
@@ -836,8 +1644,36 @@ def main():
         with open(file_config, 'r') as f:
             config_dict = json.load(f)
 
+    bids_config = None
+    if args.bids_config:
+        with open(args.bids_config, 'r') as f:
+            bids_config = json.load(f)
+
     mf = MaxFilter(config_dict)
-    mf.loop_dirs()
+    if args.metrics_file or args.metrics_port is not None:
+        metrics.enable(args.metrics_file, args.metrics_port)
+    if args.profile:
+        profiler.enable()
+    if args.io_limits:
+        aliases = {'data_path': mf.parameters['data_path'], 'output_path': mf.plan.output_path}
+        if bids_config:
+            aliases |= {key: bids_config[key] for key in ['squidMEG', 'opmMEG', 'BIDS']}
+        limits.load(args.io_limits, aliases)
+    if args.scratch:
+        roots = [mf.plan.data_root]
+        if bids_config:
+            roots += [bids_config.get('squidMEG'), bids_config.get('opmMEG')]
+        staging.enable(args.scratch, args.scratch_size, args.prefetch, roots)
+    try:
+        if args.conversion:
+            mf.loop_conversion_table(args.conversion, bids_config)
+        else:
+            mf.loop_dirs(bids_config)
+    finally:
+        staging.close()
+        if args.profile:
+            ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+            profiler.write(f'{mf.plan.output_path}/log/{ts}_maxfilter_profile')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Counters, gauges and histograms of bidsify and MaxFilter runs, exported in
+the Prometheus text format to a file (e.g. for the node_exporter textfile
+collector) or served on a local HTTP endpoint.
+
+    files_total            Files converted or MaxFiltered, by tool and status
+    bytes_written_total    Bytes written, by tool
+    stage_seconds          Time per stage, from the spans of profiling.py
+    jobs                   Jobs of the running job graph per state, the
+                           waiting jobs are the queue depth
+    jobs_total             Finished jobs by stage and status
+    retries_total          Work done again, by stage and reason
+
+All metric names start with natmeg_. Nothing is exported unless enable()
+is called.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from profiling import profiler
+
+prefix = 'natmeg_'
+
+# Seconds, from a header read to a long MaxFilter run
+default_buckets = (0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300., 900., 3600.)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+
+def _number(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    A metric with values per label set.
+
+    Args:
+        name (str, required): Name without the natmeg_ prefix.
+        description (str, required): Shown as HELP in the export.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str):
+        self.name = prefix + name
+        self.description = description
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{_labels(labels)} {_number(value)}'
+                  for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple=default_buckets):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for name, labels, (counts, total) in super().samples():
+            cumulative = 0
+            for le, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{name}_bucket', labels | {'le': _number(le)}, cumulative))
+            samples.append((f'{name}_sum', labels, total))
+            samples.append((f'{name}_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    All metrics of the process and where they are exported to.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.file = None
+        self.server = None
+        self._lock = threading.Lock()
+
+    def add(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+    def write(self, file_name: str=None):
+        """Write the metrics to file_name, by default the file set in enable."""
+        file_name = file_name or self.file
+        if not file_name:
+            return
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        # Scrapers never see a partly written file
+        with self._lock:
+            with open(f'{file_name}.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(f'{file_name}.tmp', file_name)
+
+    def serve(self, port: int, host: str='127.0.0.1'):
+        """Serve the metrics on http://host:port/metrics in a daemon thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Serving metrics on http://{host}:{self.server.server_port}/metrics')
+        return self.server
+
+
+registry = Registry()
+
+files = registry.add(Counter('files_total', 'Files converted or MaxFiltered'))
+bytes_written = registry.add(Counter('bytes_written_total', 'Bytes written'))
+stage_seconds = registry.add(Histogram('stage_seconds', 'Time spent per stage'))
+jobs = registry.add(Gauge('jobs', 'Jobs of the running job graph per state'))
+jobs_finished = registry.add(Counter('jobs_total', 'Finished jobs'))
+retries = registry.add(Counter('retries_total', 'Work done again'))
+
+
+def _observe_stage(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def enable(file_name: str=None, port: int=None):
+    """
+    Start exporting the metrics.
+
+    Args:
+        file_name (str): Rewritten after every file and job.
+        port (int): Serve the metrics on localhost, 0 for any free port.
+    """
+    if _observe_stage not in profiler.observers:
+        profiler.observers.append(_observe_stage)
+    registry.file = file_name
+    if port is not None and registry.server is None:
+        registry.serve(port)
+    registry.write()
+
+
+def record_file(tool: str, status: str, usage=None):
+    """
+    Count a converted or MaxFiltered file, with the bytes written from its
+    resources.Usage, and update the export file.
+    """
+    files.inc(tool=tool, status=status)
+    if usage is not None and usage.write_mb:
+        bytes_written.inc(round(usage.write_mb * 1024**2), tool=tool)
+    registry.write()
+
+
+@contextmanager
+def recorded(tool: str, usage=None):
+    """Record the file of the block, as failed if the block raises."""
+    try:
+        yield
+    except BaseException:
+        record_file(tool, 'failed', usage)
+        raise
+    record_file(tool, 'ok', usage)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MaxFilter and BIDS conversion of a project in one process.
+
+The raw tree is walked once for the conversion table, the TRIUX recordings
+in it are MaxFiltered and every session is converted to BIDS as soon as its
+MaxFilter outputs exist, all in one job graph. Recordings without MaxFilter
+tasks (e.g. OPM) are converted afterwards and the sidecars updated.
+Directory listings, parsed file names and FIF headers are shared by both
+steps through inventory.py, head positions through the head position cache.
+
+    python natmeg.py --maxfilter-config=maxfilter_settings.json --bids-config=bids_config.json
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import metrics
+from inventory import inventory
+from profiling import profiler
+from staging import staging
+from iolimits import limits
+
+
+def run(maxfilter_config: dict, bids_config: dict, conversion_file: str=None):
+    """
+    Run MaxFilter and the BIDS conversion of a project.
+
+    Args:
+        maxfilter_config (dict, required): MaxFilter configuration.
+        bids_config (dict, required): BIDS configuration.
+        conversion_file (str): Conversion table, defaults to the latest,
+            which is created if there is none.
+
+    Returns:
+        dict: number of jobs of the job graph per final status.
+    """
+    from bidsify import (create_dataset_description, latest_conversion_file,
+                         bidsify, update_sidecars)
+    from maxfilter import MaxFilter
+
+    create_dataset_description(bids_config['BIDS'])
+    conversion_file = conversion_file or latest_conversion_file(bids_config)
+    print(f'Using conversion table {conversion_file}')
+
+    summary = MaxFilter(maxfilter_config).loop_conversion_table(conversion_file, bids_config)
+
+    # Files without MaxFilter jobs, e.g. OPM recordings and other tasks
+    tree = bidsify(bids_config, conversion_file)
+    update_sidecars(bids_config['BIDS'], tree)
+    inventory.summary()
+    return summary
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='''NatMEG pipeline
+
+                                     Runs MaxFilter and the BIDS conversion of a project in one process.
+
+                                     ''',
+                                     add_help=True)
+    parser.add_argument('-m', '--maxfilter-config', type=str, required=True, help='Path to the MaxFilter configuration file')
+    parser.add_argument('-b', '--bids-config', type=str, required=True, help='Path to the BIDS configuration file')
+    parser.add_argument('--conversion', type=str, help='Path to the conversion file, defaults to the latest')
+    parser.add_argument('--profile', action='store_true', help='Write a trace of the pipeline stages and a cProfile of the run to conversion_logs')
+    parser.add_argument('--metrics-file', type=str, help='Write metrics in Prometheus text format to this file while running')
+    parser.add_argument('--metrics-port', type=int, help='Serve metrics in Prometheus text format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--scratch', type=str, help='Copy raw files to this local directory once and read them from there')
+    parser.add_argument('--scratch-size', type=float, default=100, help='Largest size of the scratch directory in GB (default 100)')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of raw files copied to scratch ahead of processing (default 2)')
+    parser.add_argument('--io-limits', type=str, help='JSON file with limits on concurrent access and MB/s per storage mount, see iolimits.py')
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+
+    with open(args.maxfilter_config, 'r') as f:
+        maxfilter_config = json.load(f)
+    with open(args.bids_config, 'r') as f:
+        bids_config = json.load(f)
+
+    if args.metrics_file or args.metrics_port is not None:
+        metrics.enable(args.metrics_file, args.metrics_port)
+    if args.profile:
+        profiler.enable()
+    if args.io_limits:
+        standard = maxfilter_config['standard_settings']
+        limits.load(args.io_limits,
+                    {'data_path': standard['data_path'], 'output_path': standard['output_path']}
+                    | {key: bids_config[key] for key in ['squidMEG', 'opmMEG', 'BIDS']})
+    if args.scratch:
+        # All raw files are found through the conversion table
+        staging.enable(args.scratch, args.scratch_size, args.prefetch,
+                       [bids_config['squidMEG'], bids_config['opmMEG']])
+    from bidsify import DeviantsError
+    try:
+        summary = run(maxfilter_config, bids_config, args.conversion)
+    except DeviantsError as e:
+        print(e)
+        return 1
+    finally:
+        staging.close()
+        if args.profile:
+            ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+            profiler.write(f"{bids_config['BIDS']}/conversion_logs/{ts}_natmeg_profile")
+    return 1 if summary.get('failed') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
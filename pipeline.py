@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Dependency-aware job graph used to run the MaxFilter and BIDS stages.
+
+Jobs are added in dependency order and run by a thread pool as soon as all
+the jobs they depend on are done. The heavy lifting of a job happens in a
+subprocess (MaxFilter) or in worker processes started by the job itself,
+so threads are enough to keep several jobs in flight.
+"""
+
+import traceback
+
+import metrics
+from profiling import span
+
+
+class Job:
+    """
+    A node in a JobGraph.
+
+    Args:
+        name (str, required): Unique name, e.g. 'maxfilter:NatMEG_0001/240101/rest_raw.fif'.
+        func (callable, required): Function to run.
+        args (tuple): Positional arguments of func.
+        kwargs (dict): Keyword arguments of func.
+        deps (list): Names of jobs that must be done before this one starts.
+        lock (str): Jobs sharing a lock never run at the same time.
+    """
+    def __init__(self, name, func, args=(), kwargs=None, deps=(), lock=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.lock = lock
+        self.status = 'waiting'
+        self.result = None
+        self.error = None
+
+    @property
+    def stage(self):
+        return self.name.split(':')[0]
+
+    def run(self):
+        with span(self.stage, self.name):
+            return self.func(*self.args, **self.kwargs)
+
+
+class JobGraph:
+    """
+    Jobs with file-level dependencies, run by JobGraph.run.
+    """
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, func, *args, deps=(), lock=None, **kwargs):
+        """
+        Add a job, dependencies must already be in the graph.
+
+        Returns:
+            str: name of the job, to be used in deps of later jobs.
+        """
+        if name in self.jobs:
+            return name
+        missing = [d for d in deps if d not in self.jobs]
+        if missing:
+            raise ValueError(f'{name} depends on unknown jobs: {", ".join(missing)}')
+        self.jobs[name] = Job(name, func, args, kwargs, deps, lock)
+        return name
+
+    def _skip_dependents(self, job, dependents, counts):
+        # Only the jobs that depend on the failed job, directly or not
+        stack = list(dependents[job.name])
+        while stack:
+            dependent = stack.pop()
+            if dependent.status != 'waiting':
+                continue
+            counts[dependent.status] -= 1
+            dependent.status = 'skipped'
+            counts['skipped'] += 1
+            metrics.jobs_finished.inc(stage=dependent.stage, status='skipped')
+            print(f'Skipping {dependent.name}, a dependency failed')
+            stack.extend(dependents[dependent.name])
+
+    def summary(self):
+        """
+        Returns:
+            dict: number of jobs per status.
+        """
+        summary = {}
+        for job in self.jobs.values():
+            summary[job.status] = summary.get(job.status, 0) + 1
+        return summary
+
+    def _update_metrics(self, counts):
+        for status in ['waiting', 'running', 'done', 'failed', 'skipped']:
+            metrics.jobs.set(counts.get(status, 0), state=status)
+        metrics.registry.write()
+
+    def run(self, n_jobs=1):
+        """
+        Run all jobs, at most n_jobs at a time, each as soon as its
+        dependencies are done. Jobs depending on a failed job are skipped.
+
+        Returns:
+            dict: number of jobs per final status.
+        """
+        import heapq
+        from collections import Counter, defaultdict
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        n_jobs = max(n_jobs, 1)
+        # Insertion order, ready jobs are started in this order
+        order = {name: i for i, name in enumerate(self.jobs)}
+        dependents = defaultdict(list)
+        # Dependencies of each job that are not done yet
+        remaining = {}
+        for job in self.jobs.values():
+            for d in job.deps:
+                dependents[d].append(job)
+            remaining[job.name] = sum(self.jobs[d].status != 'done' for d in job.deps)
+        counts = Counter(job.status for job in self.jobs.values())
+        for job in list(self.jobs.values()):
+            if job.status in ['failed', 'skipped']:
+                self._skip_dependents(job, dependents, counts)
+        ready = [(order[job.name], job.name) for job in self.jobs.values()
+                 if job.status == 'waiting' and remaining[job.name] == 0]
+        heapq.heapify(ready)
+        # Ready jobs waiting for a lock held by a running job
+        blocked = defaultdict(list)
+        running = {}
+        locks = set()
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            while True:
+                while ready and len(running) < n_jobs:
+                    _, name = heapq.heappop(ready)
+                    job = self.jobs[name]
+                    if job.lock and job.lock in locks:
+                        blocked[job.lock].append(name)
+                        continue
+                    counts['waiting'] -= 1
+                    job.status = 'running'
+                    counts['running'] += 1
+                    if job.lock:
+                        locks.add(job.lock)
+                    running[pool.submit(job.run)] = job
+                self._update_metrics(counts)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    if job.lock:
+                        locks.discard(job.lock)
+                        for name in blocked.pop(job.lock, []):
+                            heapq.heappush(ready, (order[name], name))
+                    try:
+                        job.result = future.result()
+                        job.status = 'done'
+                    except Exception as e:
+                        job.error = e
+                        job.status = 'failed'
+                        print(f'{job.name} failed: {e!r}')
+                        traceback.print_exception(e)
+                    counts['running'] -= 1
+                    counts[job.status] += 1
+                    metrics.jobs_finished.inc(stage=job.stage, status=job.status)
+                    if job.status == 'failed':
+                        self._skip_dependents(job, dependents, counts)
+                        continue
+                    for dependent in dependents[job.name]:
+                        remaining[dependent.name] -= 1
+                        if remaining[dependent.name] == 0 and dependent.status == 'waiting':
+                            heapq.heappush(ready, (order[dependent.name], dependent.name))
+
+        return self.summary()
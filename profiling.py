@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Timing spans around the pipeline stages, enabled with --profile.
+
+Stages are scan (directory walking), probe (FIF header reads), map (BIDS
+names), write (write_raw_bids), sidecar, staging (scratch copies), io_wait
+(waiting for a mount, see iolimits.py) and the job graph stages headpos,
+trans, plot, maxfilter and bids. Spans are exported as Chrome trace-event
+JSON, to be opened in chrome://tracing or https://ui.perfetto.dev, and the
+whole run is profiled with cProfile into a pstats file.
+
+Spans cost a function call when profiling and metrics are off. cProfile
+sees all threads of the process from Python 3.12, their calls are merged in
+the pstats file, the trace shows each thread on its own row.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Collects the spans of a run, a single instance (profiler) is shared by
+    all modules.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.perf_counter()
+        # Called with the stage and seconds of every span, e.g. by metrics
+        self.observers = []
+        self._lock = threading.Lock()
+        self._profile = None
+
+    def enable(self):
+        """Start collecting spans and profiling the process."""
+        import cProfile
+        self.enabled = True
+        self.events = []
+        self.origin = time.perf_counter()
+        self._profile = cProfile.Profile()
+        try:
+            self._profile.enable()
+        except ValueError:
+            # Another profiler or debugger is active
+            print('cProfile not available, only recording spans')
+            self._profile = None
+
+    def disable(self):
+        self.enabled = False
+        if self._profile is not None:
+            self._profile.disable()
+
+    @contextmanager
+    def span(self, stage: str, item: str='', **args):
+        """
+        Record the time spent in the block.
+
+        Args:
+            stage (str, required): Stage, e.g. 'scan' or 'write'.
+            item (str): What the stage works on, e.g. a file name.
+            args: Extra values shown in the trace viewer.
+        """
+        if not self.enabled and not self.observers:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(stage, item, start, time.perf_counter(), args)
+
+    def _record(self, stage, item, start, end, args):
+        for observer in self.observers:
+            observer(stage, end - start)
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        with self._lock:
+            self.events.append({
+                'name': item or stage,
+                'cat': stage,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6),
+                'dur': round((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args | {'thread': thread.name}
+            })
+
+    def trace(self):
+        """
+        Returns:
+            dict: spans in Chrome trace-event format, with thread names.
+        """
+        with self._lock:
+            events = list(self.events)
+        threads = {(e['pid'], e['tid']): e['args']['thread'] for e in events}
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                  'args': {'name': name}} for (pid, tid), name in threads.items()]
+        return {'traceEvents': names + events, 'displayTimeUnit': 'ms'}
+
+    def stage_totals(self):
+        """
+        Returns:
+            dict: number of spans and seconds per stage.
+        """
+        totals = defaultdict(lambda: [0, 0.])
+        with self._lock:
+            for event in self.events:
+                totals[event['cat']][0] += 1
+                totals[event['cat']][1] += event['dur'] / 1e6
+        return dict(totals)
+
+    def write(self, prefix: str):
+        """
+        Stop profiling and write {prefix}.trace.json and {prefix}.pstats.
+        """
+        self.disable()
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        with open(f'{prefix}.trace.json', 'w') as f:
+            json.dump(self.trace(), f)
+        print(f'Trace written to {prefix}.trace.json')
+        if self._profile is not None:
+            self._profile.dump_stats(f'{prefix}.pstats')
+            print(f'Profile written to {prefix}.pstats')
+
+        print('Time per stage (spans of threads overlap):')
+        for stage, (count, seconds) in sorted(self.stage_totals().items(),
+                                              key=lambda item: -item[1][1]):
+            print(f'  {stage}: {seconds:.2f} s in {count} spans')
+
+
+profiler = Profiler()
+span = profiler.span
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Run MaxFilter jobs with their output streamed to per-job log files and
+parsed for progress, detected bad channels and timing.
+
+Each job runs in a thread of the JobGraph, its stdout and stderr are read
+by an asyncio event loop of that thread, so concurrent jobs never write to
+the same console. A ProgressBoard collects the status of all jobs and
+reports per-job progress and the throughput of the whole batch.
+"""
+
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+# Patterns of MaxFilter -v output, the first group is the value of interest.
+# They are written against the stand-in output of fake_maxfilter.py, not a
+# captured log of the MaxFilter binary. Jobs whose output never matches
+# 'data_time' are reported as running without progress.
+patterns = {
+    # Processed data range, e.g. 'Processing ... 10.000 -- 20.000 s'
+    'data_time': re.compile(r'(?:\d+\.\d+)\s*(?:\.\.\.|--|-)\s*(\d+\.\d+)\s*s(?:ec)?\b'),
+    # Bad channels, e.g. 'Static bad channels (2): 1433 2511'
+    'bad_channels': re.compile(r'[Bb]ad\s+channels?[^:]*:\s*((?:\d{3,4}\s*)+)$'),
+    # Reported timing, e.g. 'Total CPU time 123.4 s'
+    'time': re.compile(r'(?i)(?:cpu|elapsed|total|processing)\s+time\D*(\d+(?:\.\d+)?)'),
+    'error': re.compile(r'(?i)\b(?:error|fatal|cannot|failed)\b'),
+}
+
+
+@dataclass
+class JobStatus:
+    """
+    Live status of a single MaxFilter job.
+
+    Args:
+        name (str, required): Job name.
+        duration (float): Length of the input data in seconds, used to
+            compute progress.
+    """
+    name: str
+    duration: float = None
+    state: str = 'waiting'
+    started: float = None
+    finished: float = None
+    data_time: float = 0.
+    bad_channels: set = field(default_factory=set)
+    reported_time: float = None
+    errors: list = field(default_factory=list)
+    returncode: int = None
+    lines: int = 0
+    has_progress: bool = False
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def progress(self):
+        if self.state == 'done':
+            return 1.
+        if not self.duration or not self.has_progress:
+            return None
+        return min(self.data_time / self.duration, 1.)
+
+    def parse_line(self, line: str):
+        """Update the status from a line of MaxFilter output."""
+        self.lines += 1
+        match = patterns['data_time'].search(line)
+        if match:
+            self.has_progress = True
+            self.data_time = max(self.data_time, float(match.group(1)))
+        match = patterns['bad_channels'].search(line)
+        if match:
+            self.bad_channels.update(f'MEG{int(ch):04d}' for ch in match.group(1).split())
+        match = patterns['time'].search(line)
+        if match:
+            self.reported_time = float(match.group(1))
+        if patterns['error'].search(line):
+            self.errors.append(line.strip())
+
+    def line(self):
+        progress = self.progress
+        text = f'{self.name}: {self.state}'
+        details = [f'{self.elapsed:.0f} s']
+        if self.state == 'running':
+            if progress is not None:
+                text += f' {progress:.0%}'
+            else:
+                # Output that never matched the progress pattern
+                text += ', no progress'
+                details.append(f'{self.lines} lines of output')
+        if self.bad_channels:
+            details.append(f'bad: {" ".join(sorted(self.bad_channels))}')
+        return f'{text} ({", ".join(details)})'
+
+
+class ProgressBoard:
+    """
+    Status of all MaxFilter jobs of a batch.
+
+    Args:
+        interval (float): Seconds between status reports while jobs are
+            running, 0 to only report at the end.
+    """
+    def __init__(self, interval: float=60.):
+        self.interval = interval
+        self.jobs = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reporter = None
+
+    def job(self, name: str, duration: float=None):
+        with self._lock:
+            if name not in self.jobs:
+                self.jobs[name] = JobStatus(name, duration)
+            return self.jobs[name]
+
+    def start(self, status: JobStatus):
+        status.state = 'running'
+        status.started = time.time()
+
+    def finish(self, status: JobStatus, ok: bool=True):
+        status.finished = time.time()
+        status.state = 'done' if ok else 'failed'
+        print(status.line())
+
+    def throughput(self):
+        """
+        Returns:
+            dict: number of jobs per state and seconds of data processed
+                per second of wall time for the whole batch.
+        """
+        with self._lock:
+            jobs = list(self.jobs.values())
+        states = {}
+        for status in jobs:
+            states[status.state] = states.get(status.state, 0) + 1
+        data_time = sum(
+            (status.duration or status.data_time) if status.state == 'done'
+            else status.data_time for status in jobs)
+        wall = time.time() - self.started
+        return states | {'data_s_per_s': round(data_time / wall, 2) if wall else 0.}
+
+    def report(self):
+        with self._lock:
+            running = [status for status in self.jobs.values() if status.state == 'running']
+        for status in running:
+            print(f'  {status.line()}')
+        print(f'MaxFilter progress: {self.throughput()}')
+
+    def _run_reporter(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        self.started = time.time()
+        self._stop.clear()
+        if self.interval:
+            self._reporter = threading.Thread(target=self._run_reporter, daemon=True)
+            self._reporter.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        if self.jobs:
+            self.report()
+
+
+async def _pipe_to_log(stream, log, status: JobStatus, prefix: str=''):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode(errors='replace')
+        log.write(prefix + text)
+        log.flush()
+        status.parse_line(text)
+
+
+async def _run(args: list, cwd: str, log_file: str, status: JobStatus, sampler=None):
+    import asyncio
+    with open(log_file, 'a') as log:
+        log.write(f'# {datetime.now().isoformat(timespec="seconds")} {" ".join(args)}\n')
+        process = await asyncio.create_subprocess_exec(
+            *args, cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        tasks = [_pipe_to_log(process.stdout, log, status),
+                 _pipe_to_log(process.stderr, log, status, prefix='stderr: ')]
+        if sampler is not None:
+            tasks.append(sampler.poll(process))
+        await asyncio.gather(*tasks)
+        return await process.wait()
+
+
+def run_streamed(args: list, cwd: str, log_file: str, status: JobStatus, sampler=None):
+    """
+    Run a command, appending its output to log_file and updating status
+    from every line of it.
+
+    Args:
+        args (list, required): Command and arguments, not run through a shell.
+        cwd (str, required): Working directory.
+        log_file (str, required): Per-job log file.
+        status (JobStatus, required): Status updated while the job runs.
+        sampler (resources.ProcessSampler): Records the resources used by
+            the command.
+
+    Returns:
+        int: return code of the command.
+    """
+    import asyncio
+    status.returncode = asyncio.run(_run(args, cwd, log_file, status, sampler))
+    return status.returncode
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-job resource accounting: wall time, CPU time, peak RSS and bytes read
+and written, for MaxFilter subprocesses and in-process work (bidsify rows,
+MNE maxwell_filter in worker processes).
+
+Subprocesses are sampled from /proc/<pid> while they run, in-process work
+is measured with getrusage and /proc. Where /proc is not available only
+wall and CPU time are recorded.
+
+Work in a thread of a process that runs other items at the same time
+(bidsify rows, jobs of the job graph) is measured per thread: CPU time
+and bytes read and written are those of the thread, the peak RSS is that
+of the whole process, as memory is shared by all threads. The scope
+column of the report tells which items were measured this way.
+"""
+
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from os.path import exists
+
+
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+@dataclass
+class Usage:
+    """Resources used by a single item of a run."""
+    stage: str
+    item: str
+    status: str = 'ok'
+    started: str = ''
+    wall_s: float = 0.
+    cpu_s: float = 0.
+    peak_rss_mb: float = None
+    read_mb: float = None
+    write_mb: float = None
+    # 'thread': CPU and IO of the thread, peak RSS of the process
+    scope: str = 'process'
+
+
+def _read_proc(pid, name):
+    try:
+        with open(f'/proc/{pid}/{name}') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def proc_io(pid='self'):
+    """Bytes read and written from storage, (None, None) if unavailable."""
+    text = _read_proc(pid, 'io')
+    if not text:
+        return None, None
+    values = dict(line.split(': ') for line in text.splitlines() if ': ' in line)
+    return int(values['read_bytes']), int(values['write_bytes'])
+
+
+def proc_peak_rss(pid='self'):
+    """Peak resident set size in MB (VmHWM), None if unavailable."""
+    text = _read_proc(pid, 'status') or ''
+    for line in text.splitlines():
+        if line.startswith('VmHWM:'):
+            return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def proc_cpu(pid):
+    """User and system CPU time of a process in seconds."""
+    text = _read_proc(pid, 'stat')
+    if not text:
+        return None
+    # Fields after the command name, which may contain spaces
+    values = text.rsplit(')', 1)[1].split()
+    return (int(values[11]) + int(values[12])) / clock_ticks
+
+
+def _mb(value):
+    return None if value is None else round(value / 1024**2, 2)
+
+
+@contextmanager
+def measure(usage: Usage, scope: str='thread'):
+    """
+    Measure the current thread while the block runs and fill usage.
+
+    Args:
+        usage (Usage, required): Item to fill.
+        scope (str): 'thread' for the CPU time and IO of the current
+            thread, 'process' for those of the whole process, e.g. a worker
+            process that runs only this item. The peak RSS is always that
+            of the process so far.
+    """
+    who, pid = resource.RUSAGE_SELF, 'self'
+    if scope == 'thread' and hasattr(resource, 'RUSAGE_THREAD'):
+        who, pid = resource.RUSAGE_THREAD, 'thread-self'
+    usage.scope = 'thread' if pid == 'thread-self' else 'process'
+    usage.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    start = time.time()
+    rusage = resource.getrusage(who)
+    io = proc_io(pid)
+    try:
+        yield usage
+    except BaseException:
+        usage.status = 'failed'
+        raise
+    finally:
+        end = resource.getrusage(who)
+        usage.wall_s = round(time.time() - start, 2)
+        usage.cpu_s = round(end.ru_utime + end.ru_stime
+                            - rusage.ru_utime - rusage.ru_stime, 2)
+        usage.peak_rss_mb = proc_peak_rss() or round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        io_end = proc_io(pid)
+        if io[0] is not None and io_end[0] is not None:
+            usage.read_mb = _mb(io_end[0] - io[0])
+            usage.write_mb = _mb(io_end[1] - io[1])
+
+
+def call_measured(usage: Usage, func, *args, **kwargs):
+    """
+    Run func under measure in a worker process that runs only this item,
+    measured as a whole including the threads started by func.
+
+    Returns:
+        tuple: result of func and the filled usage.
+    """
+    with measure(usage, scope='process'):
+        result = func(*args, **kwargs)
+    return result, usage
+
+
+class ProcessSampler:
+    """
+    Sample a subprocess from /proc while it runs.
+
+    The last sample is taken shortly before the process exits, so the
+    values can be slightly lower than the true totals.
+    """
+    def __init__(self, usage: Usage):
+        self.usage = usage
+        self.pid = None
+        self.start = None
+
+    def attach(self, pid: int):
+        self.pid = pid
+        self.start = time.time()
+        self.usage.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def sample(self):
+        usage = self.usage
+        cpu = proc_cpu(self.pid)
+        if cpu is not None:
+            usage.cpu_s = round(cpu, 2)
+        peak = proc_peak_rss(self.pid)
+        if peak is not None:
+            usage.peak_rss_mb = max(peak, usage.peak_rss_mb or 0)
+        read, write = proc_io(self.pid)
+        if read is not None:
+            usage.read_mb = _mb(read)
+            usage.write_mb = _mb(write)
+        usage.wall_s = round(time.time() - self.start, 2)
+
+    async def poll(self, process, interval: float=1.):
+        """Sample until the asyncio process has exited."""
+        import asyncio
+        self.attach(process.pid)
+        while process.returncode is None:
+            self.sample()
+            try:
+                await asyncio.wait_for(asyncio.shield(process.wait()), interval)
+            except asyncio.TimeoutError:
+                pass
+        self.usage.wall_s = round(time.time() - self.start, 2)
+        if process.returncode != 0:
+            self.usage.status = 'failed'
+
+
+class ResourceReport:
+    """
+    Collects Usage of all items of a run, written as a TSV table.
+    """
+    def __init__(self):
+        self.items = []
+        self._lock = threading.Lock()
+
+    def add(self, usage: Usage):
+        with self._lock:
+            self.items.append(usage)
+        return usage
+
+    @contextmanager
+    def measure(self, stage: str, item: str):
+        """Measure the block in the current process and add it to the report."""
+        usage = self.add(Usage(stage, item))
+        with measure(usage):
+            yield usage
+
+    def table(self):
+        import pandas as pd
+        with self._lock:
+            items = list(self.items)
+        return pd.DataFrame([asdict(u) for u in items],
+                            columns=[f.name for f in fields(Usage)])
+
+    def write(self, file_name: str):
+        """Append the items to a TSV report, with a header if it is new."""
+        if not self.items:
+            return
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.table().to_csv(file_name, sep='\t', index=False, mode='a',
+                            header=not exists(file_name))
+        print(f'Resource report written to {file_name}')
+
+    def summary(self, n: int=5):
+        """Print totals and the n slowest items."""
+        df = self.table()
+        if df.empty:
+            return
+        print(f'{len(df)} items, wall {df["wall_s"].sum():.0f} s, '
+              f'CPU {df["cpu_s"].sum():.0f} s, '
+              f'peak RSS {df["peak_rss_mb"].fillna(0).max():.0f} MB')
+        print('Slowest items:')
+        slowest = df.sort_values('wall_s', ascending=False).head(n)
+        for _, row in slowest.iterrows():
+            print(f'  {row["wall_s"]:8.1f} s  {row["stage"]}: {row["item"]} ({row["status"]})')
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local scratch copies of raw files on slow network mounts, enabled with
+--scratch.
+
+Raw files under the staged roots (the raw data directories of the
+configuration) are copied once to the scratch directory together with
+their split parts, and the head position, MaxFilter and BIDS stages read
+the copies. While a file is processed the next files queued by the job
+graph or the conversion table are copied in the background. The scratch
+directory is bounded in size, the least recently used recordings not in
+use are removed first. Copies are reused across runs while the size and
+modification time of the raw files are unchanged.
+
+Files outside the staged roots, e.g. in the BIDS folder, are read in place.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from glob import escape, glob
+
+from utils import hash_fingerprint, read_manifest, write_manifest
+from profiling import span
+from iolimits import limits
+
+
+def split_parts(file_name: str):
+    """A raw file and its split parts (name-1.fif, name-2.fif, ...)."""
+    if not file_name.endswith('.fif'):
+        return [file_name]
+    stem = file_name[:-len('.fif')]
+    parts = [f for f in glob(f'{escape(stem)}-*.fif') if f[len(stem) + 1:-len('.fif')].isdigit()]
+    return [file_name] + sorted(parts, key=lambda f: int(f[len(stem) + 1:-len('.fif')]))
+
+
+class Staging:
+    """
+    Scratch copies of raw files, a single instance (staging) is shared by
+    all modules and threads. Until enable() is called path() and staged()
+    return the file names unchanged.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.scratch = None
+        self.max_size = 0
+        self.n_prefetch = 0
+        self.roots = []
+        self.order = []
+        self.copied = 0
+        self.reused = 0
+        self.evicted = 0
+        self._index = {}
+        self._pins = {}
+        self._copies = {}
+        # Bytes of copies in progress
+        self._reserved = 0
+        self._lock = threading.RLock()
+        self._pool = None
+
+    def enable(self, path: str, max_size_gb: float=100, prefetch: int=2, roots: list=()):
+        """
+        Start staging raw files.
+
+        Args:
+            path (str, required): Scratch directory on a local disk.
+            max_size_gb (float): Largest total size of the copies.
+            prefetch (int): Number of queued files copied ahead.
+            roots (list): Directories of the raw files to stage.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.scratch = path
+        self.max_size = max_size_gb * 1024**3
+        self.n_prefetch = prefetch
+        self.add_roots(roots)
+        self._index = read_manifest(self._index_file())
+        # Copies removed outside of the pipeline
+        for source, entry in list(self._index.items()):
+            if not all(os.path.exists(f) for f in entry['files']):
+                del self._index[source]
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self.enabled = True
+        print(f'Staging raw files in {path} ({self.size() / 1024**3:.1f} of {max_size_gb} GB used)')
+
+    def add_roots(self, roots: list):
+        """Stage the raw files in these directories too."""
+        with self._lock:
+            self.roots += [os.path.abspath(root) for root in roots
+                           if root and os.path.abspath(root) not in self.roots]
+
+    def _index_file(self):
+        return os.path.join(self.scratch, 'index.json')
+
+    def _stageable(self, source: str):
+        return self.enabled and any(source.startswith(root + os.sep) for root in self.roots)
+
+    def size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._index.values())
+
+    def _current(self, source: str):
+        """Index entry of source if its copy is up to date."""
+        entry = self._index.get(source)
+        if not entry:
+            return None
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        if [stat.st_size, stat.st_mtime_ns] != entry['stat']:
+            return None
+        return entry
+
+    def _evict(self, needed: int):
+        """Remove least recently used copies until needed bytes fit."""
+        needed += self._reserved
+        entries = sorted(self._index.items(), key=lambda item: item[1]['last_used'])
+        for source, entry in entries:
+            if self.size() + needed <= self.max_size:
+                break
+            if self._pins.get(source) or source in self._copies:
+                continue
+            for f in entry['files']:
+                if os.path.exists(f):
+                    os.remove(f)
+            del self._index[source]
+            self.evicted += 1
+        return self.size() + needed <= self.max_size
+
+    def _copy(self, source: str):
+        """Copy source and its split parts, returns the local path or source."""
+        parts = split_parts(source)
+        needed = sum(os.path.getsize(f) for f in parts)
+        # Before copying, a file changing while copied is copied again later
+        stat = os.stat(source)
+        with self._lock:
+            if needed > self.max_size or not self._evict(needed):
+                print(f'{os.path.basename(source)} does not fit in {self.scratch}, reading in place')
+                return source
+            self._reserved += needed
+
+        # Parts keep their names, split files refer to each other by name
+        directory = os.path.join(self.scratch, hash_fingerprint(os.path.dirname(source))[:16])
+        files = []
+        try:
+            with span('staging', os.path.basename(source)), limits.access(source, directory):
+                os.makedirs(directory, exist_ok=True)
+                for part in parts:
+                    local = os.path.join(directory, os.path.basename(part))
+                    limits.copyfile(part, f'{local}.tmp')
+                    os.replace(f'{local}.tmp', local)
+                    files.append(local)
+        except OSError as e:
+            print(f'Could not stage {os.path.basename(source)}, reading in place: {e}')
+            for local in files:
+                os.remove(local)
+            return source
+        finally:
+            with self._lock:
+                self._reserved -= needed
+
+        with self._lock:
+            self._index[source] = {
+                'files': files,
+                'size': needed,
+                'stat': [stat.st_size, stat.st_mtime_ns],
+                'last_used': time.time()
+            }
+            self.copied += 1
+            write_manifest(self._index_file(), self._index)
+        return files[0]
+
+    def _local(self, source: str, prefetch=False):
+        """
+        Local path of source, copied now or by a running prefetch if needed.
+        """
+        with self._lock:
+            entry = self._current(source)
+            if entry:
+                if not prefetch:
+                    entry['last_used'] = time.time()
+                    self.reused += 1
+                return entry['files'][0]
+            future = self._copies.get(source)
+            owner = future is None
+            if owner:
+                future = self._copies[source] = Future()
+        if not owner:
+            return future.result()
+        try:
+            local = self._copy(source)
+        except OSError:
+            local = source
+        with self._lock:
+            del self._copies[source]
+        future.set_result(local)
+        return local
+
+    def queue(self, files):
+        """Files in the order they will be processed, for prefetching."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.order += [source for source in map(os.path.abspath, files)
+                           if self._stageable(source) and source not in self.order]
+
+    def _prefetch_after(self, source: str):
+        with self._lock:
+            if source not in self.order:
+                return
+            i = self.order.index(source)
+            for next_source in self.order[i + 1:i + 1 + self.n_prefetch]:
+                if not self._current(next_source) and next_source not in self._copies:
+                    self._pool.submit(self._local, next_source, prefetch=True)
+
+    def path(self, file_name: str):
+        """
+        Local copy of a raw file if it is staged, otherwise the file itself.
+        Does not copy, for reading headers.
+        """
+        source = os.path.abspath(file_name)
+        if not self._stageable(source):
+            return file_name
+        with self._lock:
+            entry = self._current(source)
+            return entry['files'][0] if entry else file_name
+
+    @contextmanager
+    def staged(self, file_name: str):
+        """
+        Local copy of a raw file, staged if needed and kept while the block
+        runs. Yields the file itself if it is not under a staged root or
+        cannot be copied.
+        """
+        source = os.path.abspath(file_name)
+        if not self._stageable(source):
+            yield file_name
+            return
+        with self._lock:
+            self._pins[source] = self._pins.get(source, 0) + 1
+        try:
+            local = self._local(source)
+            self._prefetch_after(source)
+            yield local
+        finally:
+            with self._lock:
+                self._pins[source] -= 1
+                if source in self._index:
+                    self._index[source]['last_used'] = time.time()
+
+    def close(self):
+        """Stop prefetching, save the index and print the summary."""
+        if not self.enabled:
+            return
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            write_manifest(self._index_file(), self._index)
+        print(f'Staging: {self.copied} copied, {self.reused} reused, {self.evicted} evicted, '
+              f'{self.size() / 1024**3:.1f} GB in {self.scratch}')
+
+
+staging = Staging()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Write the recording and reference outputs used by the tests.
+
+chpi_raw.fif is a small simulated recording with the layout of a Neuromag
+system: 51 sensor triplets (a magnetometer and two planar gradiometers) on
+a helmet, five cHPI coils and a digitized head. The head moves slowly
+during the 12 s recording. The reference outputs are computed from it
+with MNE directly:
+
+- chpi_raw_headpos.pos: head positions of the whole recording
+- chpi_raw_sss.fif: maxwell_filter with tSSS (10 s, correlation 0.98),
+  movement compensation and downsampling by 2, the options of the parity
+  test of maxfilter.py with engine 'mne'
+
+Run again only when the test data has to change:
+
+    python tests/data/make_test_data.py
+"""
+
+import os
+
+import numpy as np
+
+data_path = os.path.dirname(os.path.abspath(__file__))
+raw_file = f'{data_path}/chpi_raw.fif'
+headpos_file = f'{data_path}/chpi_raw_headpos.pos'
+sss_file = f'{data_path}/chpi_raw_sss.fif'
+
+sfreq = 200.
+duration = 12.
+hpi_freqs = [37., 43., 61., 67., 73.]
+
+
+def _frame(normal):
+    """Two unit vectors orthogonal to normal and to each other."""
+    ex = np.cross([0., 0., 1.] if abs(normal[2]) < 0.9 else [1., 0., 0.], normal)
+    ex /= np.linalg.norm(ex)
+    return ex, np.cross(normal, ex)
+
+
+def _sphere(n, radius, center, max_angle):
+    """n points spread over a spherical cap around +z."""
+    i = np.arange(n) + 0.5
+    polar = np.arccos(1 - (1 - np.cos(np.deg2rad(max_angle))) * i / n)
+    azimuth = np.pi * (1 + 5 ** 0.5) * i
+    return np.array(center) + radius * np.c_[np.sin(polar) * np.cos(azimuth),
+                                             np.sin(polar) * np.sin(azimuth),
+                                             np.cos(polar)]
+
+
+def make_info():
+    import mne
+    from mne._fiff._digitization import DigPoint
+    from mne.io.constants import FIFF
+    from mne.transforms import Transform, apply_trans, rotation
+
+    ch_names, ch_types, locs = [], [], []
+    for i, r in enumerate(_sphere(51, 0.12, [0., 0., 0.], 110.)):
+        ez = r / np.linalg.norm(r)
+        ex, ey = _frame(ez)
+        for suffix, ch_type, (x, y) in [('1', 'mag', (ex, ey)), ('2', 'grad', (ex, ey)),
+                                        ('3', 'grad', (ey, -ex))]:
+            ch_names.append(f'MEG{i + 1:03d}{suffix}')
+            ch_types.append(ch_type)
+            locs.append(np.concatenate([r, x, y, ez]))
+    info = mne.create_info(ch_names, sfreq, ch_types)
+    for ch, loc in zip(info['chs'], locs):
+        ch['loc'][:] = loc
+
+    # Head 4 cm below the helmet center, slightly rotated
+    dev_head_t = rotation(0.05, -0.03, 0.02)
+    dev_head_t[:3, 3] = [0.002, -0.004, -0.04]
+    dev_head_t = Transform('meg', 'head', np.linalg.inv(dev_head_t))
+    hpi = np.array([[-0.05, 0.07, 0.04], [0.05, 0.07, 0.04], [-0.07, -0.02, 0.06],
+                    [0.07, -0.02, 0.06], [0., -0.04, 0.09]])
+    head_shape = _sphere(40, 0.09, [0., 0., 0.02], 80.)
+    montage = mne.channels.make_dig_montage(
+        nasion=[0., 0.09, 0.], lpa=[-0.075, 0., 0.], rpa=[0.075, 0., 0.],
+        hpi=hpi, hsp=head_shape, coord_frame='head')
+    info.set_montage(montage)
+
+    head_dev = np.linalg.inv(dev_head_t['trans'])
+    dig_points = [DigPoint(kind=FIFF.FIFFV_POINT_HPI, ident=i + 1,
+                                                  r=apply_trans(head_dev, r),
+                                                  coord_frame=FIFF.FIFFV_COORD_UNKNOWN)
+                  for i, r in enumerate(hpi)]
+    with info._unlock():
+        info['dev_head_t'] = dev_head_t
+        info['line_freq'] = 50.
+        info['hpi_subsystem'] = None
+        info['hpi_meas'] = [dict(creator='make_test_data.py', sfreq=sfreq, nchan=len(ch_names),
+                                 nave=1, ncoil=len(hpi_freqs),
+                                 hpi_coils=[dict(number=i + 1, coil_freq=f)
+                                            for i, f in enumerate(hpi_freqs)])]
+        info['hpi_results'] = [dict(dig_points=dig_points,
+                                    order=np.arange(1, len(hpi) + 1),
+                                    used=np.arange(1, len(hpi) + 1),
+                                    moments=np.zeros((len(hpi), 3)),
+                                    goodness=np.ones(len(hpi)),
+                                    good_limit=0.98, dist_limit=0.005, accept=1,
+                                    coord_trans=dev_head_t)]
+    return info
+
+
+def make_raw():
+    import mne
+    from mne.transforms import rot_to_quat, rotation
+
+    rng = np.random.default_rng(0)
+    info = make_info()
+    n_times = int(duration * sfreq)
+    scale = np.where(np.array(info.get_channel_types()) == 'mag', 20e-15, 4e-13)
+    raw = mne.io.RawArray(scale[:, np.newaxis] * rng.standard_normal((len(scale), n_times)),
+                          info, verbose='error')
+
+    # Slow drift of a few mm and degrees away from the initial position
+    times = np.arange(0., duration, 0.1)
+    dev_head_t = raw.info['dev_head_t']['trans']
+    head_pos = []
+    for t in times:
+        move = rotation(0.03 * np.sin(t / 3), 0.02 * t / duration, 0.)
+        move[:3, 3] = [0.003 * np.sin(t / 2), 0.004 * t / duration, -0.002 * np.cos(t / 4)]
+        trans = dev_head_t @ move
+        head_pos.append(np.concatenate([[t], rot_to_quat(trans[:3, :3]), trans[:3, 3],
+                                        [1., 0., 0.]]))
+    mne.simulation.add_chpi(raw, np.array(head_pos), verbose='error')
+    return raw
+
+
+def main():
+    import mne
+
+    make_raw().save(raw_file, fmt='single', overwrite=True, verbose='error')
+
+    raw = mne.io.read_raw_fif(raw_file, verbose='error')
+    head_pos = mne.chpi.compute_head_pos(
+        raw.info, mne.chpi.compute_chpi_locs(
+            raw.info, mne.chpi.compute_chpi_amplitudes(raw, verbose='error'), verbose='error'),
+        verbose='error')
+    mne.chpi.write_head_pos(headpos_file, head_pos)
+
+    raw_sss = mne.preprocessing.maxwell_filter(
+        raw, st_duration=10., st_correlation=0.98, head_pos=head_pos,
+        coord_frame='head', origin='auto', verbose='error')
+    raw_sss.resample(raw_sss.info['sfreq'] / 2, verbose='error')
+    raw_sss.save(sss_file, fmt='single', overwrite=True, verbose='error')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import pandas as pd
+import pytest
+
+from bidsify import DeviantsError, bidsify
+from pipeline import JobGraph
+
+
+def conversion_row(bids_root, task, task_flag):
+    return {'time_stamp': '20250101', 'run_conversion': 'yes', 'task_count': '1',
+            'task_flag': task_flag, 'participant_from': 'NatMEG_0001',
+            'participant_to': '0001', 'session_from': '250101', 'session_to': '250101',
+            'task': task, 'split': None, 'run': None, 'datatype': 'eeg',
+            'acquisition': 'triux', 'processing': None, 'description': None,
+            'raw_path': f'{bids_root}/raw', 'raw_name': f'NatMEG_0001_{task}_eeg.fif',
+            'bids_path': f'{bids_root}/sub-0001/ses-250101/eeg',
+            'bids_name': f'sub-0001_ses-250101_task-{task}_acq-triux_eeg.fif'}
+
+
+@pytest.fixture
+def deviant_config(tmp_path):
+    bids_root = tmp_path / 'bids'
+    (bids_root / 'conversion_logs').mkdir(parents=True)
+    conversion_file = bids_root / 'conversion_logs' / '20250101_bids_conversion.tsv'
+    pd.DataFrame([conversion_row(bids_root, 'rest', 'ok'),
+                  conversion_row(bids_root, 'odd', 'check')]
+                 ).to_csv(conversion_file, sep='\t', index=False)
+    config = {'BIDS': str(bids_root), 'Calibration': '', 'Crosstalk': '',
+              'Overwrite': 'off'}
+    return config, str(conversion_file)
+
+
+def test_deviants_fail_only_their_job(deviant_config):
+    config, conversion_file = deviant_config
+    with pytest.raises(DeviantsError):
+        bidsify(config, conversion_file)
+
+    graph = JobGraph()
+    bids = graph.add('bids:NatMEG_0001/250101', bidsify, config, conversion_file)
+    graph.add('sidecars:NatMEG_0001/250101', lambda: None, deps=[bids])
+    graph.add('maxfilter:NatMEG_0002/250101', lambda: None)
+    assert graph.run(n_jobs=2) == {'failed': 1, 'skipped': 1, 'done': 1}
+
+
+def test_session_tasks_are_flagged_against_the_whole_table(tmp_path, monkeypatch):
+    import bidsify as bidsify_module
+
+    bids_root = tmp_path / 'bids'
+    (bids_root / 'conversion_logs').mkdir(parents=True)
+    conversion_file = bids_root / 'conversion_logs' / '20250101_bids_conversion.tsv'
+    rows = []
+    for participant in ['NatMEG_0001', 'NatMEG_0002']:
+        for run in ['1', '2']:
+            row = conversion_row(bids_root, 'rest', 'ok')
+            row.update(participant_from=participant, participant_to=participant[-4:],
+                       task_count='2', raw_name=f'{participant}_rest{run}_eeg.fif')
+            rows.append(row)
+    pd.DataFrame(rows).to_csv(conversion_file, sep='\t', index=False)
+    config = {'BIDS': str(bids_root)}
+
+    # A session with one rest file, the largest count of the session
+    new_row = conversion_row(bids_root, 'rest', 'ok')
+    new_row.update(participant_from='NatMEG_0003', participant_to='0003',
+                   task_count=1, split='', run='', processing='', description='')
+    monkeypatch.setattr(bidsify_module, 'generate_new_conversion_table',
+                        lambda *args, **kwargs: pd.DataFrame([new_row]))
+    converted = {}
+    monkeypatch.setattr(bidsify_module, 'bidsify',
+                        lambda *args, conversion_table, **kwargs: converted.update(table=conversion_table))
+
+    bidsify_module.bidsify_session(config, 'NatMEG_0003', '250101', str(conversion_file))
+    table = converted['table']
+    session = table[table['participant_from'] == 'NatMEG_0003']
+    assert list(session['task_count']) == ['1']
+    assert list(session['task_flag']) == ['check']
+    assert set(table.loc[table['participant_from'] != 'NatMEG_0003', 'task_flag']) == {'ok'}
+
+
+def test_session_conversion_checks_and_saves_only_once(tmp_path, monkeypatch):
+    import bidsify as bidsify_module
+    from inventory import inventory
+
+    bids_root = tmp_path / 'bids'
+    (bids_root / 'conversion_logs').mkdir(parents=True)
+    conversion_file = bids_root / 'conversion_logs' / '20250101_bids_conversion.tsv'
+    rows = []
+    for session in ['250101', '250102']:
+        for task in ['rest', 'aud']:
+            row = conversion_row(bids_root, task, 'ok')
+            row.update(session_from=session, run_conversion='no',
+                       raw_name=f'NatMEG_0001_{session}_{task}_eeg.fif')
+            rows.append(row)
+    pd.DataFrame(rows).to_csv(conversion_file, sep='\t', index=False)
+    config = {'BIDS': str(bids_root), 'Calibration': '', 'Crosstalk': '',
+              'Overwrite': 'off'}
+
+    monkeypatch.setattr(bidsify_module, 'generate_new_conversion_table',
+                        lambda *args, **kwargs: pd.DataFrame(columns=list(rows[0])))
+    checked = []
+    # Outputs of 250101/rest are missing
+    monkeypatch.setattr(inventory, 'glob',
+                        lambda pattern, root_dir: checked.append(pattern) or ([] if 'rest' in pattern else [pattern]))
+
+    conversion = bidsify_module.SessionConversion(config, str(conversion_file))
+    with pytest.raises(FileNotFoundError):
+        # The missing output is converted from a raw file that does not exist
+        conversion.convert('NatMEG_0001', '250101')
+    assert len(checked) == 2
+    assert pd.read_csv(conversion_file, sep='\t', dtype=str)['run_conversion'].tolist() == ['no'] * 4
+
+    conversion.save()
+    saved = pd.read_csv(conversion_file, sep='\t', dtype=str)
+    assert saved['run_conversion'].tolist() == ['yes', 'no', 'no', 'no']
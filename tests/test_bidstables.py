@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+import pytest
+
+mne_bids = pytest.importorskip('mne_bids')
+import mne_bids.write as mne_bids_write
+
+from bidstables import TableBuffer
+
+
+def scans(name):
+    return OrderedDict([('filename', [name]), ('acq_time', ['n/a'])])
+
+
+def test_only_the_thread_of_the_block_is_buffered(tmp_path):
+    scans_tsv = tmp_path / 'sub-01_ses-01_scans.tsv'
+    mne_bids_write._write_tsv(scans_tsv, scans('old.fif'), overwrite=True)
+    tables = TableBuffer()
+    original = mne_bids_write._write_tsv
+
+    with tables.buffered():
+        mne_bids_write._write_tsv(scans_tsv, scans('buffered.fif'), overwrite=True)
+        assert mne_bids_write._from_tsv(scans_tsv)['filename'] == ['buffered.fif']
+
+        read = []
+
+        def other_thread():
+            # Read from and written to disk
+            read.append(mne_bids_write._from_tsv(scans_tsv)['filename'])
+            mne_bids_write._write_tsv(scans_tsv, scans('other.fif'), overwrite=True)
+            read.append(mne_bids_write._from_tsv(scans_tsv)['filename'])
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        assert read == [['old.fif'], ['other.fif']]
+        assert mne_bids_write._from_tsv(scans_tsv)['filename'] == ['buffered.fif']
+
+    assert mne_bids_write._write_tsv is original
+    assert mne_bids_write._from_tsv(scans_tsv)['filename'] == ['buffered.fif']
+
+
+def test_blocks_run_one_at_a_time():
+    tables = TableBuffer()
+    events = []
+
+    def block(name):
+        with tables.buffered():
+            events.append(f'{name} start')
+            if name == 'first':
+                started.set()
+                release.wait(5)
+            events.append(f'{name} end')
+
+    started, release = threading.Event(), threading.Event()
+    first = threading.Thread(target=block, args=('first',))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=block, args=('second',))
+    second.start()
+    second.join(0.2)
+    release.set()
+    first.join()
+    second.join()
+    assert events == ['first start', 'first end', 'second start', 'second end']
+
+
+def test_unsupported_mne_bids_fails(monkeypatch):
+    tables = TableBuffer()
+    monkeypatch.setattr(mne_bids, '__version__', '0.99.0')
+    with pytest.raises(RuntimeError, match='not tested'):
+        with tables.buffered():
+            pass
+    monkeypatch.undo()
+
+    monkeypatch.delattr(mne_bids_write, '_write_tsv')
+    with pytest.raises(RuntimeError, match='missing or changed'):
+        with tables.buffered():
+            pass
@@ -0,0 +1,68 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Import time of a script run with --help, in seconds
+budget = 0.3
+heavy_modules = ['mne', 'pandas', 'tkinter']
+
+# Runs a script as __main__ and prints the modules imported until it exits
+run_script = '''
+import json, runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)))
+'''
+
+
+def import_time(stderr: str):
+    """Total of the top-level imports in the output of -X importtime, in seconds."""
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1e6
+
+
+@pytest.mark.parametrize('script', ['bidsify.py', 'maxfilter.py', 'natmeg.py'])
+def test_help_is_fast(script):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', run_script, script, '--help'],
+                            cwd=root, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    modules = json.loads(result.stdout.splitlines()[-1])
+    assert [m for m in heavy_modules if m in modules] == []
+    assert import_time(result.stderr) < budget
+
+
+@pytest.mark.parametrize('script', ['bidsify.py', 'maxfilter.py', 'natmeg.py'])
+def test_usage_lists_all_options(script):
+    result = subprocess.run([sys.executable, script, '--help'],
+                            cwd=root, capture_output=True, text=True, timeout=60)
+    usage, _, options = result.stdout.partition('options:')
+    # Option strings of each argument, e.g. ['-c', '--config']
+    arguments = [[name.split()[0] for name in line.strip().split('  ')[0].split(', ')]
+                 for line in options.splitlines() if line.strip().startswith('-')]
+    assert len(arguments) > 3
+    missing = [names for names in arguments
+               if not any(re.search(rf'(?<![\w-]){name}(?![\w-])', usage) for name in names)]
+    assert missing == []
+
+
+@pytest.mark.parametrize('script', ['bidsify.py', 'maxfilter.py', 'natmeg.py'])
+def test_usage_lists_profile(script):
+    result = subprocess.run([sys.executable, script, '--help'],
+                            cwd=root, capture_output=True, text=True, timeout=60)
+    usage = result.stdout.partition('options:')[0]
+    assert '[--profile]' in usage
+    assert '[--metrics-file METRICS_FILE]' in usage
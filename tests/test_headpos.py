@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+mne = pytest.importorskip('mne')
+
+from maxfilter import compute_file_headpos
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+raw_file = os.path.join(data_path, 'chpi_raw.fif')
+
+
+@pytest.fixture(scope='module')
+def whole():
+    return compute_file_headpos(raw_file, chunk_duration=None)[0]
+
+
+def test_head_pos_matches_reference(whole):
+    reference = mne.chpi.read_head_pos(os.path.join(data_path, 'chpi_raw_headpos.pos'))
+    np.testing.assert_allclose(whole, reference, atol=1e-4)
+
+
+def test_chunked_head_pos_matches_whole_recording(whole, tmp_path):
+    pos_file = str(tmp_path / 'headpos.pos')
+    # Window boundaries between the fits, which are 1 s apart
+    chunked = compute_file_headpos(raw_file, chunk_duration=2.5, pos_file=pos_file)[0]
+    np.testing.assert_allclose(chunked[:, 0], whole[:, 0])
+    # The coil fits of a window start from those of the previous window,
+    # within the tolerance of the fits
+    np.testing.assert_allclose(chunked[:, 1:9], whole[:, 1:9], atol=5e-4)
+    # No jumps of the velocity where a window starts
+    np.testing.assert_allclose(chunked[:, 9], whole[:, 9], atol=1e-4)
+    np.testing.assert_allclose(mne.chpi.read_head_pos(pos_file), chunked, atol=1e-5)
@@ -0,0 +1,30 @@
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('mne')
+
+from inventory import Inventory
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def test_raw_and_header_are_read_once(tmp_path):
+    raw_file = str(tmp_path / 'chpi_raw.fif')
+    shutil.copy(os.path.join(data_path, 'chpi_raw.fif'), raw_file)
+    inventory = Inventory()
+
+    header = inventory.header(raw_file)
+    raw = inventory.raw(raw_file)
+    assert (raw.first_samp, raw.n_times) == (header.first_samp, header.n_times)
+    # Copies, changing one does not change the cached raw
+    raw.info['bads'] = ['MEG0111']
+    assert inventory.raw(raw_file).info['bads'] == []
+    assert inventory.header(raw_file) is header
+    assert inventory.misses['headers'] == 1 and inventory.hits['headers'] == 3
+
+    # Read again once the file changed
+    os.utime(raw_file, ns=(0, 0))
+    inventory.raw(raw_file)
+    assert inventory.misses['headers'] == 2
@@ -0,0 +1,22 @@
+import json
+import time
+
+from iolimits import IOLimits
+
+
+def test_charge_waits_for_the_bandwidth_of_the_mount(tmp_path):
+    mount = tmp_path / 'mount'
+    mount.mkdir()
+    output = mount / 'output_raw.fif'
+    output.write_bytes(b'\0' * 2 * 1024**2)
+    limits_file = tmp_path / 'limits.json'
+    limits_file.write_text(json.dumps({str(mount): {'mb_per_s': 10}}))
+    limits = IOLimits()
+    limits.load(str(limits_file))
+
+    start = time.monotonic()
+    # The first 2 MB are written at once, the next have to wait for them
+    limits.charge(str(output), str(mount / 'missing.fif'), str(tmp_path / 'limits.json'))
+    assert time.monotonic() - start < 0.1
+    limits.charge(str(output))
+    assert time.monotonic() - start >= 0.18
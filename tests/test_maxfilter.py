@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import maxfilter
+from maxfilter import MaxFilter, defaultMaxfilterConfig
+from pipeline import JobGraph
+
+
+def test_run_graph_shares_one_pool_in_debug_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(maxfilter, 'debug', True)
+    config = defaultMaxfilterConfig()
+    config['standard_settings']['output_path'] = str(tmp_path)
+    config['advanced_settings']['status_interval'] = 0
+    mf = MaxFilter(config)
+    pools = []
+    graph = JobGraph()
+    for i in range(3):
+        graph.add(f'headpos:{i}', lambda: pools.append(mf.pool))
+    assert mf.run_graph(graph) == {'done': 3}
+    assert len(pools) == 3 and pools[0] is not None
+    assert all(pool is pools[0] for pool in pools)
+    assert mf.pool is None
+
+
+def test_max_movement_from_initial_position():
+    np = pytest.importorskip('numpy')
+    from utils import max_movement
+
+    head_pos = np.zeros((3, 10))
+    head_pos[:, 4:7] = [[0.01, 0.02, 0.05], [0.01, 0.02, 0.053], [0.014, 0.02, 0.05]]
+    assert max_movement(head_pos) == 0.004
+    dev_head_t = {'trans': np.eye(4)}
+    dev_head_t['trans'][:3, 3] = [0.01, 0.02, 0.049]
+    assert max_movement(head_pos, dev_head_t) == round(float(np.hypot(0.004, 0.001)), 4)
+    assert max_movement(np.zeros((0, 10))) is None
+
+
+def test_headpos_without_fits_is_cached(tmp_path, monkeypatch):
+    np = pytest.importorskip('numpy')
+    from maxfilter import TaskContext, write_head_pos_header
+    from utils import HeadposCache
+
+    data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+    def compute_head_pos(self, pos_file=None, **kwargs):
+        # No cHPI fit passed the limits
+        self.head_pos = np.zeros((0, 10))
+        with open(pos_file, 'w') as fid:
+            write_head_pos_header(fid)
+        return self.head_pos
+
+    monkeypatch.setattr(TaskContext, 'compute_head_pos', compute_head_pos)
+    config = defaultMaxfilterConfig()
+    config['standard_settings']['output_path'] = str(tmp_path)
+    mf = MaxFilter(config)
+    mf.headpos_cache = HeadposCache(str(tmp_path / 'cache'))
+    context = TaskContext(data_path, ['chpi_raw.fif'])
+    mf.task_headpos(context, str(tmp_path), 'rest')
+    key = mf._cache_key(context)
+    assert mf.headpos_cache.get(key, 'headpos')
+    assert 'MaxMovement' not in mf.headpos_cache.meta(key)
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+mne = pytest.importorskip('mne')
+
+from maxfilter import run_mne_maxfilter
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+raw_file = os.path.join(data_path, 'chpi_raw.fif')
+# Options of the reference output, see tests/data/make_test_data.py
+options = ['--st', '--corr=0.98', '--movecomp', '--ds=2', '']
+
+
+def test_mne_engine_matches_reference(tmp_path):
+    clean = str(tmp_path / 'chpi_raw_tsss.fif')
+    assert run_mne_maxfilter(raw_file, clean, options) == clean
+
+    raw = mne.io.read_raw_fif(clean, verbose='error')
+    reference = mne.io.read_raw_fif(os.path.join(data_path, 'chpi_raw_sss.fif'), verbose='error')
+    assert raw.ch_names == reference.ch_names
+    assert raw.info['sfreq'] == reference.info['sfreq']
+    assert raw.n_times == reference.n_times
+    for ch_type in ['mag', 'grad']:
+        data = raw.get_data(picks=ch_type)
+        expected = reference.get_data(picks=ch_type)
+        np.testing.assert_allclose(data, expected, atol=1e-4 * np.abs(expected).max())
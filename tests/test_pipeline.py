@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+
+from pipeline import JobGraph
+
+
+def test_dependency_order():
+    order = []
+    graph = JobGraph()
+    a = graph.add('a:1', order.append, 'a')
+    b = graph.add('b:1', order.append, 'b', deps=[a])
+    graph.add('c:1', order.append, 'c', deps=[a, b])
+    assert graph.run(n_jobs=3) == {'done': 3}
+    assert order == ['a', 'b', 'c']
+
+
+def test_failed_job_skips_only_its_dependents():
+    def fail():
+        raise RuntimeError('failed')
+
+    graph = JobGraph()
+    a = graph.add('a:1', fail)
+    b = graph.add('b:1', lambda: None, deps=[a])
+    graph.add('c:1', lambda: None, deps=[b])
+    d = graph.add('d:1', lambda: None)
+    graph.add('e:1', lambda: None, deps=[d])
+    assert graph.run(n_jobs=2) == {'failed': 1, 'skipped': 2, 'done': 2}
+    assert graph.jobs['c:1'].status == 'skipped'
+    assert graph.jobs['e:1'].status == 'done'
+
+
+def test_lock_is_exclusive():
+    lock = threading.Lock()
+    active = []
+
+    def job():
+        with lock:
+            active.append(1)
+            assert len(active) == 1
+        threading.Event().wait(0.01)
+        with lock:
+            active.pop()
+
+    graph = JobGraph()
+    for i in range(8):
+        graph.add(f'bids:{i}', job, lock='bids')
+    assert graph.run(n_jobs=4) == {'done': 8}
+
+
+def test_keyboard_interrupt_is_not_a_failure():
+    def interrupt():
+        raise KeyboardInterrupt
+
+    graph = JobGraph()
+    graph.add('a:1', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        graph.run()
+
+
+def test_large_graph():
+    # 10000 jobs in chains of 100, slow if all jobs are scanned after each job
+    graph = JobGraph()
+    for i in range(100):
+        previous = []
+        for j in range(100):
+            previous = [graph.add(f'job:{i}/{j}', lambda: None, deps=previous)]
+    assert graph.run(n_jobs=4) == {'done': 10000}
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import fake_maxfilter
+from progress import JobStatus
+
+data_path = os.path.join(os.path.dirname(__file__), 'data')
+sample_log = os.path.join(data_path, 'maxfilter_sample.log')
+
+
+def sample_duration():
+    with open(sample_log) as f:
+        return next(float(line.split(':')[1]) for line in f
+                    if line.startswith('# duration:'))
+
+
+def test_progress_from_matching_output():
+    status = JobStatus('rest_raw.fif', duration=40.)
+    status.state = 'running'
+    for line in ['Static bad channels (2): 1433 2511',
+                 'Processing 0.000 -- 10.000 s',
+                 'Processing 10.000 -- 20.000 s']:
+        status.parse_line(line)
+    assert status.progress == 0.5
+    assert status.bad_channels == {'MEG1433', 'MEG2511'}
+    assert status.line().startswith('rest_raw.fif: running 50% (')
+
+
+def test_unmatched_output_is_running_without_progress():
+    status = JobStatus('rest_raw.fif', duration=40.)
+    status.state = 'running'
+    for line in ['Reading rest_raw.fif', 'buffer 1 of 4 done']:
+        status.parse_line(line)
+    assert status.progress is None
+    assert 'running, no progress' in status.line()
+    assert '2 lines of output' in status.line()
+
+
+def test_progress_from_the_sample_log():
+    status = JobStatus('rest_raw.fif', duration=sample_duration())
+    status.state = 'running'
+    for line in fake_maxfilter.read_log(sample_log):
+        status.parse_line(line)
+    assert status.progress == 1.
+    assert status.bad_channels == {'MEG1433', 'MEG2511'}
+    assert status.reported_time is not None
+    assert status.errors == []
+
+
+def test_fake_maxfilter_replays_the_sample_log(tmp_path, capsys):
+    pytest.importorskip('mne')
+    output = str(tmp_path / 'chpi_raw_tsss.fif')
+    assert fake_maxfilter.main(['-f', os.path.join(data_path, 'chpi_raw.fif'),
+                                '-o', output, '--runtime', '0']) == 0
+    assert capsys.readouterr().out.splitlines() == fake_maxfilter.read_log(sample_log)
+    assert os.path.exists(output)
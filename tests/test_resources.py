@@ -0,0 +1,38 @@
+import threading
+import time
+
+from resources import Usage, measure, call_measured
+
+
+def _busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def test_measure_counts_only_the_current_thread():
+    stop = threading.Event()
+
+    def other():
+        while not stop.is_set():
+            sum(range(10000))
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    try:
+        usage = Usage('test', 'sleep')
+        with measure(usage):
+            time.sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+    assert usage.scope == 'thread'
+    assert usage.wall_s >= 0.5
+    assert usage.cpu_s < 0.2
+    assert usage.peak_rss_mb > 0
+
+
+def test_call_measured_counts_the_process():
+    _, usage = call_measured(Usage('test', 'busy'), _busy, 0.3)
+    assert usage.scope == 'process'
+    assert usage.cpu_s >= 0.25
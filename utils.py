@@ -2,11 +2,16 @@
 
 from datetime import datetime
 import sys
-from tkinter.filedialog import askopenfilename, asksaveasfile
 import re
-from os.path import basename
+import os
+import json
+import hashlib
+from shutil import copy2
+from os.path import basename, exists
 
 default_output_path = '/neuro/data/local'
+default_cache_path = os.environ.get(
+    'NATMEG_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'natmeg_utils'))
 noise_patterns = ['empty', 'noise', 'Empty']
 proc_patterns = ['tsss', 'sss', r'corr\d+', r'ds\d+', 'mc', 'avgHead']
 headpos_patterns = ['trans', 'headpos']
@@ -59,6 +64,203 @@ def log(
 def file_contains(file: str, pattern: list):
     return bool(re.compile('|'.join(pattern)).search(file))
 
+def file_fingerprint(file_name: str):
+    """
+    Identity of a file on disk without reading its content.
+
+    Args:
+        file_name (str, required): Path to the file.
+
+    Returns:
+        dict: absolute path, size in bytes and modification time in ns.
+            Only the path is returned if the file does not exist.
+    """
+    file_name = os.path.abspath(file_name)
+    if not exists(file_name):
+        return {'path': file_name}
+    stat = os.stat(file_name)
+    return {
+        'path': file_name,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns
+    }
+
+def hash_fingerprint(fingerprint):
+    """
+    Stable sha256 hex digest of a JSON serializable fingerprint.
+    """
+    serialized = json.dumps(fingerprint, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def read_manifest(manifest_file: str):
+    """
+    Read a JSON manifest, returns an empty dict if missing or unreadable.
+    """
+    if not exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def write_manifest(manifest_file: str, manifest: dict):
+    """
+    Write a JSON manifest atomically so that readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+    tmp_file = f'{manifest_file}.tmp{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=4, default=str)
+    os.replace(tmp_file, manifest_file)
+
+def link_file(src: str, dst: str):
+    """
+    Hard link src to dst, or copy if they are on different file systems.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    if exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+def max_movement(head_pos, dev_head_t=None):
+    """
+    Largest distance of the head from its initial position, in the units of
+    the head positions (m).
+
+    Args:
+        head_pos (np.ndarray, required): Head positions as read by
+            mne.chpi.read_head_pos.
+        dev_head_t (mne.Transform): Device to head transform of the raw
+            file, the initial position. Defaults to the first head position.
+
+    Returns:
+        float: rounded to 0.1 mm, None if there are no head positions.
+    """
+    import numpy as np
+    if len(head_pos) == 0:
+        return None
+    positions = head_pos[:, 4:7]
+    origin = positions[0] if dev_head_t is None else dev_head_t['trans'][:3, 3]
+    return round(float(np.linalg.norm(positions - origin, axis=1).max()), 4)
+
+class HeadposCache:
+    """
+    Head position and average trans files keyed by the raw files they were
+    computed from.
+
+    Shared by maxfilter.py, which computes head positions, and bidsify.py,
+    which copies them to BIDS and summarizes them in the sidecars. Entries
+    are keyed by the fingerprints of the contributing raw files, so they are
+    reused for as long as the raw files are unchanged. Every copy of a cached
+    file (e.g. the one written next to the MaxFilter output and the one in
+    BIDS) is registered as a product of the entry so it can be looked up from
+    its path alone.
+
+    Args:
+        cache_path (str): Root of the cache, defaults to $NATMEG_CACHE or
+            ~/.cache/natmeg_utils.
+    """
+    extensions = {'headpos': '.pos', 'trans': '_trans.fif'}
+
+    def __init__(self, cache_path: str=default_cache_path):
+        self.path = os.path.join(cache_path, 'headpos')
+        self.products_path = os.path.join(self.path, 'products')
+        try:
+            os.makedirs(self.products_path, exist_ok=True)
+            self.enabled = os.access(self.path, os.W_OK)
+        except OSError:
+            self.enabled = False
+        if not self.enabled:
+            print(f'Head position cache {self.path} not writable, cache disabled')
+
+    def key(self, raw_files: list, **params):
+        """
+        Cache key of the raw files of a task plus any parameters that
+        change the result.
+        """
+        return hash_fingerprint({
+            'raw': [file_fingerprint(f) for f in raw_files],
+            'params': params
+        })
+
+    def _entry_file(self, key: str):
+        return os.path.join(self.path, f'{key}.json')
+
+    def _product_file(self, file_name: str):
+        return os.path.join(self.products_path,
+                            f'{hash_fingerprint(os.path.abspath(file_name))}.json')
+
+    def get(self, key: str, kind: str):
+        """
+        Path of the cached file of kind 'headpos' or 'trans', None if missing.
+        """
+        if not self.enabled:
+            return None
+        cached = os.path.join(self.path, f'{key}{self.extensions[kind]}')
+        return cached if exists(cached) else None
+
+    def meta(self, key: str):
+        return read_manifest(self._entry_file(key)).get('meta', {})
+
+    def put(self, key: str, kind: str, file_name: str, **meta):
+        """
+        Store file_name in the cache and register it as a product of key.
+        """
+        if not self.enabled:
+            return
+        link_file(file_name, os.path.join(self.path, f'{key}{self.extensions[kind]}'))
+        entry = read_manifest(self._entry_file(key))
+        entry.setdefault('meta', {}).update(meta)
+        write_manifest(self._entry_file(key), entry)
+        self.register(file_name, key, kind)
+
+    def register(self, file_name: str, key: str, kind: str):
+        """
+        Record that file_name is a copy of the cached file of kind for key.
+        """
+        if not self.enabled:
+            return
+        write_manifest(self._product_file(file_name), {
+            'key': key,
+            'kind': kind,
+            'fingerprint': file_fingerprint(file_name)
+        })
+
+    def lookup(self, file_name: str):
+        """
+        Find the cache entry a file is a copy of.
+
+        Returns:
+            dict: key, kind and meta of the entry, or None if the file is
+                unknown or has changed since it was registered.
+        """
+        if not self.enabled or not exists(file_name):
+            return None
+        product = read_manifest(self._product_file(file_name))
+        if not product or product.get('fingerprint') != file_fingerprint(file_name):
+            return None
+        if not self.get(product['key'], product['kind']):
+            return None
+        return product | {'meta': self.meta(product['key'])}
+
+    def link(self, src: str, dst: str):
+        """
+        Link a registered file to dst and register dst. Returns False if src
+        is not in the cache, in which case nothing is done.
+        """
+        product = self.lookup(src)
+        if not product:
+            return False
+        link_file(self.get(product['key'], product['kind']), dst)
+        self.register(dst, product['key'], product['kind'])
+        return True
+
 def askForConfig():
     """_summary_
 
@@ -69,6 +271,7 @@ def askForConfig():
     Returns:
         dict: dictionary with the configuration parameters
     """
+    from tkinter.filedialog import askopenfilename
     option = input("Do you want to open an existing config file or create a new? ([open]/new/cancel): ").strip().lower()
     # Check if the file is defined or ask for it
     if option not in ['o', 'open']:
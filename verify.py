@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Verify the BIDS outputs of a conversion against their raw sources.
+
+For every converted MEG recording in the conversion table the raw file and
+the BIDS file are read in worker processes and compared on the number of
+samples, the channel names, the sampling frequency and a sha256 of the data
+(as float32, read in chunks so that memory does not grow with the
+recording). Raw and BIDS files are read at the same time, so the run scales
+with the number of workers as long as the disks keep up. Mismatching rows
+are set to run_conversion=yes in the conversion table, so the next bidsify
+run converts them again, and a report is written to conversion_logs.
+
+    python verify.py --config=bids_config.json --n-jobs=8
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from glob import escape, glob
+from os.path import basename, exists
+
+from iolimits import limits
+from staging import split_parts
+
+# Seconds of data hashed at a time
+default_chunk_duration = 10.
+
+
+def fif_digest(file_name: str, chunk_duration: float=default_chunk_duration):
+    """
+    Header values and data hash of a FIF recording, including its split
+    files. Runs in a worker process.
+
+    Args:
+        file_name (str, required): Path to the FIF file.
+        chunk_duration (float): Seconds of data read at a time.
+
+    Returns:
+        dict: n_times, sfreq, ch_names, sha256 of the data as float32
+            and the number of bytes hashed.
+    """
+    import numpy as np
+    import mne
+    raw = mne.io.read_raw_fif(file_name, allow_maxshield=True, verbose='error')
+    sha = hashlib.sha256()
+    n_bytes = 0
+    step = max(int(chunk_duration * raw.info['sfreq']), 1)
+    for start in range(0, raw.n_times, step):
+        data = raw.get_data(start=start, stop=min(start + step, raw.n_times))
+        chunk = np.ascontiguousarray(data, dtype='<f4').tobytes()
+        sha.update(chunk)
+        n_bytes += len(chunk)
+    return {
+        'n_times': raw.n_times,
+        'sfreq': raw.info['sfreq'],
+        'ch_names': raw.ch_names,
+        'sha256': sha.hexdigest(),
+        'n_bytes': n_bytes
+    }
+
+
+def bids_file(bids_path: str, bids_name: str):
+    """The BIDS file of a row, its first split file if it was split."""
+    file_name = f'{bids_path}/{bids_name}'
+    if not exists(file_name):
+        split_name = file_name.replace('_meg.fif', '_split-01_meg.fif')
+        if exists(split_name):
+            return split_name
+    return file_name
+
+
+def recording_files(file_name: str):
+    """All files of a recording, raw split parts or BIDS split files."""
+    if '_split-01_' in basename(file_name):
+        return sorted(glob(escape(file_name).replace('_split-01_', '_split-[0-9][0-9]_')))
+    return split_parts(file_name)
+
+
+def compare(raw: dict, bids: dict):
+    """
+    Returns:
+        list: names of the values that differ.
+    """
+    return [key for key in ['n_times', 'sfreq', 'ch_names', 'sha256']
+            if raw[key] != bids[key]]
+
+
+def verify(config_dict: dict,
+           conversion_file: str=None,
+           n_jobs: int=4,
+           chunk_duration: float=default_chunk_duration):
+    """
+    Compare the converted MEG recordings of a conversion table with their
+    raw sources and mark mismatches for conversion.
+
+    Args:
+        config_dict (dict, required): BIDS configuration.
+        conversion_file (str): Conversion table, defaults to the latest.
+        n_jobs (int): Worker processes.
+        chunk_duration (float): Seconds of data hashed at a time.
+
+    Returns:
+        pd.DataFrame: a row per verified recording with its status.
+    """
+    import pandas as pd
+    from bidsify import latest_conversion_file
+    from utils import file_contains, headpos_patterns
+
+    path_BIDS = config_dict['BIDS']
+    conversion_file = conversion_file or latest_conversion_file(config_dict)
+    df = pd.read_csv(conversion_file, sep='\t', dtype=str)
+
+    # Converted MEG recordings, split files are read with their first file
+    rows = df[(df['run_conversion'] == 'no') & df['split'].isna() & (df['datatype'] == 'meg')
+              & df['bids_name'].fillna('').str.endswith('.fif')
+              & ~df['raw_name'].apply(lambda name: file_contains(name, headpos_patterns))]
+    print(f'Verifying {len(rows)} recordings in {basename(conversion_file)} with {n_jobs} workers')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool, \
+            ThreadPoolExecutor(max_workers=2 * n_jobs) as threads:
+
+        def digest(file_name):
+            # Held here, the limits are not shared with the workers
+            with limits.access(file_name):
+                result = pool.submit(fif_digest, file_name, chunk_duration).result()
+                # Read by MNE in the worker, see iolimits.py
+                limits.charge(*recording_files(file_name))
+                return result
+
+        futures = {}
+        for i, row in rows.iterrows():
+            raw_file = f"{row['raw_path']}/{row['raw_name']}"
+            bids = bids_file(row['bids_path'], row['bids_name'])
+            futures[i] = (threads.submit(digest, raw_file),
+                          threads.submit(digest, bids) if exists(bids) else None)
+
+        results = []
+        n_bytes = 0
+        for i, (raw_future, bids_future) in futures.items():
+            row = rows.loc[i]
+            result = {'raw_name': row['raw_name'], 'bids_name': row['bids_name']}
+            try:
+                raw = raw_future.result()
+            except Exception as e:
+                # Nothing to convert from, leave the row as is
+                results.append(result | {'status': 'raw unreadable', 'mismatches': repr(e)})
+                continue
+            if bids_future is None:
+                mismatches = ['missing']
+            else:
+                try:
+                    bids = bids_future.result()
+                    mismatches = compare(raw, bids)
+                    n_bytes += raw['n_bytes'] + bids['n_bytes']
+                except Exception as e:
+                    mismatches = [f'unreadable ({e!r})']
+            status = 'mismatch' if mismatches else 'ok'
+            if mismatches:
+                df.at[i, 'run_conversion'] = 'yes'
+                print(f"{row['bids_name']} does not match {row['raw_name']}: {', '.join(mismatches)}")
+            results.append(result | {'status': status, 'mismatches': ', '.join(mismatches),
+                                     'n_times': raw['n_times']})
+    seconds = time.perf_counter() - start
+
+    report = pd.DataFrame(results, columns=['raw_name', 'bids_name', 'status', 'mismatches', 'n_times'])
+    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+    report_file = f'{path_BIDS}/conversion_logs/{ts}_bids_verify.tsv'
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    report.to_csv(report_file, sep='\t', index=False)
+
+    bad = report[report['status'] != 'ok']
+    print(f'{len(report) - len(bad)} of {len(report)} recordings match, '
+          f'{n_bytes / 1024**2 / max(seconds, 1e-9):.1f} MB/s of data hashed in {seconds:.1f} s')
+    print(f'Report written to {report_file}')
+    if (report['status'] == 'mismatch').any():
+        df.to_csv(conversion_file, sep='\t', index=False)
+        print(f"{(report['status'] == 'mismatch').sum()} rows set to run_conversion=yes in {basename(conversion_file)}")
+    return report
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='''Verify BIDS
+
+                                     Compares the BIDS outputs of a conversion with their raw sources.
+
+                                     ''',
+                                     add_help=True)
+    parser.add_argument('-c', '--config', type=str, required=True, help='Path to the BIDS configuration file')
+    parser.add_argument('--conversion', type=str, help='Path to the conversion file, defaults to the latest')
+    parser.add_argument('-n', '--n-jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes (default all cores)')
+    parser.add_argument('--chunk-duration', type=float, default=default_chunk_duration, help='Seconds of data hashed at a time (default 10)')
+    parser.add_argument('--io-limits', type=str, help='JSON file with limits on concurrent access and MB/s per storage mount, see iolimits.py')
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    with open(args.config, 'r') as f:
+        config_dict = json.load(f)
+    if args.io_limits:
+        limits.load(args.io_limits, {key: config_dict[key] for key in ['squidMEG', 'opmMEG', 'BIDS']})
+
+    report = verify(config_dict, args.conversion, args.n_jobs, args.chunk_duration)
+    return 1 if (report['status'] != 'ok').any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())